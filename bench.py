@@ -0,0 +1,334 @@
+from __future__ import print_function
+
+import os
+import copy
+import json
+import time
+import platform
+import importlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from subprocess import check_output, CalledProcessError
+from datetime import datetime
+
+import numpy as np
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+from config import get_config
+from utils import prepare_dirs_and_logger, save_config, worker_rngs, produce_examples
+from data_line import draw_path, SVG_START_TEMPLATE, SVG_END_TEMPLATE
+from rasterizer import render_alpha, StrokeMasks
+from tester import Tester, vectorize, update_check, STAGES
+
+
+class SyntheticDrawings(object):
+    # batch_manager of a Tester over data_line drawings made on the fly,
+    # with a given number of strokes and stroke width
+    def __init__(self, config):
+        self.rng = np.random.RandomState(config.random_seed)
+        self.width = config.width
+        self.height = config.height
+        self.stroke_type = config.stroke_type
+        self.min_length = config.min_length
+        self.test_paths = []
+        self.vec_paths = []
+        self.svgs = {}
+
+    def add(self, name, num_strokes, stroke_width):
+        while True:
+            svg = SVG_START_TEMPLATE
+            for i in range(num_strokes):
+                svg += draw_path(self.stroke_type, i, 64, 64, self.min_length,
+                                 stroke_width, self.rng) + '\n'
+            svg += SVG_END_TEMPLATE
+            svg = svg.format(w=self.width, h=self.height)
+            if np.amax(render_alpha(svg)) > 0:
+                break
+        self.svgs[name] = svg
+        return name
+
+    def read_svg(self, file_path):
+        svg = self.svgs[os.path.basename(file_path)]
+        s = render_alpha(svg).astype(np.float)
+        s = s / np.amax(s)
+
+        path_list = StrokeMasks(svg)
+        return s, len(path_list), path_list
+
+
+def rss():
+    # resident set size in MB now, /proc only
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2.0**20
+    except (IOError, OSError, AttributeError):
+        return None
+
+def peak_rss(children=False):
+    # max resident set size in MB of this process or of its largest child
+    # (gco, potrace) so far
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        return peak / 2.0**20 # bytes
+    return peak / 2.0**10 # KB
+
+def commit():
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'],
+                            cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, CalledProcessError):
+        return ''
+
+def scaling(records):
+    # latency ~ coef * pixels^exponent, fit on log-log per stage
+    fit = {}
+    for stage in STAGES + ['total']:
+        x = np.array([r['pixels'] for r in records], dtype=np.float64)
+        if stage == 'total':
+            y = np.array([r['total'] for r in records])
+        else:
+            y = np.array([r['latency'][stage] for r in records])
+        ok = np.logical_and(x > 0, y > 0)
+        if np.sum(ok) < 2 or len(np.unique(x[ok])) < 2:
+            continue
+        exponent, log_coef = np.polyfit(np.log(x[ok]), np.log(y[ok]), 1)
+        fit[stage] = {'exponent': exponent, 'coef': np.exp(log_coef)}
+    return fit
+
+
+def bench_tester(config, size):
+    # tester of size x size synthetic drawings, random weights unless
+    # checkpoints are given
+    c = copy.copy(config)
+    c.width = c.height = size
+    c.mp = False
+    c.num_test = 0
+    c.test_dir = ''
+    c.random_weights = True # nets without a checkpoint
+    if c.bench_tiny:
+        c.conv_hidden_num, c.repeat_num = 8, 4
+
+    drawings = SyntheticDrawings(c)
+    return c, drawings, Tester(c, drawings)
+
+def bench(config):
+    # latency per stage and memory of Tester.predict + vectorize on
+    # synthetic line drawings, for every canvas size x number of strokes x
+    # stroke width, into model_dir/bench.json
+    sizes = [int(s) for s in config.bench_sizes.split(',')]
+    strokes = [int(s) for s in config.bench_strokes.split(',')]
+    widths = [int(s) for s in config.bench_widths.split(',')]
+
+    records = []
+    for size in sizes:
+        c, drawings, tester = bench_tester(config, size)
+
+        # first run pays for session warm-up, tagged so stat() skips it
+        name = drawings.add('warmup_%d.svg' % size, strokes[0], widths[0])
+        pm = tester.predict(os.path.join(c.model_dir, name))
+        pm.warmup = True
+        vectorize(pm)
+
+        for num_strokes in strokes:
+            for stroke_width in widths:
+                for k in range(c.bench_num):
+                    name = drawings.add('bench_%d_%d_%d_%d.svg' % (size, num_strokes, stroke_width, k),
+                                        num_strokes, stroke_width)
+                    pm = tester.predict(os.path.join(c.model_dir, name))
+                    rss_predict = rss()
+                    vectorize(pm)
+
+                    num_pixels = len(pm.path_pixels[0])
+                    records.append({
+                        'size': size,
+                        'strokes': num_strokes,
+                        'stroke_width': stroke_width,
+                        'pixels': num_pixels,
+                        'sites': pm.num_sites,
+                        'edges': pm.num_edges,
+                        'labels': int(np.unique(pm.labels).size),
+                        'latency': {s: pm.latency.get(s, 0) for s in STAGES},
+                        'total': sum(pm.latency.values()),
+                        # pathnet output, one map per ink pixel
+                        'paths_mb': num_pixels * size * size * 4 / 2.0**20,
+                        'rss_mb': rss_predict,
+                        'peak_rss_mb': peak_rss(),
+                        'child_peak_rss_mb': peak_rss(children=True),
+                    })
+
+        tester.sp.close()
+        if tester.find_overlap:
+            tester.so.close()
+
+    result = {
+        'commit': commit(),
+        'time': str(datetime.now()),
+        'sizes': sizes,
+        'strokes': strokes,
+        'widths': widths,
+        'num': config.bench_num,
+        'tiny': config.bench_tiny,
+        'load_pathnet': config.load_pathnet,
+        'load_overlapnet': config.load_overlapnet,
+        'records': sorted(records, key=lambda r: (r['size'], r['pixels'])),
+        'scaling': {str(size): scaling([r for r in records if r['size'] == size])
+                    for size in sizes},
+    }
+
+    print('size strokes width pixels sites edges ' + ' '.join(STAGES) + ' total')
+    for r in result['records']:
+        print('%d %d %d %d %d %d ' % (r['size'], r['strokes'], r['stroke_width'], r['pixels'], r['sites'], r['edges']) +
+              ' '.join('%.3f' % r['latency'][s] for s in STAGES) + ' %.3f' % r['total'])
+    for size in sizes:
+        for stage, fit in sorted(result['scaling'][str(size)].items()):
+            print('%s: %dx%d, %s ~ pixels^%.2f' % (datetime.now(), size, size, stage, fit['exponent']))
+
+    bench_path = os.path.join(config.model_dir, 'bench.json')
+    with open(bench_path, 'w') as f:
+        json.dump(result, f, indent=4)
+    print('%s: %d drawings, results in %s' % (datetime.now(), len(records), bench_path))
+    return result
+
+
+def bench_update(config):
+    # update_check (Tester.update after no edit and after erasing a square
+    # against full reruns) on synthetic drawings of every size x number of
+    # strokes, first stroke width
+    sizes = [int(s) for s in config.bench_sizes.split(',')]
+    strokes = [int(s) for s in config.bench_strokes.split(',')]
+    stroke_width = int(config.bench_widths.split(',')[0])
+
+    for size in sizes:
+        c, drawings, tester = bench_tester(config, size)
+        for num_strokes in strokes:
+            for k in range(c.bench_num):
+                name = drawings.add('update_%d_%d_%d.svg' % (size, num_strokes, k),
+                                    num_strokes, stroke_width)
+                update_check(tester, os.path.join(c.model_dir, name), seed=config.random_seed + k)
+
+        tester.sp.close()
+        if tester.find_overlap:
+            tester.so.close()
+    print('%s: update check done' % datetime.now())
+
+
+# (batch_manager, ids, rng) per worker, inherited by forked processes
+producer_jobs = []
+
+def produce_job(i):
+    return produce_examples(*producer_jobs[i])
+
+def bench_producers(config):
+    # samples/sec and per drawing latency of preprocess_path/overlap of each
+    # dataset, in --bench_workers threads and processes, with the svg read
+    # from the pack or from the files (--data_pack) and, for stroke
+    # datasets, with either rasterizer. into model_dir/bench_producer.json
+    global producer_jobs
+    datasets = config.bench_datasets.split(',')
+    workers = [int(n) for n in config.bench_workers.split(',')]
+    try:
+        fork = multiprocessing.get_context('fork')
+    except (AttributeError, ValueError): # python 2, windows
+        fork = None
+
+    records = []
+    for dataset in datasets:
+        data_path = os.path.join(config.data_dir, dataset)
+        if not os.path.exists(data_path):
+            print('%s: %s not found, skip %s' % (datetime.now(), data_path, dataset))
+            continue
+        if dataset == 'baseball' or dataset == 'cat':
+            module = importlib.import_module('data_qdraw')
+        else:
+            module = importlib.import_module('data_' + dataset)
+        rasterizers = ['cairo'] if hasattr(module, 'TEMPLATE_TRANSFORM') else ['cairo', 'numpy']
+
+        for archi in ['path', 'overlap']:
+            for data_pack in [True, False]:
+                for rasterizer in rasterizers:
+                    c = copy.copy(config)
+                    c.dataset, c.data_path = dataset, data_path
+                    c.archi, c.data_pack, c.rasterizer = archi, data_pack, rasterizer
+                    c.augment = False
+                    batch_manager = module.BatchManager(c)
+                    rng = np.random.RandomState(c.random_seed)
+                    ids = rng.randint(len(batch_manager.train), size=c.bench_samples)
+
+                    for mode in ['thread', 'process']:
+                        if mode == 'process' and fork is None:
+                            continue
+                        for n in workers:
+                            producer_jobs = [(batch_manager, ids[i::n], r)
+                                             for i, r in enumerate(worker_rngs(c.random_seed, n))]
+                            pool = ThreadPool(n) if mode == 'thread' else fork.Pool(n)
+                            start_time = time.time()
+                            results = pool.map(produce_job, range(n))
+                            duration = time.time() - start_time
+                            pool.close()
+                            pool.join()
+
+                            latency = np.concatenate([l for l, _ in results])
+                            num_examples = sum(sum(k) for _, k in results)
+                            p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+                            records.append({
+                                'dataset': dataset,
+                                'archi': archi,
+                                'data_pack': data_pack,
+                                'pack': type(batch_manager.train).__name__,
+                                'rasterizer': rasterizer,
+                                'mode': mode,
+                                'workers': n,
+                                'drawings': len(latency),
+                                'examples': num_examples,
+                                'samples_per_sec': num_examples / duration,
+                                'drawings_per_sec': len(latency) / duration,
+                                'latency': {'mean': np.average(latency), 'p50': p50, 'p95': p95, 'p99': p99},
+                            })
+                            print('%s: %s %s %s %s %d %s, %.1f samples/sec' % (
+                                datetime.now(), dataset, archi, rasterizer, records[-1]['pack'],
+                                n, mode, records[-1]['samples_per_sec']))
+    producer_jobs = []
+
+    print('%-8s %-7s %-12s %-6s %-7s %3s %10s %8s %8s' % (
+        'dataset', 'archi', 'pack', 'raster', 'mode', 'n', 'samples/s', 'p50 ms', 'p95 ms'))
+    for r in records:
+        print('%-8s %-7s %-12s %-6s %-7s %3d %10.1f %8.2f %8.2f' % (
+            r['dataset'], r['archi'], r['pack'], r['rasterizer'], r['mode'], r['workers'],
+            r['samples_per_sec'], r['latency']['p50']*1000, r['latency']['p95']*1000))
+
+    result = {
+        'commit': commit(),
+        'time': str(datetime.now()),
+        'cpu_count': multiprocessing.cpu_count(),
+        'width': config.width,
+        'height': config.height,
+        'samples_per_render': config.samples_per_render,
+        'records': records,
+    }
+    bench_path = os.path.join(config.model_dir, 'bench_producer.json')
+    with open(bench_path, 'w') as f:
+        json.dump(result, f, indent=4)
+    print('%s: results in %s' % (datetime.now(), bench_path))
+    return result
+
+def main(config):
+    prepare_dirs_and_logger(config)
+    save_config(config)
+    if config.bench_mode == 'producer':
+        bench_producers(config)
+    elif config.bench_mode == 'update':
+        bench_update(config)
+    else:
+        bench(config)
+
+if __name__ == "__main__":
+    config, unparsed = get_config()
+    setattr(config, 'is_train', False)
+    if config.bench_mode != 'producer':
+        setattr(config, 'dataset', 'line')
+    main(config)
@@ -32,17 +32,34 @@ data_arg.add_argument('--dataset', type=str, default='line',
                       choices=['line','ch','kanji','baseball','cat'])
 data_arg.add_argument('--batch_size', type=int, default=8)
 data_arg.add_argument('--num_worker', type=int, default=16)
+data_arg.add_argument('--rasterizer', type=str, default='cairo',
+                      choices=['cairo','numpy']) # numpy: line, baseball, cat
+data_arg.add_argument('--data_pack', type=str2bool, default=True) # train/test.pack in data_path
+data_arg.add_argument('--augment', type=str2bool, default=False)
+data_arg.add_argument('--aug_rotate', type=float, default=15) # deg
+data_arg.add_argument('--aug_scale', type=float, default=0.2) # [1-s, 1+s]
+data_arg.add_argument('--aug_translate', type=float, default=0.1) # of viewBox
+data_arg.add_argument('--samples_per_render', type=int, default=1) # pathnet
+data_arg.add_argument('--rank', type=int, default=0) # training process, trains on train records rank::world_size
+data_arg.add_argument('--world_size', type=int, default=1) # training processes
 # line
 data_arg.add_argument('--num_strokes', type=int, default=4)
 data_arg.add_argument('--stroke_type', type=int, default=2)
 data_arg.add_argument('--min_length', type=int, default=10)
 data_arg.add_argument('--max_stroke_width', type=int, default=2) # 4 for varying w.
+data_arg.add_argument('--gen_shard_size', type=int, default=1000)
+data_arg.add_argument('--gen_reference', type=str2bool, default=False) # svg/, jpg/
 
 # Training / test parameters
 train_arg = add_argument_group('Training')
 train_arg.add_argument('--is_train', type=str2bool, default=True)
 train_arg.add_argument('--use_gpu', type=str2bool, default=True)
 train_arg.add_argument('--gpu_id', type=str, default='0')
+train_arg.add_argument('--num_replica', type=int, default=1) # towers on GPU 0..N-1 of one process, averaged grads
+train_arg.add_argument('--cluster_port', type=int, default=2222) # world_size > 1: localhost ps, rank r on port+1+r
+train_arg.add_argument('--precision', type=str, default='float32',
+                       choices=['float32','float16','bfloat16']) # conv compute, weights stay float32
+train_arg.add_argument('--loss_scale', type=float, default=128) # float16 only
 train_arg.add_argument('--start_step', type=int, default=0)
 train_arg.add_argument('--max_step', type=int, default=50000) # 2000
 train_arg.add_argument('--lr_update_step', type=int, default=20000)
@@ -66,12 +83,39 @@ vect_arg.add_argument('--find_overlap', type=str2bool, default=True)
 vect_arg.add_argument('--overlap_threshold', type=float, default=0.5)
 vect_arg.add_argument('--test_batch_size', type=int, default=512)
 vect_arg.add_argument('--mp', type=str2bool, default=True)
+vect_arg.add_argument('--test_dir', type=str, default='') # raster inputs
+vect_arg.add_argument('--raster_threshold', type=float, default=0)
+vect_arg.add_argument('--raster_cache', type=str2bool, default=False)
+vect_arg.add_argument('--compute_accuracy', type=str2bool, default=True)
+vect_arg.add_argument('--gt_one_pass', type=str2bool, default=False)
+vect_arg.add_argument('--serve', type=str2bool, default=False)
+vect_arg.add_argument('--serve_port', type=int, default=8000)
+vect_arg.add_argument('--serve_batch', type=int, default=8)
+vect_arg.add_argument('--serve_wait', type=float, default=0.01) # sec
+vect_arg.add_argument('--random_weights', type=str2bool, default=False) # nets without load_*
+
+# Bench (bench.py)
+bench_arg = add_argument_group('Bench')
+bench_arg.add_argument('--bench_mode', type=str, default='vectorize',
+                       choices=['vectorize','producer','update'])
+bench_arg.add_argument('--bench_sizes', type=str, default='64') # canvas w=h
+bench_arg.add_argument('--bench_strokes', type=str, default='1,2,4,8,16')
+bench_arg.add_argument('--bench_widths', type=str, default='1,2,4')
+bench_arg.add_argument('--bench_num', type=int, default=3) # drawings per setting
+bench_arg.add_argument('--bench_tiny', type=str2bool, default=False) # 8 filters, 4 layers
+bench_arg.add_argument('--bench_datasets', type=str, default='line,ch,kanji,baseball') # producer
+bench_arg.add_argument('--bench_workers', type=str, default='1,2,4,8') # producer threads/processes
+bench_arg.add_argument('--bench_samples', type=int, default=200) # producer drawings per run
 
 # Misc
 misc_arg = add_argument_group('Misc')
 misc_arg.add_argument('--log_step', type=int, default=100)
+misc_arg.add_argument('--trace_step', type=int, default=1000) # FULL_TRACE for the dequeue wait, 0: never
 misc_arg.add_argument('--test_step', type=int, default=10000) # 1000
+misc_arg.add_argument('--eval_size', type=int, default=4000) # fixed test examples, data_path/valid
+misc_arg.add_argument('--eval', type=str2bool, default=False) # score load_pathnet/overlapnet (--archi)
 misc_arg.add_argument('--save_sec', type=int, default=900)
+misc_arg.add_argument('--profile', type=str, default='') # train steps or test files (name or index), model_dir/profile
 misc_arg.add_argument('--log_dir', type=str, default='log')
 misc_arg.add_argument('--tag', type=str, default='test')
 misc_arg.add_argument('--random_seed', type=int, default=123)
@@ -90,4 +134,7 @@ def get_config():
         data_format = 'NHWC'
     # data_format = 'NHWC' # for debug
     setattr(config, 'data_format', data_format)
+
+    assert 0 <= config.rank < config.world_size, \
+        'rank %d out of range for world_size %d' % (config.rank, config.world_size)
     return config, unparsed
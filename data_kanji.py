@@ -15,6 +15,15 @@ import xml.etree.ElementTree as et
 import matplotlib.pyplot as plt
 
 from ops import *
+from rasterizer import StrokeMasks, StrokeSVG, stroke_buffers, augment_template, sample_markers
+from data_pack import load_split
+from utils import worker_rngs, epoch_ids, compact_example
+
+
+# rotate/scale/translate of the svg_pre template: glyph as is in 109 units
+TEMPLATE_TRANSFORM = (0, [1, 1], [0, 0])
+TEMPLATE_CENTER = 54
+TEMPLATE_SIZE = 109
 
 
 class BatchManager(object):
@@ -22,8 +31,10 @@ class BatchManager(object):
         self.root = config.data_path
         self.rng = np.random.RandomState(config.random_seed)
 
-        self.paths = sorted(glob("{}/train/*.{}".format(self.root, 'svg_pre')))
-        self.test_paths = sorted(glob("{}/test/*.{}".format(self.root, 'svg_pre')))
+        # svg text of each split, read once from a pack
+        self.paths, self.train = load_split(self.root, 'train', 'svg_pre', False, config.data_pack,
+                                            config.rank, config.world_size)
+        self.test_paths, self.test = load_split(self.root, 'test', 'svg_pre', False, config.data_pack)
         assert(len(self.paths) > 0 and len(self.test_paths) > 0)
 
         self.batch_size = config.batch_size
@@ -31,21 +42,47 @@ class BatchManager(object):
         self.width = config.width
        
         self.is_pathnet = (config.archi == 'path')
+        # glyph outlines are filled paths, only cairo renders them
+        assert config.rasterizer == 'cairo', 'numpy rasterizer supports stroke datasets only'
+        # examples are queued compactly and expanded to float in batch():
+        # uint8 image, then the marker (row, col) and uint8 stroke alpha
+        # for pathnet, the bits of the overlap mask for overlapnet
         if self.is_pathnet:
-            feature_dim = [self.height, self.width, 2]
-            label_dim = [self.height, self.width, 1]
+            dtypes = [tf.uint8, tf.int32, tf.uint8]
+            shapes = [[self.height, self.width, 1], [2], [self.height, self.width, 1]]
         else:
-            feature_dim = [self.height, self.width, 1]
-            label_dim = [self.height, self.width, 1]
+            dtypes = [tf.uint8, tf.uint8]
+            shapes = [[self.height, self.width, 1], [(self.height*self.width + 7) // 8]]
+
+        # pathnet examples per rendered drawing (overlapnet has no marker)
+        self.samples_per_render = config.samples_per_render if self.is_pathnet else 1
 
         self.capacity = 10000
-        self.q = tf.FIFOQueue(self.capacity, [tf.float32, tf.float32], [feature_dim, label_dim])
-        self.x = tf.placeholder(dtype=tf.float32, shape=feature_dim)
-        self.y = tf.placeholder(dtype=tf.float32, shape=label_dim)
-        self.enqueue = self.q.enqueue([self.x, self.y])
+        if self.samples_per_render > 1:
+            # examples of one drawing are spread over batches
+            self.q = tf.RandomShuffleQueue(self.capacity, self.capacity // 2,
+                                           dtypes, shapes,
+                                           seed=config.random_seed)
+        else:
+            self.q = tf.FIFOQueue(self.capacity, dtypes, shapes)
+        self.inputs = [tf.placeholder(dtype=d, shape=[None] + s) for d, s in zip(dtypes, shapes)]
+        self.enqueue = self.q.enqueue_many(self.inputs)
         self.num_threads = config.num_worker
         # np.amin([config.num_worker, multiprocessing.cpu_count(), self.batch_size])
 
+        # random template transform per sample
+        self.augment = None
+        if config.augment:
+            self.augment = (config.aug_rotate, config.aug_scale, config.aug_translate)
+
+        # one rng stream per producer thread, for markers and augmentation
+        self.worker_rngs = worker_rngs(config.random_seed, self.num_threads)
+        # train ids of each producer thread, every drawing once per epoch
+        self.samplers = [epoch_ids(len(self.train), config.random_seed, i, self.num_threads)
+                         for i in range(self.num_threads)]
+        # examples enqueued by each producer thread (trainer throughput log)
+        self.produced = [0] * self.num_threads
+
     def __del__(self):
         try:
             self.stop_thread()
@@ -60,29 +97,40 @@ class BatchManager(object):
         self.coord = tf.train.Coordinator()
 
         # Create a method for loading and enqueuing
-        def load_n_enqueue(sess, enqueue, coord, paths, rng,
-                           x, y, w, h, is_pathnet):
+        def load_n_enqueue(sess, enqueue, coord, pack, sampler, rng, produced, worker,
+                           inputs, w, h, is_pathnet, augment, num_samples):
             with coord.stop_on_exception():                
                 while not coord.should_stop():
-                    id = rng.randint(len(paths))
+                    id = next(sampler)
+                    svg = pack.read(id)
+                    transform = TEMPLATE_TRANSFORM
+                    if augment is not None:
+                        transform = augment_template(rng, augment, transform,
+                                                     TEMPLATE_CENTER, TEMPLATE_SIZE)
                     if is_pathnet:
-                        x_, y_ = preprocess_path(paths[id], w, h, rng)
+                        x_, y_ = preprocess_path(svg, w, h, rng, transform, num_samples)
                     else:
-                        x_, y_ = preprocess_overlap(paths[id], w, h, rng)
-                    sess.run(enqueue, feed_dict={x: x_, y: y_})
+                        x_, y_ = preprocess_overlap(svg, w, h, rng, transform)
+                        x_, y_ = x_[np.newaxis], y_[np.newaxis]
+                    sess.run(enqueue, feed_dict=dict(zip(inputs, compact_example(x_, y_, is_pathnet))))
+                    produced[worker] += len(x_)
 
         # Create threads that enqueue
         self.threads = [threading.Thread(target=load_n_enqueue, 
                                           args=(self.sess, 
                                                 self.enqueue,
                                                 self.coord,
-                                                self.paths,
-                                                self.rng,
-                                                self.x,
-                                                self.y,
+                                                self.train,
+                                                self.samplers[i],
+                                                self.worker_rngs[i],
+                                                self.produced,
+                                                i,
+                                                self.inputs,
                                                 self.width,
                                                 self.height,
-                                                self.is_pathnet)
+                                                self.is_pathnet,
+                                                self.augment,
+                                                self.samples_per_render)
                                           ) for i in range(self.num_threads)]
 
         # define signal handler
@@ -117,13 +165,17 @@ class BatchManager(object):
         self.sess.run(self.q.close(cancel_pending_enqueues=True))
         self.coord.join(self.threads)
 
-    def test_batch(self):
+    def test_batch(self, rng=None):
+        # rng: a seeded one gives the same test markers every time
+        if rng is None:
+            rng = self.rng
         x_list, y_list = [], []
-        for i, file_path in enumerate(self.test_paths):
+        for i in range(len(self.test)):
+            svg = self.test.read(i)
             if self.is_pathnet:
-                x_, y_ = preprocess_path(file_path, self.width, self.height, self.rng)
+                x_, y_ = preprocess_path(svg, self.width, self.height, rng)
             else:
-                x_, y_ = preprocess_overlap(file_path, self.width, self.height, self.rng)
+                x_, y_ = preprocess_overlap(svg, self.width, self.height, rng)
             x_list.append(x_)
             y_list.append(y_)
             if i % self.batch_size == self.batch_size-1:
@@ -131,7 +183,8 @@ class BatchManager(object):
                 x_list, y_list = [], []
 
     def batch(self):
-        return self.q.dequeue_many(self.batch_size)
+        return expand_example(self.q.dequeue_many(self.batch_size),
+                              self.height, self.width, self.is_pathnet)
 
     def sample(self, num):
         idx = self.rng.choice(len(self.paths), num).tolist()
@@ -140,12 +193,14 @@ class BatchManager(object):
     def random_list(self, num):
         x_list = []
         xs, ys = [], []
-        file_list = self.sample(num)
-        for file_path in file_list:
+        idx = self.rng.choice(len(self.paths), num).tolist()
+        file_list = [self.paths[i] for i in idx]
+        for i in idx:
+            svg = self.train.read(i)
             if self.is_pathnet:
-                x, y = preprocess_path(file_path, self.width, self.height, self.rng)
+                x, y = preprocess_path(svg, self.width, self.height, self.rng)
             else:
-                x, y = preprocess_overlap(file_path, self.width, self.height, self.rng)
+                x, y = preprocess_overlap(svg, self.width, self.height, self.rng)
             x_list.append(x)
 
             if self.is_pathnet:
@@ -158,8 +213,12 @@ class BatchManager(object):
         return np.array(x_list), np.array(xs), np.array(ys), file_list
 
     def read_svg(self, file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            svg = f.read()
+        if os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                svg = f.read()
+        else:
+            # preprocessed test set, only in the shard packs
+            svg = self.test.read(self.test.index(os.path.basename(file_path)))
 
         r = 0
         s = [1, 1]
@@ -181,49 +240,14 @@ class BatchManager(object):
         max_intensity = np.amax(s)
         s = s / max_intensity
 
-        path_list = []        
-        pid = 0
-        num_paths = 0
-        while pid != -1:
-            pid = svg.find('path id', pid + 1)
-            num_paths = num_paths + 1
-        num_paths = num_paths - 1 # uncount last one
-        
-        for i in range(num_paths):
-            svg_one = svg
-            pid = len(svg_one)
-            for j in range(num_paths):
-                pid = svg_one.rfind('path id', 0, pid)
-                if j != i:
-                    id_start = svg_one.rfind('>', 0, pid) + 1
-                    id_end = svg_one.find('/>', id_start) + 2
-                    svg_one = svg_one[:id_start] + svg_one[id_end:]
-
-            # leave only one path
-            y_png = cairosvg.svg2png(bytestring=svg_one.encode('utf-8'))
-            y_img = Image.open(io.BytesIO(y_png))
-            path = (np.array(y_img)[:,:,3] > 0)            
-            path_list.append(path)
+        # ground truth strokes, rendered on demand
+        path_list = StrokeMasks(svg)
+        num_paths = len(path_list)
 
         return s, num_paths, path_list
 
-def preprocess_path(file_path, w, h, rng):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        svg = f.read()
-
-    r = 0
-    s = [1, 1]
-    t = [0, 0]
-    # if transform:
-    #     r = rng.randint(-45, 45)
-    #     # s_sign = rng.choice([1, -1], 1)[0]
-    #     s_sign = 1
-    #     s = 1.75 * rng.random_sample(2) + 0.25 # [0.25, 2)
-    #     s[1] = s[1] * s_sign
-    #     t = rng.randint(-10, 10, 2)
-    #     if s_sign == -1:
-    #         t[1] = t[1] - 109
-
+def preprocess_path(svg, w, h, rng, transform=TEMPLATE_TRANSFORM, num_samples=None):
+    r, s, t = transform
     svg = svg.format(w=w, h=h, r=r, sx=s[0], sy=s[1], tx=t[0], ty=t[1])
     img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
     img = Image.open(io.BytesIO(img))
@@ -231,7 +255,6 @@ def preprocess_path(file_path, w, h, rng):
     max_intensity = np.amax(s)
     s = s / max_intensity
 
-    # while True:
     pid = 0
     num_paths = 0
     while pid != -1:
@@ -239,35 +262,22 @@ def preprocess_path(file_path, w, h, rng):
         num_paths = num_paths + 1
     num_paths = num_paths - 1 # uncount last one
 
-    path_id = rng.randint(num_paths)
-    svg_one = svg
-    pid = len(svg_one)
-    for c in range(num_paths):
-        pid = svg_one.rfind('path id', 0, pid)
-        if c != path_id:
-            id_start = svg_one.rfind('>', 0, pid) + 1
-            id_end = svg_one.find('/>', id_start) + 2
-            svg_one = svg_one[:id_start] + svg_one[id_end:]
-
-    # leave only one path
-    y_png = cairosvg.svg2png(bytestring=svg_one.encode('utf-8'))
-    y_img = Image.open(io.BytesIO(y_png))
-    y = np.array(y_img)[:,:,3].astype(np.float) / max_intensity # [0,1]
-
-    pixel_ids = np.nonzero(y)
-    # if len(pixel_ids[0]) == 0:
-    #     continue
-    # else:
-    #     break            
-
-    # select arbitrary marking pixel
-    point_id = rng.randint(len(pixel_ids[0]))
-    px, py = pixel_ids[0][point_id], pixel_ids[1][point_id]
-
-    y = np.reshape(y, [h, w, 1])
-    x = np.zeros([h, w, 2])
-    x[:,:,0] = s
-    x[px,py,1] = 1.0
+    def render_stroke(path_id):
+        # leave only one path
+        svg_one = svg
+        pid = len(svg_one)
+        for c in range(num_paths):
+            pid = svg_one.rfind('path id', 0, pid)
+            if c != path_id:
+                id_start = svg_one.rfind('>', 0, pid) + 1
+                id_end = svg_one.find('/>', id_start) + 2
+                svg_one = svg_one[:id_start] + svg_one[id_end:]
+
+        y_png = cairosvg.svg2png(bytestring=svg_one.encode('utf-8'))
+        y_img = Image.open(io.BytesIO(y_png))
+        return np.array(y_img)[:,:,3].astype(np.float) / max_intensity # [0,1]
+
+    x, y = sample_markers(s, render_stroke, num_paths, rng, num_samples)
 
     # # debug
     # plt.figure()
@@ -283,23 +293,8 @@ def preprocess_path(file_path, w, h, rng):
 
     return x, y
 
-def preprocess_overlap(file_path, w, h, rng):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        svg = f.read()
-    
-    r = 0
-    s = [1, 1]
-    t = [0, 0]
-    # if transform:
-    #     r = rng.randint(-45, 45)
-    #     # s_sign = rng.choice([1, -1], 1)[0]
-    #     s_sign = 1
-    #     s = 1.75 * rng.random_sample(2) + 0.25 # [0.25, 2)
-    #     s[1] = s[1] * s_sign
-    #     t = rng.randint(-10, 10, 2)
-    #     if s_sign == -1:
-    #         t[1] = t[1] - 109
-
+def preprocess_overlap(svg, w, h, rng, transform=TEMPLATE_TRANSFORM):
+    r, s, t = transform
     svg = svg.format(w=w, h=h, r=r, sx=s[0], sy=s[1], tx=t[0], ty=t[1])
     img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
     img = Image.open(io.BytesIO(img))
@@ -307,36 +302,9 @@ def preprocess_overlap(file_path, w, h, rng):
     max_intensity = np.amax(s)
     s = s / max_intensity
 
-    # while True:
-    path_list = []        
-    pid = 0
-    num_paths = 0
-    while pid != -1:
-        pid = svg.find('path id', pid + 1)
-        num_paths = num_paths + 1
-    num_paths = num_paths - 1 # uncount last one
-    
-    for i in range(num_paths):
-        svg_one = svg
-        pid = len(svg_one)
-        for j in range(num_paths):
-            pid = svg_one.rfind('path id', 0, pid)
-            if j != i:
-                id_start = svg_one.rfind('>', 0, pid) + 1
-                id_end = svg_one.find('/>', id_start) + 2
-                svg_one = svg_one[:id_start] + svg_one[id_end:]
-
-        # leave only one path
-        y_png = cairosvg.svg2png(bytestring=svg_one.encode('utf-8'))
-        y_img = Image.open(io.BytesIO(y_png))
-        path = (np.array(y_img)[:,:,3] > 0)            
-        path_list.append(path)
-
-    y = np.zeros([h, w], dtype=np.int)
-    for i in range(num_paths-1):
-        for j in range(i+1, num_paths):
-            intersect = np.logical_and(path_list[i], path_list[j])
-            y = np.logical_or(intersect, y)
+    # overlap: pixels covered by two or more strokes
+    count, _ = stroke_buffers(StrokeSVG(svg))
+    y = (count >= 2)
 
     x = np.expand_dims(s, axis=-1)
     y = np.expand_dims(y, axis=-1)
@@ -356,8 +324,9 @@ def preprocess_overlap(file_path, w, h, rng):
 def main(config):
     prepare_dirs_and_logger(config)
     batch_manager = BatchManager(config)
-    preprocess_path('data/kanji/train/0f9a8.svg_pre', 64, 64, batch_manager.rng)
-    preprocess_overlap('data/kanji/train/0f9a8.svg_pre', 64, 64, batch_manager.rng)
+    svg = batch_manager.train.read(0)
+    preprocess_path(svg, 64, 64, batch_manager.rng)
+    preprocess_overlap(svg, 64, 64, batch_manager.rng)
 
     # thread test
     sess_config = tf.ConfigProto()
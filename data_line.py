@@ -1,4 +1,5 @@
 import os
+import json
 from glob import glob
 import threading
 import multiprocessing
@@ -15,6 +16,10 @@ import xml.etree.ElementTree as et
 import matplotlib.pyplot as plt
 
 from ops import *
+from rasterizer import StrokeMasks, StrokeSVG, stroke_buffers
+from rasterizer import parse_drawing, rasterize_strokes, composite, augment_drawings, sample_markers
+from data_pack import load_pack, write_pack, DrawingPack, shard_records
+from utils import worker_rngs, epoch_ids, compact_example
 
 
 SVG_START_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?><!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
@@ -23,6 +28,15 @@ SVG_START_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?><!DOCTYPE svg PUBL
 SVG_LINE_TEMPLATE = """<path id="{id}" d="M {x1} {y1} L{x2} {y2}" stroke="rgb({r},{g},{b})" stroke-width="{sw}"/>"""
 SVG_CUBIC_BEZIER_TEMPLATE = """<path id="{id}" d="M {sx} {sy} C {cx1} {cy1} {cx2} {cy2} {tx} {ty}" stroke="rgb({r},{g},{b})" stroke-width="{sw}"/>"""
 SVG_END_TEMPLATE = """</g>\n</svg>"""
+# viewBox of SVG_START_TEMPLATE: drawings are generated in its units and
+# rendered at width x height
+VIEW_SIZE = 64
+
+# generated shards are kept only while these flags (and the split sizes)
+# match the ones recorded with them in gen_config.json
+GEN_CONFIG_FILE = 'gen_config.json'
+GEN_CONFIG_KEYS = ['num_strokes', 'stroke_type', 'min_length', 'max_stroke_width',
+                   'random_seed', 'gen_shard_size']
 
 
 class BatchManager(object):
@@ -31,20 +45,27 @@ class BatchManager(object):
         self.rng = np.random.RandomState(config.random_seed)
 
         self.paths = sorted(glob("{}/train/*.{}".format(self.root, 'svg_pre')))
-        if len(self.paths) == 0:
-            # create line dataset
-            data_dir = os.path.join(config.data_dir, config.dataset)
-            train_dir = os.path.join(data_dir, 'train')
-            if not os.path.exists(train_dir):
-                os.makedirs(train_dir)
-            test_dir = os.path.join(data_dir, 'test')
-            if not os.path.exists(test_dir):
-                os.makedirs(test_dir)
-
-            self.paths = gen_data(data_dir, config, self.rng,
-                                    num_train=45000, num_test=5000)
-        
-        self.test_paths = sorted(glob("{}/test/*.{}".format(self.root, 'svg_pre')))
+        if len(self.paths) > 0:
+            self.test_paths = sorted(glob("{}/test/*.{}".format(self.root, 'svg_pre')))
+
+            # svg text and stroke geometry of each split, read once from a pack
+            self.train = load_pack(self.paths, os.path.join(self.root, 'train.pack'),
+                                   True, config.data_pack)
+            self.test = load_pack(self.test_paths, os.path.join(self.root, 'test.pack'),
+                                  True, config.data_pack)
+        else:
+            # generated line dataset, only in shard packs (missing shards
+            # of an interrupted run are generated first)
+            train_shards, test_shards = gen_data(self.root, config,
+                                                 num_train=45000, num_test=5000)
+            self.train = DrawingPack(train_shards)
+            self.test = DrawingPack(test_shards)
+            self.paths = [os.path.join(self.root, 'train', n) for n in self.train.names]
+            self.test_paths = [os.path.join(self.root, 'test', n) for n in self.test.names]
+        if config.world_size > 1:
+            # this trainer's records of the train split
+            self.paths = self.paths[config.rank::config.world_size]
+            self.train = shard_records(self.train, config.rank, config.world_size)
         assert(len(self.paths) > 0 and len(self.test_paths) > 0)
 
         self.batch_size = config.batch_size
@@ -52,21 +73,47 @@ class BatchManager(object):
         self.width = config.width
 
         self.is_pathnet = (config.archi == 'path')
+        self.rasterizer = config.rasterizer
+        # examples are queued compactly and expanded to float in batch():
+        # uint8 image, then the marker (row, col) and uint8 stroke alpha
+        # for pathnet, the bits of the overlap mask for overlapnet
         if self.is_pathnet:
-            feature_dim = [self.height, self.width, 2]
-            label_dim = [self.height, self.width, 1]
+            dtypes = [tf.uint8, tf.int32, tf.uint8]
+            shapes = [[self.height, self.width, 1], [2], [self.height, self.width, 1]]
         else:
-            feature_dim = [self.height, self.width, 1]
-            label_dim = [self.height, self.width, 1]
+            dtypes = [tf.uint8, tf.uint8]
+            shapes = [[self.height, self.width, 1], [(self.height*self.width + 7) // 8]]
+
+        # pathnet examples per rendered drawing (overlapnet has no marker)
+        self.samples_per_render = config.samples_per_render if self.is_pathnet else 1
 
         self.capacity = 10000
-        self.q = tf.FIFOQueue(self.capacity, [tf.float32, tf.float32], [feature_dim, label_dim])
-        self.x = tf.placeholder(dtype=tf.float32, shape=feature_dim)
-        self.y = tf.placeholder(dtype=tf.float32, shape=label_dim)
-        self.enqueue = self.q.enqueue([self.x, self.y])
+        if self.samples_per_render > 1:
+            # examples of one drawing are spread over batches
+            self.q = tf.RandomShuffleQueue(self.capacity, self.capacity // 2,
+                                           dtypes, shapes,
+                                           seed=config.random_seed)
+        else:
+            self.q = tf.FIFOQueue(self.capacity, dtypes, shapes)
+        self.inputs = [tf.placeholder(dtype=d, shape=[None] + s) for d, s in zip(dtypes, shapes)]
+        self.enqueue = self.q.enqueue_many(self.inputs)
         self.num_threads = config.num_worker
         # np.amin([config.num_worker, multiprocessing.cpu_count(), self.batch_size])
 
+        # random similarity on the parsed strokes of a batch of drawings
+        self.augment = None
+        if config.augment:
+            assert self.rasterizer == 'numpy', 'augmentation transforms the parsed geometry, use --rasterizer=numpy'
+            self.augment = (config.aug_rotate, config.aug_scale, config.aug_translate)
+
+        # one rng stream per producer thread, for markers and augmentation
+        self.worker_rngs = worker_rngs(config.random_seed, self.num_threads)
+        # train ids of each producer thread, every drawing once per epoch
+        self.samplers = [epoch_ids(len(self.train), config.random_seed, i, self.num_threads)
+                         for i in range(self.num_threads)]
+        # examples enqueued by each producer thread (trainer throughput log)
+        self.produced = [0] * self.num_threads
+
     def __del__(self):
         try:
             self.stop_thread()
@@ -81,29 +128,45 @@ class BatchManager(object):
         self.coord = tf.train.Coordinator()
 
         # Create a method for loading and enqueuing
-        def load_n_enqueue(sess, enqueue, coord, paths, rng,
-                           x, y, w, h, is_pathnet):
+        def load_n_enqueue(sess, enqueue, coord, pack, sampler, rng, produced, worker,
+                           inputs, w, h, is_pathnet, rasterizer, augment, batch_size,
+                           num_samples):
             with coord.stop_on_exception():                
                 while not coord.should_stop():
-                    id = rng.randint(len(paths))
-                    if is_pathnet:
-                        x_, y_ = preprocess_path(paths[id], w, h, rng)
-                    else:
-                        x_, y_ = preprocess_overlap(paths[id], w, h, rng)
-                    sess.run(enqueue, feed_dict={x: x_, y: y_})
+                    ids = [next(sampler) for _ in range(batch_size)]
+                    samples = [pack[id] for id in ids]
+                    if augment is not None:
+                        drawings = [d if d is not None else parse_drawing(svg) for svg, d in samples]
+                        drawings = augment_drawings(drawings, rng, augment)
+                        samples = [(svg, d) for (svg, _), d in zip(samples, drawings)]
+
+                    for svg, drawing in samples:
+                        if is_pathnet:
+                            x_, y_ = preprocess_path(svg, w, h, rng, rasterizer, drawing, num_samples)
+                        else:
+                            x_, y_ = preprocess_overlap(svg, w, h, rng, rasterizer, drawing)
+                            x_, y_ = x_[np.newaxis], y_[np.newaxis]
+                        sess.run(enqueue, feed_dict=dict(zip(inputs, compact_example(x_, y_, is_pathnet))))
+                        produced[worker] += len(x_)
 
         # Create threads that enqueue
         self.threads = [threading.Thread(target=load_n_enqueue, 
                                           args=(self.sess, 
                                                 self.enqueue,
                                                 self.coord,
-                                                self.paths,
-                                                self.rng,
-                                                self.x,
-                                                self.y,
+                                                self.train,
+                                                self.samplers[i],
+                                                self.worker_rngs[i],
+                                                self.produced,
+                                                i,
+                                                self.inputs,
                                                 self.width,
                                                 self.height,
-                                                self.is_pathnet)
+                                                self.is_pathnet,
+                                                self.rasterizer,
+                                                self.augment,
+                                                self.batch_size,
+                                                self.samples_per_render)
                                           ) for i in range(self.num_threads)]
 
         # define signal handler
@@ -138,13 +201,17 @@ class BatchManager(object):
         self.sess.run(self.q.close(cancel_pending_enqueues=True))
         self.coord.join(self.threads)
 
-    def test_batch(self):
+    def test_batch(self, rng=None):
+        # rng: a seeded one gives the same test markers every time
+        if rng is None:
+            rng = self.rng
         x_list, y_list = [], []
-        for i, file_path in enumerate(self.test_paths):
+        for i in range(len(self.test)):
+            svg, drawing = self.test[i]
             if self.is_pathnet:
-                x_, y_ = preprocess_path(file_path, self.width, self.height, self.rng)
+                x_, y_ = preprocess_path(svg, self.width, self.height, rng, self.rasterizer, drawing)
             else:
-                x_, y_ = preprocess_overlap(file_path, self.width, self.height, self.rng)
+                x_, y_ = preprocess_overlap(svg, self.width, self.height, rng, self.rasterizer, drawing)
             x_list.append(x_)
             y_list.append(y_)
             if i % self.batch_size == self.batch_size-1:
@@ -152,7 +219,8 @@ class BatchManager(object):
                 x_list, y_list = [], []
 
     def batch(self):
-        return self.q.dequeue_many(self.batch_size)
+        return expand_example(self.q.dequeue_many(self.batch_size),
+                              self.height, self.width, self.is_pathnet)
 
     def sample(self, num):
         idx = self.rng.choice(len(self.paths), num).tolist()
@@ -161,12 +229,14 @@ class BatchManager(object):
     def random_list(self, num):
         x_list = []
         xs, ys = [], []
-        file_list = self.sample(num)
-        for file_path in file_list:
+        idx = self.rng.choice(len(self.paths), num).tolist()
+        file_list = [self.paths[i] for i in idx]
+        for i in idx:
+            svg, drawing = self.train[i]
             if self.is_pathnet:
-                x, y = preprocess_path(file_path, self.width, self.height, self.rng)
+                x, y = preprocess_path(svg, self.width, self.height, self.rng, self.rasterizer, drawing)
             else:
-                x, y = preprocess_overlap(file_path, self.width, self.height, self.rng)
+                x, y = preprocess_overlap(svg, self.width, self.height, self.rng, self.rasterizer, drawing)
             x_list.append(x)
 
             if self.is_pathnet:
@@ -179,8 +249,12 @@ class BatchManager(object):
         return np.array(x_list), np.array(xs), np.array(ys), file_list
 
     def read_svg(self, file_path):
-        with open(file_path, 'r') as f:
-            svg = f.read()
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as f:
+                svg = f.read()
+        else:
+            # generated test set, only in the shard packs
+            svg = self.test.read(self.test.index(os.path.basename(file_path)))
 
         svg = svg.format(w=self.width, h=self.height)
         img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
@@ -189,21 +263,9 @@ class BatchManager(object):
         max_intensity = np.amax(s)
         s = s / max_intensity
 
-        path_list = []        
-        svg_xml = et.fromstring(svg)
-        num_paths = len(svg_xml[0])
-
-        for i in range(num_paths):
-            svg_xml = et.fromstring(svg)
-            svg_xml[0][0] = svg_xml[0][i]
-            del svg_xml[0][1:]
-            svg_one = et.tostring(svg_xml, method='xml')
-
-            # leave only one path
-            y_png = cairosvg.svg2png(bytestring=svg_one)
-            y_img = Image.open(io.BytesIO(y_png))
-            path = (np.array(y_img)[:,:,3] > 0)            
-            path_list.append(path)
+        # ground truth strokes, rendered on demand
+        path_list = StrokeMasks(svg)
+        num_paths = len(path_list)
 
         return s, num_paths, path_list
 
@@ -255,111 +317,141 @@ def draw_path(stroke_type, id, w, h, min_length, max_stroke_width, rng):
 
     return path_selector[stroke_type](id, w, h,min_length, max_stroke_width, rng)
 
-def gen_data(data_dir, config, rng, num_train, num_test):
-    file_list = []
-    num = num_train + num_test
-    for file_id in range(num):
+def gen_shard(args):
+    data_dir, config, shard_id, split, file_ids = args
+    shard_path = os.path.join(data_dir, split, 'shard_%05d.pack' % shard_id)
+    rng = np.random.RandomState(np.random.MT19937(
+        np.random.SeedSequence(config.random_seed, spawn_key=(shard_id,))))
+
+    names, svgs, drawings = [], [], []
+    for file_id in file_ids:
         while True:
-            svg = SVG_START_TEMPLATE.format(
-                        w=config.width,
-                        h=config.height,
-                    )
             svgpre = SVG_START_TEMPLATE
-
             for i in range(config.num_strokes):
                 path = draw_path(
                         stroke_type=config.stroke_type,
                         id=i, 
-                        w=config.width,
-                        h=config.height,
+                        w=VIEW_SIZE,
+                        h=VIEW_SIZE,
                         min_length=config.min_length,
                         max_stroke_width=config.max_stroke_width,
                         rng=rng,
                     )
-                svg += path + '\n'
                 svgpre += path + '\n'
-
-            svg += SVG_END_TEMPLATE
             svgpre += SVG_END_TEMPLATE
+
+            svg = svgpre.format(w=VIEW_SIZE, h=VIEW_SIZE)
+            drawing = parse_drawing(svg)
+            s = composite(rasterize_strokes(drawing, VIEW_SIZE, VIEW_SIZE))
+            if np.amax(s) > 0:
+                break
+
+        names.append('%d.svg_pre' % file_id)
+        svgs.append(svgpre.encode('utf-8'))
+        drawings.append(drawing)
+
+        if config.gen_reference:
+            # svg and jpg for reference
+            svg_file_path = os.path.join(data_dir, 'svg', '%d.svg' % file_id)
+            jpg_file_path = os.path.join(data_dir, 'jpg', '%d.jpg' % file_id)
+            with open(svg_file_path, 'w') as f:
+                f.write(svg)
             s_png = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
             s_img = Image.open(io.BytesIO(s_png))
-            s = np.array(s_img)[:,:,3].astype(np.float) # / 255.0
-            max_intensity = np.amax(s)
-            
-            if max_intensity == 0:
-                continue
-            else:
-                s = s / max_intensity # [0,1]
-            break
-
-        if file_id < num_train:
-            cat = 'train'
-        else:
-            cat = 'test'
-        
-        # svgpre
-        svgpre_file_path = os.path.join(data_dir, cat, '%d.svg_pre' % file_id)
-        print(svgpre_file_path)
-        with open(svgpre_file_path, 'w') as f:
-            f.write(svgpre)
-        
-        # svg and jpg for reference
-        svg_dir = os.path.join(data_dir, 'svg')
-        if not os.path.exists(svg_dir):
-            os.makedirs(svg_dir)
-        jpg_dir = os.path.join(data_dir, 'jpg')
-        if not os.path.exists(jpg_dir):
-            os.makedirs(jpg_dir)
-        
-        svg_file_path = os.path.join(data_dir, 'svg', '%d.svg' % file_id)
-        jpg_file_path = os.path.join(data_dir, 'jpg', '%d.jpg' % file_id)
-        
-        with open(svg_file_path, 'w') as f:
-            f.write(svg)
-        s_img.convert('RGB').save(jpg_file_path)
-
-        if file_id < num_train:
-            file_list.append(svgpre_file_path)
-
-    return file_list
-
-def preprocess_path(file_path, w, h, rng):
-    with open(file_path, 'r') as f:
-        svg = f.read()
-
+            s_img.convert('RGB').save(jpg_file_path)
+
+    write_pack(shard_path, names, svgs, drawings)
+    return shard_path
+
+def gen_data(data_dir, config, num_train, num_test):
+    # drawings in shards of gen_shard_size, each generated by a pool worker
+    # from its own seed and written as one pack. shards already on disk are
+    # kept if generated with the same config, so an interrupted run resumes
+    # where it stopped.
+    dirs = ['train', 'test']
+    if config.gen_reference:
+        dirs += ['svg', 'jpg']
+    for d in dirs:
+        if not os.path.exists(os.path.join(data_dir, d)):
+            os.makedirs(os.path.join(data_dir, d))
+
+    gen_config = {k: getattr(config, k) for k in GEN_CONFIG_KEYS}
+    gen_config.update(num_train=num_train, num_test=num_test)
+    gen_config_path = os.path.join(data_dir, GEN_CONFIG_FILE)
+    old_config = None
+    if os.path.exists(gen_config_path):
+        with open(gen_config_path, 'r') as f:
+            old_config = json.load(f)
+    if old_config != gen_config:
+        old_shards = glob(os.path.join(data_dir, 'train', 'shard_*.pack')) + \
+                     glob(os.path.join(data_dir, 'test', 'shard_*.pack'))
+        if old_shards:
+            print('%s: generation config changed (was %s), remove %d shards' % (
+                datetime.now(), old_config, len(old_shards)))
+            for shard_path in old_shards:
+                os.remove(shard_path)
+        with open(gen_config_path + '.tmp', 'w') as f:
+            json.dump(gen_config, f, indent=4, sort_keys=True)
+        os.rename(gen_config_path + '.tmp', gen_config_path)
+
+    shards = []
+    for split, start, end in [('train', 0, num_train), ('test', num_train, num_train + num_test)]:
+        for s in range(start, end, config.gen_shard_size):
+            shard_id = len(shards)
+            shards.append((data_dir, config, shard_id, split,
+                           list(range(s, min(s + config.gen_shard_size, end)))))
+
+    todo = [s for s in shards if not os.path.exists(
+            os.path.join(data_dir, s[3], 'shard_%05d.pack' % s[2]))]
+    print('%s: generate %d of %d shards with %d processes' % (
+        datetime.now(), len(todo), len(shards), config.num_worker))
+    if todo:
+        pool = multiprocessing.Pool(config.num_worker)
+        for i, shard_path in enumerate(pool.imap_unordered(gen_shard, todo)):
+            print('%s: [%d/%d] %s' % (datetime.now(), i+1, len(todo), shard_path))
+        pool.close()
+        pool.join()
+
+    shard_paths = [os.path.join(data_dir, s[3], 'shard_%05d.pack' % s[2]) for s in shards]
+    train_shards = [p for p, s in zip(shard_paths, shards) if s[3] == 'train']
+    test_shards = [p for p, s in zip(shard_paths, shards) if s[3] == 'test']
+    return train_shards, test_shards
+
+def preprocess_path(svg, w, h, rng, rasterizer='cairo', drawing=None, num_samples=None):
     svg = svg.format(w=w, h=h)
-    img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
-    img = Image.open(io.BytesIO(img))
-    s = np.array(img)[:,:,3].astype(np.float) # / 255.0
+    if rasterizer == 'numpy':
+        # all strokes at once from the parsed geometry
+        if drawing is None:
+            drawing = parse_drawing(svg)
+        alpha = rasterize_strokes(drawing, w, h)
+        s = composite(alpha)
+        num_paths = len(alpha)
+    else:
+        img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
+        img = Image.open(io.BytesIO(img))
+        s = np.array(img)[:,:,3].astype(np.float) # / 255.0
+        num_paths = len(et.fromstring(svg)[0])
     max_intensity = np.amax(s)
-    s = s / max_intensity
-
-    # while True:
-    svg_xml = et.fromstring(svg)
-    path_id = rng.randint(len(svg_xml[0]))
-    svg_xml[0][0] = svg_xml[0][path_id]
-    del svg_xml[0][1:]
-    svg_one = et.tostring(svg_xml, method='xml')        
-
-    # leave only one path
-    y_png = cairosvg.svg2png(bytestring=svg_one)
-    y_img = Image.open(io.BytesIO(y_png))
-    y = np.array(y_img)[:,:,3].astype(np.float) / max_intensity # [0,1]
-
-    pixel_ids = np.nonzero(y)
-    # if len(pixel_ids[0]) == 0:
-    #     continue
-    # else:
-    #     break            
-
-    # select arbitrary marking pixel
-    point_id = rng.randint(len(pixel_ids[0]))
-    px, py = pixel_ids[0][point_id], pixel_ids[1][point_id]
-
-    y = np.reshape(y, [h, w, 1])
-    x = np.zeros([h, w, 2])
-    x[:,:,0] = s
-    x[px,py,1] = 1.0
+    if max_intensity == 0: # augmented out of the frame, nothing to mark
+        num_paths = 0
+    else:
+        s = s / max_intensity
+
+    def render_stroke(path_id):
+        if rasterizer == 'numpy':
+            return alpha[path_id] / max_intensity # [0,1]
+
+        # leave only one path
+        svg_xml = et.fromstring(svg)
+        svg_xml[0][0] = svg_xml[0][path_id]
+        del svg_xml[0][1:]
+        svg_one = et.tostring(svg_xml, method='xml')        
+
+        y_png = cairosvg.svg2png(bytestring=svg_one)
+        y_img = Image.open(io.BytesIO(y_png))
+        return np.array(y_img)[:,:,3].astype(np.float) / max_intensity # [0,1]
+
+    x, y = sample_markers(s, render_stroke, num_paths, rng, num_samples)
 
     # # debug
     # plt.figure()
@@ -375,38 +467,30 @@ def preprocess_path(file_path, w, h, rng):
 
     return x, y
 
-def preprocess_overlap(file_path, w, h, rng):
-    with open(file_path, 'r') as f:
-        svg = f.read()
+def preprocess_overlap(svg, w, h, rng, rasterizer='cairo', drawing=None):
     svg = svg.format(w=w, h=h)
-    img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
-    img = Image.open(io.BytesIO(img))
-    s = np.array(img)[:,:,3].astype(np.float) # / 255.0
-    max_intensity = np.amax(s)
-    s = s / max_intensity
-
-    # while True:
-    path_list = []        
-    svg_xml = et.fromstring(svg)
-    num_paths = len(svg_xml[0])
-
-    for i in range(num_paths):
-        svg_xml = et.fromstring(svg)
-        svg_xml[0][0] = svg_xml[0][i]
-        del svg_xml[0][1:]
-        svg_one = et.tostring(svg_xml, method='xml')
+    if rasterizer == 'numpy':
+        if drawing is None:
+            drawing = parse_drawing(svg)
+        alpha = rasterize_strokes(drawing, w, h)
+        s = composite(alpha)
+        max_intensity = np.amax(s)
+        if max_intensity == 0: # augmented out of the frame
+            return np.zeros([h, w, 1]), np.zeros([h, w, 1])
+        s = s / max_intensity
 
-        # leave only one path
-        y_png = cairosvg.svg2png(bytestring=svg_one)
-        y_img = Image.open(io.BytesIO(y_png))
-        path = (np.array(y_img)[:,:,3] > 0)            
-        path_list.append(path)
+        # overlap: pixels covered by two or more strokes
+        y = (np.sum(alpha > 0, axis=0) >= 2)
+    else:
+        img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
+        img = Image.open(io.BytesIO(img))
+        s = np.array(img)[:,:,3].astype(np.float) # / 255.0
+        max_intensity = np.amax(s)
+        s = s / max_intensity
 
-    y = np.zeros([h, w], dtype=np.int)
-    for i in range(num_paths-1):
-        for j in range(i+1, num_paths):
-            intersect = np.logical_and(path_list[i], path_list[j])
-            y = np.logical_or(intersect, y)
+        # overlap: pixels covered by two or more strokes
+        count, _ = stroke_buffers(StrokeSVG(svg))
+        y = (count >= 2)
 
     x = np.expand_dims(s, axis=-1)
     y = np.expand_dims(y, axis=-1)
@@ -426,8 +510,9 @@ def preprocess_overlap(file_path, w, h, rng):
 def main(config):
     prepare_dirs_and_logger(config)
     batch_manager = BatchManager(config)
-    preprocess_path('data/line/train/0.svg_pre', 64, 64, batch_manager.rng)
-    preprocess_overlap('data/line/train/0.svg_pre', 64, 64, batch_manager.rng)
+    svg = batch_manager.train.read(0)
+    preprocess_path(svg, 64, 64, batch_manager.rng)
+    preprocess_overlap(svg, 64, 64, batch_manager.rng)
 
     # thread test
     sess_config = tf.ConfigProto()
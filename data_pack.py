@@ -0,0 +1,232 @@
+import os
+from glob import glob
+from datetime import datetime
+
+import numpy as np
+
+from rasterizer import Drawing, parse_drawing, drawing_svg
+
+
+# a pack holds the svg text of every file of a split and, for stroke
+# datasets, the parsed geometry, all in flat arrays of one .pack (npz) file:
+#   names [N], svg (utf-8 bytes) / svg_offset [N+1],
+#   stroke_offset [N+1] -> point_offset [S+1] -> points [P,2], widths [S],
+#   viewbox [N,4], geometry [N] (False if the file was not parsed)
+# records converted from stroke data (qdraw ndjson) have geometry and no svg
+PACK_KEYS = ['names', 'svg', 'svg_offset', 'stroke_offset', 'point_offset',
+             'points', 'widths', 'viewbox', 'geometry']
+
+# preprocess_svg.py output: shard packs plus an index of
+# 'name content_hash shard' lines (shard -1: input failed validation)
+INDEX_FILE = 'index.txt'
+
+
+def build_pack(paths, pack_path, geometry=True):
+    print('%s: build %s from %d files' % (datetime.now(), pack_path, len(paths)))
+    names, svgs, parsed = [], [], []
+    for file_path in paths:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            svg = f.read()
+        names.append(os.path.basename(file_path))
+        svgs.append(svg.encode('utf-8'))
+        parsed.append(parse_drawing(svg) if geometry else None)
+    write_pack(pack_path, names, svgs, parsed)
+
+def write_pack(pack_path, names, svgs, drawings):
+    # drawings: Drawing or None per file
+    strokes = [d.strokes if d is not None else [] for d in drawings]
+    num_strokes = [len(s) for s in strokes]
+    num_points = [len(p) for s in strokes for p in s]
+    points = [p for s in strokes for p in s]
+
+    arrays = {
+        'names': np.array(names),
+        'svg': np.frombuffer(b''.join(svgs), dtype=np.uint8),
+        'svg_offset': np.cumsum([0] + [len(s) for s in svgs]).astype(np.int64),
+        'stroke_offset': np.cumsum([0] + num_strokes).astype(np.int64),
+        'point_offset': np.cumsum([0] + num_points).astype(np.int64),
+        'points': np.concatenate(points).astype(np.float32) if points else np.zeros([0,2], dtype=np.float32),
+        'widths': np.concatenate([d.widths for d in drawings if d is not None] + [np.zeros([0])]).astype(np.float32),
+        'viewbox': np.array([d.viewbox if d is not None else [0,0,0,0] for d in drawings], dtype=np.float32).reshape([-1,4]),
+        'geometry': np.array([d is not None for d in drawings], dtype=bool),
+    }
+
+    # write aside and rename, readers never see a partial pack
+    tmp_path = pack_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_path, pack_path)
+
+def read_pack(pack_path):
+    with np.load(pack_path) as pack:
+        return {k: pack[k] for k in PACK_KEYS}
+
+def concat_packs(packs):
+    # offsets of each pack are shifted past the ones before it
+    if len(packs) == 1:
+        return packs[0]
+    arrays = {}
+    for k in ['names', 'svg', 'points', 'widths', 'viewbox', 'geometry']:
+        arrays[k] = np.concatenate([p[k] for p in packs])
+    for k, base in [('svg_offset', 'svg'), ('stroke_offset', 'widths'), ('point_offset', 'points')]:
+        offsets, shift = [np.zeros([1], dtype=np.int64)], 0
+        for p in packs:
+            offsets.append(p[k][1:] + shift)
+            shift += len(p[base])
+        arrays[k] = np.concatenate(offsets)
+    return arrays
+
+def select_records(arrays, ids):
+    # arrays of the drawings ids, in that order
+    svgs, widths, points, num_strokes, num_points = [], [], [], [], []
+    for i in ids:
+        svgs.append(arrays['svg'][arrays['svg_offset'][i]:arrays['svg_offset'][i+1]])
+        s0, s1 = arrays['stroke_offset'][i], arrays['stroke_offset'][i+1]
+        p = arrays['point_offset'][s0:s1+1]
+        widths.append(arrays['widths'][s0:s1])
+        points.append(arrays['points'][p[0]:p[-1]])
+        num_strokes.append(s1 - s0)
+        num_points.extend(np.diff(p))
+    return {
+        'names': arrays['names'][ids],
+        'svg': np.concatenate(svgs + [np.zeros([0], dtype=np.uint8)]),
+        'svg_offset': np.cumsum([0] + [len(s) for s in svgs]).astype(np.int64),
+        'stroke_offset': np.cumsum([0] + num_strokes).astype(np.int64),
+        'point_offset': np.cumsum([0] + num_points).astype(np.int64),
+        'points': np.concatenate(points + [np.zeros([0,2], dtype=np.float32)]),
+        'widths': np.concatenate(widths + [np.zeros([0], dtype=np.float32)]),
+        'viewbox': arrays['viewbox'][ids],
+        'geometry': arrays['geometry'][ids],
+    }
+
+
+class DrawingPack(object):
+    # svg text and parsed geometry of a split, loaded from one or more packs
+    # (or given as arrays)
+    def __init__(self, pack_paths=None, arrays=None):
+        if isinstance(pack_paths, str):
+            pack_paths = [pack_paths]
+        self.pack_paths = pack_paths
+        if arrays is None:
+            arrays = concat_packs([read_pack(p) for p in pack_paths])
+        for k in PACK_KEYS:
+            setattr(self, k, arrays[k])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.read(i), self.drawing(i)
+
+    def read(self, i):
+        svg = self.svg[self.svg_offset[i]:self.svg_offset[i+1]].tobytes().decode('utf-8')
+        if not svg and self.geometry[i]:
+            # strokes-only record (qdraw ndjson), svg made on demand
+            svg = drawing_svg(self.drawing(i))
+        return svg
+
+    def index(self, name):
+        if not hasattr(self, 'name_ids'):
+            self.name_ids = {n: i for i, n in enumerate(self.names.tolist())}
+        return self.name_ids[name]
+
+    def drawing(self, i):
+        if not self.geometry[i]:
+            return None
+        s0, s1 = self.stroke_offset[i], self.stroke_offset[i+1]
+        p = self.point_offset[s0:s1+1]
+        strokes = [self.points[p[j]:p[j+1]] for j in range(s1 - s0)]
+        return Drawing(strokes, self.widths[s0:s1], self.viewbox[i].tolist())
+
+
+class SVGFiles(object):
+    # same interface as DrawingPack, reading the files on every access
+    def __init__(self, paths):
+        self.paths = paths
+        self.names = [os.path.basename(p) for p in paths]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return self.read(i), None
+
+    def read(self, i):
+        with open(self.paths[i], 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def drawing(self, i):
+        return None
+
+
+def load_pack(paths, pack_path, geometry=True, use_pack=True):
+    # the pack next to the dataset is rebuilt when the file list changes
+    if not use_pack:
+        return SVGFiles(paths)
+
+    names = [os.path.basename(p) for p in paths]
+    if os.path.exists(pack_path):
+        pack = DrawingPack(pack_path)
+        if pack.names.tolist() == names:
+            return pack
+    build_pack(paths, pack_path, geometry)
+    return DrawingPack(pack_path)
+
+
+def shard_records(pack, rank, world_size):
+    # records rank::world_size of a split, the part one of world_size
+    # trainer processes reads
+    if isinstance(pack, SVGFiles):
+        return SVGFiles(pack.paths[rank::world_size])
+    ids = np.arange(len(pack))[rank::world_size]
+    return DrawingPack(arrays=select_records({k: getattr(pack, k) for k in PACK_KEYS}, ids))
+
+
+def shard_path(pack_dir, shard_id):
+    return os.path.join(pack_dir, 'shard_%05d.pack' % shard_id)
+
+def read_index(pack_dir):
+    index = {}
+    index_path = os.path.join(pack_dir, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            for line in f:
+                name, file_hash, shard_id = line.split()
+                index[name] = (file_hash, int(shard_id))
+    return index
+
+def write_index(pack_dir, index):
+    index_path = os.path.join(pack_dir, INDEX_FILE)
+    with open(index_path + '.tmp', 'w') as f:
+        for name in sorted(index):
+            f.write('%s %s %d\n' % (name, index[name][0], index[name][1]))
+    os.rename(index_path + '.tmp', index_path)
+
+def load_indexed(pack_dir, names):
+    # a name rewritten by an incremental run is also in older shards, the
+    # index points at the current one
+    index = read_index(pack_dir)
+    shards = sorted(set(index[n][1] for n in names))
+    packs = [read_pack(shard_path(pack_dir, s)) for s in shards]
+    base = dict(zip(shards, np.cumsum([0] + [len(p['names']) for p in packs])))
+    pos = {}
+    for s, p in zip(shards, packs):
+        for i, n in enumerate(p['names'].tolist()):
+            pos[s, n] = base[s] + i
+    ids = [pos[index[n][1], n] for n in names]
+    return DrawingPack(arrays=select_records(concat_packs(packs), ids))
+
+def load_split(root, split, ext, geometry=True, use_pack=True, rank=0, world_size=1):
+    # files root/split/*.ext (packed on first use) or, without them, the
+    # names listed in root/split.txt from the preprocess_svg.py shard packs;
+    # with world_size > 1 only the records rank::world_size
+    paths = sorted(glob("{}/{}/*.{}".format(root, split, ext)))
+    if len(paths) == 0 and os.path.exists(os.path.join(root, INDEX_FILE)):
+        with open(os.path.join(root, split + '.txt'), 'r') as f:
+            names = [line.strip() for line in f if line.strip()][rank::world_size]
+        paths = [os.path.join(root, split, n) for n in names]
+        return paths, load_indexed(root, names)
+    pack = load_pack(paths, os.path.join(root, split + '.pack'), geometry, use_pack)
+    if world_size > 1:
+        paths, pack = paths[rank::world_size], shard_records(pack, rank, world_size)
+    return paths, pack
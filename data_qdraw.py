@@ -15,15 +15,22 @@ import xml.etree.ElementTree as et
 import matplotlib.pyplot as plt
 
 from ops import *
+from rasterizer import StrokeMasks, StrokeSVG, stroke_buffers
+from rasterizer import parse_drawing, rasterize_strokes, composite, augment_drawings, sample_markers
+from data_pack import load_split
+from utils import worker_rngs, epoch_ids, compact_example
 
 class BatchManager(object):
     def __init__(self, config):
         self.root = config.data_path
         self.rng = np.random.RandomState(config.random_seed)
 
-        self.paths = sorted(glob("{}/train/*.{}".format(self.root, 'svg')))
-        self.test_paths = sorted(glob("{}/test/*.{}".format(self.root, 'svg')))
-        self.vec_paths = sorted(glob("{}/vec/*.{}".format(self.root, 'svg')))
+        # svg files (packed on first use) or the strokes-only shard packs of
+        # preprocess_svg.py --qdraw
+        self.paths, self.train = load_split(self.root, 'train', 'svg', True, config.data_pack,
+                                            config.rank, config.world_size)
+        self.test_paths, self.test = load_split(self.root, 'test', 'svg', True, config.data_pack)
+        self.vec_paths, self.vec = load_split(self.root, 'vec', 'svg', True, config.data_pack)
         assert(len(self.paths) > 0 and len(self.test_paths) > 0 and len(self.vec_paths) > 0)
 
         self.batch_size = config.batch_size
@@ -31,21 +38,47 @@ class BatchManager(object):
         self.width = config.width
 
         self.is_pathnet = (config.archi == 'path')
+        self.rasterizer = config.rasterizer
+        # examples are queued compactly and expanded to float in batch():
+        # uint8 image, then the marker (row, col) and uint8 stroke alpha
+        # for pathnet, the bits of the overlap mask for overlapnet
         if self.is_pathnet:
-            feature_dim = [self.height, self.width, 2]
-            label_dim = [self.height, self.width, 1]
+            dtypes = [tf.uint8, tf.int32, tf.uint8]
+            shapes = [[self.height, self.width, 1], [2], [self.height, self.width, 1]]
         else:
-            feature_dim = [self.height, self.width, 1]
-            label_dim = [self.height, self.width, 1]
+            dtypes = [tf.uint8, tf.uint8]
+            shapes = [[self.height, self.width, 1], [(self.height*self.width + 7) // 8]]
+
+        # pathnet examples per rendered drawing (overlapnet has no marker)
+        self.samples_per_render = config.samples_per_render if self.is_pathnet else 1
 
         self.capacity = 10000
-        self.q = tf.FIFOQueue(self.capacity, [tf.float32, tf.float32], [feature_dim, label_dim])
-        self.x = tf.placeholder(dtype=tf.float32, shape=feature_dim)
-        self.y = tf.placeholder(dtype=tf.float32, shape=label_dim)
-        self.enqueue = self.q.enqueue([self.x, self.y])
+        if self.samples_per_render > 1:
+            # examples of one drawing are spread over batches
+            self.q = tf.RandomShuffleQueue(self.capacity, self.capacity // 2,
+                                           dtypes, shapes,
+                                           seed=config.random_seed)
+        else:
+            self.q = tf.FIFOQueue(self.capacity, dtypes, shapes)
+        self.inputs = [tf.placeholder(dtype=d, shape=[None] + s) for d, s in zip(dtypes, shapes)]
+        self.enqueue = self.q.enqueue_many(self.inputs)
         self.num_threads = config.num_worker
         # np.amin([config.num_worker, multiprocessing.cpu_count(), self.batch_size])
 
+        # random similarity on the parsed strokes of a batch of drawings
+        self.augment = None
+        if config.augment:
+            assert self.rasterizer == 'numpy', 'augmentation transforms the parsed geometry, use --rasterizer=numpy'
+            self.augment = (config.aug_rotate, config.aug_scale, config.aug_translate)
+
+        # one rng stream per producer thread, for markers and augmentation
+        self.worker_rngs = worker_rngs(config.random_seed, self.num_threads)
+        # train ids of each producer thread, every drawing once per epoch
+        self.samplers = [epoch_ids(len(self.train), config.random_seed, i, self.num_threads)
+                         for i in range(self.num_threads)]
+        # examples enqueued by each producer thread (trainer throughput log)
+        self.produced = [0] * self.num_threads
+
     def __del__(self):
         try:
             self.stop_thread()
@@ -60,29 +93,45 @@ class BatchManager(object):
         self.coord = tf.train.Coordinator()
 
         # Create a method for loading and enqueuing
-        def load_n_enqueue(sess, enqueue, coord, paths, rng,
-                           x, y, w, h, is_pathnet):
+        def load_n_enqueue(sess, enqueue, coord, pack, sampler, rng, produced, worker,
+                           inputs, w, h, is_pathnet, rasterizer, augment, batch_size,
+                           num_samples):
             with coord.stop_on_exception():                
                 while not coord.should_stop():
-                    id = rng.randint(len(paths))
-                    if is_pathnet:
-                        x_, y_ = preprocess_path(paths[id], w, h, rng)
-                    else:
-                        x_, y_ = preprocess_overlap(paths[id], w, h, rng)
-                    sess.run(enqueue, feed_dict={x: x_, y: y_})
+                    ids = [next(sampler) for _ in range(batch_size)]
+                    samples = [pack[id] for id in ids]
+                    if augment is not None:
+                        drawings = [d if d is not None else parse_drawing(svg) for svg, d in samples]
+                        drawings = augment_drawings(drawings, rng, augment)
+                        samples = [(svg, d) for (svg, _), d in zip(samples, drawings)]
+
+                    for svg, drawing in samples:
+                        if is_pathnet:
+                            x_, y_ = preprocess_path(svg, w, h, rng, rasterizer, drawing, num_samples)
+                        else:
+                            x_, y_ = preprocess_overlap(svg, w, h, rng, rasterizer, drawing)
+                            x_, y_ = x_[np.newaxis], y_[np.newaxis]
+                        sess.run(enqueue, feed_dict=dict(zip(inputs, compact_example(x_, y_, is_pathnet))))
+                        produced[worker] += len(x_)
 
         # Create threads that enqueue
         self.threads = [threading.Thread(target=load_n_enqueue, 
                                           args=(self.sess, 
                                                 self.enqueue,
                                                 self.coord,
-                                                self.paths,
-                                                self.rng,
-                                                self.x,
-                                                self.y,
+                                                self.train,
+                                                self.samplers[i],
+                                                self.worker_rngs[i],
+                                                self.produced,
+                                                i,
+                                                self.inputs,
                                                 self.width,
                                                 self.height,
-                                                self.is_pathnet)
+                                                self.is_pathnet,
+                                                self.rasterizer,
+                                                self.augment,
+                                                self.batch_size,
+                                                self.samples_per_render)
                                           ) for i in range(self.num_threads)]
 
         # define signal handler
@@ -117,13 +166,17 @@ class BatchManager(object):
         self.sess.run(self.q.close(cancel_pending_enqueues=True))
         self.coord.join(self.threads)
 
-    def test_batch(self):
+    def test_batch(self, rng=None):
+        # rng: a seeded one gives the same test markers every time
+        if rng is None:
+            rng = self.rng
         x_list, y_list = [], []
-        for i, file_path in enumerate(self.test_paths):
+        for i in range(len(self.test)):
+            svg, drawing = self.test[i]
             if self.is_pathnet:
-                x_, y_ = preprocess_path(file_path, self.width, self.height, self.rng)
+                x_, y_ = preprocess_path(svg, self.width, self.height, rng, self.rasterizer, drawing)
             else:
-                x_, y_ = preprocess_overlap(file_path, self.width, self.height, self.rng)
+                x_, y_ = preprocess_overlap(svg, self.width, self.height, rng, self.rasterizer, drawing)
             x_list.append(x_)
             y_list.append(y_)
             if i % self.batch_size == self.batch_size-1:
@@ -131,7 +184,8 @@ class BatchManager(object):
                 x_list, y_list = [], []
 
     def batch(self):
-        return self.q.dequeue_many(self.batch_size)
+        return expand_example(self.q.dequeue_many(self.batch_size),
+                              self.height, self.width, self.is_pathnet)
 
     def sample(self, num):
         idx = self.rng.choice(len(self.paths), num).tolist()
@@ -140,12 +194,14 @@ class BatchManager(object):
     def random_list(self, num):
         x_list = []
         xs, ys = [], []
-        file_list = self.sample(num)
-        for file_path in file_list:
+        idx = self.rng.choice(len(self.paths), num).tolist()
+        file_list = [self.paths[i] for i in idx]
+        for i in idx:
+            svg, drawing = self.train[i]
             if self.is_pathnet:
-                x, y = preprocess_path(file_path, self.width, self.height, self.rng)
+                x, y = preprocess_path(svg, self.width, self.height, self.rng, self.rasterizer, drawing)
             else:
-                x, y = preprocess_overlap(file_path, self.width, self.height, self.rng)
+                x, y = preprocess_overlap(svg, self.width, self.height, self.rng, self.rasterizer, drawing)
             x_list.append(x)
 
             if self.is_pathnet:
@@ -158,8 +214,13 @@ class BatchManager(object):
         return np.array(x_list), np.array(xs), np.array(ys), file_list
 
     def read_svg(self, file_path):
-        with open(file_path, 'r') as f:
-            svg = f.read()
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as f:
+                svg = f.read()
+        else:
+            # converted from ndjson, only in the shard packs
+            pack = self.vec if file_path in self.vec_paths else self.test
+            svg = pack.read(pack.index(os.path.basename(file_path)))
 
         img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
         img = Image.open(io.BytesIO(img))
@@ -169,63 +230,46 @@ class BatchManager(object):
             return s, 0, []
         s = s / max_intensity
 
-        path_list = []        
-        num_paths = svg.count('polyline')
-
-        for i in range(1,num_paths+1):
-            svg_xml = et.fromstring(svg)
-            svg_xml[1] = svg_xml[i]
-            del svg_xml[2:]
-            svg_one = et.tostring(svg_xml, method='xml')
-
-            # leave only one path
-            y_png = cairosvg.svg2png(bytestring=svg_one)
-            y_img = Image.open(io.BytesIO(y_png))
-            path = (np.array(y_img)[:,:,3] > 0)            
-            path_list.append(path)
+        # ground truth strokes, rendered on demand
+        path_list = StrokeMasks(svg)
+        num_paths = len(path_list)
 
         return s, num_paths, path_list
 
-def preprocess_path(file_path, w, h, rng):
-    with open(file_path, 'r') as f:
-        svg = f.read()
-
-    img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
-    img = Image.open(io.BytesIO(img))
-    s = np.array(img)[:,:,3].astype(np.float) # / 255.0
+def preprocess_path(svg, w, h, rng, rasterizer='cairo', drawing=None, num_samples=None):
+    if rasterizer == 'numpy':
+        # all strokes at once from the parsed geometry
+        if drawing is None:
+            drawing = parse_drawing(svg)
+        alpha = rasterize_strokes(drawing, w, h)
+        s = composite(alpha)
+        num_paths = len(alpha)
+    else:
+        img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
+        img = Image.open(io.BytesIO(img))
+        s = np.array(img)[:,:,3].astype(np.float) # / 255.0
+        num_paths = svg.count('polyline')
     max_intensity = np.amax(s)
     if max_intensity == 0:
-        x = np.zeros([h, w, 2])
-        y = np.zeros([h, w, 1])
-        return x, y
-    s = s / max_intensity
+        num_paths = 0
+    else:
+        s = s / max_intensity
+
+    def render_stroke(path_id):
+        if rasterizer == 'numpy':
+            return alpha[path_id] / max_intensity # [0,1]
 
-    while True:
+        # leave only one path (after <defs>)
         svg_xml = et.fromstring(svg)
-        num_paths = svg.count('polyline')
-        path_id = rng.randint(1,num_paths+1)
-        svg_xml[1] = svg_xml[path_id]
+        svg_xml[1] = svg_xml[path_id+1]
         del svg_xml[2:]
         svg_one = et.tostring(svg_xml, method='xml')
 
-        # leave only one path
         y_png = cairosvg.svg2png(bytestring=svg_one)
         y_img = Image.open(io.BytesIO(y_png))
-        y = np.array(y_img)[:,:,3].astype(np.float) / max_intensity # [0,1]
-
-        pixel_ids = np.nonzero(y)
-        # assert len(pixel_ids[0]) > 0, '%s: no stroke px' % file_path
-        if len(pixel_ids[0]) > 0:
-            break
-
-    # select arbitrary marking pixel
-    point_id = rng.randint(len(pixel_ids[0]))
-    px, py = pixel_ids[0][point_id], pixel_ids[1][point_id]
+        return np.array(y_img)[:,:,3].astype(np.float) / max_intensity # [0,1]
 
-    y = np.reshape(y, [h, w, 1])
-    x = np.zeros([h, w, 2])
-    x[:,:,0] = s
-    x[px,py,1] = 1.0
+    x, y = sample_markers(s, render_stroke, num_paths, rng, num_samples)
 
     # # debug
     # plt.figure()
@@ -241,13 +285,16 @@ def preprocess_path(file_path, w, h, rng):
 
     return x, y
 
-def preprocess_overlap(file_path, w, h, rng):
-    with open(file_path, 'r') as f:
-        svg = f.read()
-
-    img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
-    img = Image.open(io.BytesIO(img))
-    s = np.array(img)[:,:,3].astype(np.float) # / 255.0
+def preprocess_overlap(svg, w, h, rng, rasterizer='cairo', drawing=None):
+    if rasterizer == 'numpy':
+        if drawing is None:
+            drawing = parse_drawing(svg)
+        alpha = rasterize_strokes(drawing, w, h)
+        s = composite(alpha)
+    else:
+        img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
+        img = Image.open(io.BytesIO(img))
+        s = np.array(img)[:,:,3].astype(np.float) # / 255.0
     max_intensity = np.amax(s)
     if max_intensity == 0:
         x = np.zeros([h, w, 1])
@@ -255,26 +302,12 @@ def preprocess_overlap(file_path, w, h, rng):
         return x, y
     s = s / max_intensity
 
-    path_list = []        
-    num_paths = svg.count('polyline')
-
-    for i in range(1,num_paths+1):
-        svg_xml = et.fromstring(svg)
-        svg_xml[1] = svg_xml[i]
-        del svg_xml[2:]
-        svg_one = et.tostring(svg_xml, method='xml')
-
-        # leave only one path
-        y_png = cairosvg.svg2png(bytestring=svg_one)
-        y_img = Image.open(io.BytesIO(y_png))
-        path = (np.array(y_img)[:,:,3] > 0)            
-        path_list.append(path)
-
-    y = np.zeros([h, w], dtype=np.int)
-    for i in range(num_paths-1):
-        for j in range(i+1, num_paths):
-            intersect = np.logical_and(path_list[i], path_list[j])
-            y = np.logical_or(intersect, y)
+    # overlap: pixels covered by two or more strokes
+    if rasterizer == 'numpy':
+        y = (np.sum(alpha > 0, axis=0) >= 2)
+    else:
+        count, _ = stroke_buffers(StrokeSVG(svg))
+        y = (count >= 2)
 
     x = np.expand_dims(s, axis=-1)
     y = np.expand_dims(y, axis=-1)
@@ -294,8 +327,9 @@ def preprocess_overlap(file_path, w, h, rng):
 def main(config):
     prepare_dirs_and_logger(config)
     batch_manager = BatchManager(config)
-    preprocess_path('data/qdraw/baseball/train/4503641325043712.svg', 128, 128, batch_manager.rng)
-    preprocess_overlap('data/qdraw/baseball/train/4503641325043712.svg', 128, 128, batch_manager.rng)
+    svg = batch_manager.train.read(0)
+    preprocess_path(svg, 128, 128, batch_manager.rng)
+    preprocess_overlap(svg, 128, 128, batch_manager.rng)
 
     # thread test
     sess_config = tf.ConfigProto()
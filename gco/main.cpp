@@ -93,6 +93,20 @@ int main(int argc, char **argv)
 		gc->setLabelCost(label_cost);
 		gc->setLabelOrder(true);
 
+		// warm start from a previous labeling (optional)
+		if (argc > 2) {
+			std::ifstream ls(argv[2]);
+			if (!ls.is_open()) {
+				std::cout << "Unable to open init label file" << std::endl;
+				return -1;
+			}
+			for (int i = 0; i < n_sites; ++i) {
+				int l;
+				if (!(ls >> l)) break;
+				gc->setLabel(i, l);
+			}
+		}
+
 		std::string label_file_path = argv[1];
 		label_file_path.replace(label_file_path.end() - 5, label_file_path.end(), ".label");
 		std::ofstream os(label_file_path.c_str());
@@ -2,7 +2,7 @@ import numpy as np
 import tensorflow as tf
 
 from config import get_config
-from utils import prepare_dirs_and_logger, save_config
+from utils import prepare_dirs_and_logger, save_config, replica_configs
 
 def main(config):
     prepare_dirs_and_logger(config)
@@ -20,8 +20,18 @@ def main(config):
              config.dataset == 'cat':
             from data_qdraw import BatchManager
 
-        batch_manager = BatchManager(config)
-        trainer = Trainer(config, batch_manager)
+        # with world_size > 1 this process is one rank, its input queues and
+        # ops on its worker and the variables on the ps
+        servers, device = None, None
+        if config.world_size > 1:
+            from trainer import start_cluster
+            servers, device = start_cluster(config)
+        with tf.device(device):
+            if config.num_replica > 1:
+                batch_manager = [BatchManager(c) for c in replica_configs(config)]
+            else:
+                batch_manager = BatchManager(config)
+            trainer = Trainer(config, batch_manager, servers)
         trainer.train()
     else:
         from tester import Tester
@@ -36,8 +46,17 @@ def main(config):
             from data_qdraw import BatchManager
         
         batch_manager = BatchManager(config)
+        if config.eval:
+            from trainer import evaluate_checkpoint
+            evaluate_checkpoint(config, batch_manager)
+            return
+
         tester = Tester(config, batch_manager)
-        tester.test()
+        if config.serve:
+            from server import serve
+            serve(config, tester)
+        else:
+            tester.test()
 
 if __name__ == "__main__":
     config, unparsed = get_config()
@@ -3,18 +3,32 @@ import tensorflow as tf
 from ops import *
 slim = tf.contrib.slim
 
+def float32_getter(getter, name, shape=None, dtype=None, *args, **kwargs):
+    # variables are always float32 (master weights), cast to the compute
+    # dtype where a layer asks for float16/bfloat16
+    var = getter(name, shape, tf.float32, *args, **kwargs)
+    if dtype is not None and dtype != tf.float32:
+        var = tf.cast(var, dtype)
+    return var
+
 def VDSR(x, hidden_num, repeat_num, data_format, use_norm, name='VDSR',
-         k=3, train=True, reuse=False):
-    with tf.variable_scope(name, reuse=reuse) as vs:
+         k=3, train=True, reuse=False, dtype=tf.float32):
+    # dtype: compute precision of the convs, batch norm and output stay float32
+    def norm(x, act=lrelu):
+        x = batch_norm(tf.cast(x, tf.float32), train, data_format, act=act)
+        return tf.cast(x, dtype)
+
+    with tf.variable_scope(name, reuse=reuse, custom_getter=float32_getter) as vs:
+        x = tf.cast(x, dtype)
         for i in range(repeat_num-1):
             x = conv2d(x, hidden_num, data_format, k=k, s=1, act=tf.nn.relu)
             if use_norm:
-                x = batch_norm(x, train, data_format, act=tf.nn.relu)
+                x = norm(x, tf.nn.relu)
 
         x = conv2d(x, 1, data_format, k=k, s=1)
         if use_norm:
-            x = batch_norm(x, train, data_format)
-        out = tf.nn.relu(x)
+            x = norm(x)
+        out = tf.nn.relu(tf.cast(x, tf.float32))
     variables = tf.contrib.framework.get_variables(vs)
     return out, variables
         
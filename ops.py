@@ -74,6 +74,22 @@ def upscale(x, scale, data_format):
 def var_on_cpu(name, shape, initializer, dtype=tf.float32):
     return slim.model_variable(name, shape, dtype=dtype, initializer=initializer, device='/CPU:0')
 
+def expand_example(queued, h, w, is_pathnet):
+    # float [n,h,w,c] x and y from the queue form of utils.compact_example
+    n = int_shape(queued[0])[0]
+    s = tf.cast(queued[0], tf.float32) / 255
+    if is_pathnet:
+        _, coords, y = queued
+        ids = coords[:,0]*w + coords[:,1]
+        ids = tf.where(coords[:,0] < 0, -tf.ones_like(ids), ids) # no marker
+        marker = tf.reshape(tf.one_hot(ids, h*w), [n, h, w, 1])
+        return tf.concat([s, marker], axis=-1), tf.cast(y, tf.float32) / 255
+
+    bits = tf.bitwise.bitwise_and(tf.expand_dims(queued[1], -1),
+                                  tf.constant([128, 64, 32, 16, 8, 4, 2, 1], dtype=tf.uint8))
+    bits = tf.reshape(tf.cast(bits > 0, tf.float32), [n, -1])
+    return s, tf.reshape(bits[:,:h*w], [n, h, w, 1])
+
 def int_shape(tensor):
     shape = tensor.get_shape().as_list()
     return [num if num is not None else -1 for num in shape]
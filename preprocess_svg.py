@@ -20,6 +20,8 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.cm as cmx
 import tarfile
+import hashlib
+import multiprocessing
 
 import numpy as np
 import scipy.stats
@@ -31,6 +33,9 @@ import simplejson as json
 import sys
 import jsonlines
 
+from data_pack import write_pack, read_index, write_index, shard_path
+from rasterizer import Drawing
+
 SVG_START_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
 <!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
 <svg width="{w}" height="{h}" viewBox="{bx} {by} {bw} {bh}" xmlns="http://www.w3.org/2000/svg" version="1.1">
@@ -39,18 +44,36 @@ SVG_LINE_START_TEMPLATE = """<polyline id="{id}" points=\""""
 SVG_LINE_END_TEMPLATE = """\" style="stroke:rgb({r}, {g}, {b})"/>\n"""
 SVG_END_TEMPLATE = """</g></svg>"""
 
+RUN_DATA_DIRS = {
+    0: 'data_tmp/sketches/car_',
+    1: 'data_tmp/chinese/makemeahanzi/svgs',
+    2: 'data_tmp/chinese/kanjivg-20160426-all/kanji',
+    3: 'data_tmp/fidelity/output/svg',
+    4: 'data_tmp/lineStrokes',
+    5: 'data_tmp/schneider/Supplementary/Dataset/Strokes',
+}
+
+# template params of the upright glyph, as in data_ch / data_kanji
+SVG_PRE_POSE = {
+    1: dict(r=0, sx=1, sy=-1, tx=0, ty=-900),
+    2: dict(r=0, sx=1, sy=1, tx=0, ty=0),
+}
+
+
+def split_dataset(dst_dir, file_list=None, seed=123):
+    if file_list is None:
+        file_list = []
+        for root, _, files in os.walk(dst_dir):
+            for file in files:
+                if not file.lower().endswith('svg_pre'):
+                    continue
 
-def split_dataset(dst_dir):
-    file_list = []
-    for root, _, files in os.walk(dst_dir):
-        for file in files:
-            if not file.lower().endswith('svg_pre'):
-                continue
-
-            file_list.append(file)
+                file_list.append(file)
 
+    # same split for the same files and seed, whatever the walk order
+    file_list = sorted(file_list)
     num_files = len(file_list)
-    ids = np.random.permutation(num_files)
+    ids = np.random.RandomState(seed).permutation(num_files)
     train_id = int(num_files * 0.9)
     with open(os.path.join(dst_dir,'train.txt'), 'w') as f: 
         for id in ids[:train_id]:
@@ -59,6 +82,34 @@ def split_dataset(dst_dir):
         for id in ids[train_id:]:
             f.write(file_list[id] + '\n')
 
+def update_split(dst_dir, file_list, seed=123):
+    # incremental split_dataset: names already in train.txt/test.txt stay
+    # in their split, names not in file_list (input removed or no longer
+    # valid) are dropped and new ones go to train or test by a seeded hash
+    # of the name, the same for a name whatever run adds it
+    if not os.path.exists(os.path.join(dst_dir, 'train.txt')):
+        split_dataset(dst_dir, file_list, seed)
+        return
+    names = set(file_list)
+    split = {}
+    for s in ['train', 'test']:
+        split[s] = []
+        s_path = os.path.join(dst_dir, s + '.txt')
+        if os.path.exists(s_path):
+            with open(s_path, 'r') as f:
+                split[s] = [n.strip() for n in f if n.strip()]
+    num_removed = sum(n not in names for s in split for n in split[s])
+    new = sorted(names - set(split['train']) - set(split['test']))
+    for n in new:
+        u = int(hashlib.md5(('%d %s' % (seed, n)).encode('utf-8')).hexdigest()[:8], 16) / 2.0**32
+        split['train' if u < 0.9 else 'test'].append(n)
+    for s in ['train', 'test']:
+        with open(os.path.join(dst_dir, s + '.txt'), 'w') as f:
+            for n in split[s]:
+                if n in names:
+                    f.write(n + '\n')
+    print('%s: split %d new, %d removed' % (datetime.now(), len(new), num_removed))
+
 def preprocess_qdraw():    
     img_size = 128
     category = 'baseball'
@@ -128,16 +179,7 @@ def preprocess_qdraw():
     for root, _, files in os.walk(output):
         for file in files:
             file_list.append(file)
-
-    num_files = len(file_list)
-    ids = np.random.permutation(num_files)
-    train_id = int(num_files * 0.9)
-    with open(os.path.join(output,'train.txt'), 'w') as f: 
-        for id in ids[:train_id]:
-            f.write(file_list[id] + '\n')
-    with open(os.path.join(output,'test.txt'), 'w') as f: 
-        for id in ids[train_id:]:
-            f.write(file_list[id] + '\n')
+    split_dataset(output, file_list, FLAGS.split_seed)
 
 
 def preprocess_kanji(file_path):
@@ -525,18 +567,7 @@ def preprocess_sketch_schneider(file_path, size=800, use_label=False):
 
 
 def preprocess(run_id):
-    if run_id == 0:
-        data_dir = 'data_tmp/sketches/car_'
-    elif run_id == 1:
-        data_dir = 'data_tmp/chinese/makemeahanzi/svgs'
-    elif run_id == 2:
-        data_dir = 'data_tmp/chinese/kanjivg-20160426-all/kanji'
-    elif run_id == 3:
-        data_dir = 'data_tmp/fidelity/output/svg'
-    elif run_id == 4:
-        data_dir = 'data_tmp/lineStrokes'
-    elif run_id == 5:
-        data_dir = 'data_tmp/schneider/Supplementary/Dataset/Strokes'
+    data_dir = RUN_DATA_DIRS[run_id]
 
     if run_id == 0:
         # valid_file_list_name = 'checked.txt'
@@ -634,7 +665,7 @@ def preprocess(run_id):
                 with open(write_path, 'w') as wf:
                     wf.write(svg_pre)
 
-        split_dataset(FLAGS.dst_dir)            
+        split_dataset(FLAGS.dst_dir, seed=FLAGS.split_seed)
 
     elif run_id == 4:
         for root, _, files in os.walk(data_dir):
@@ -727,10 +758,185 @@ def preprocess(run_id):
         tar.add(FLAGS.dst_dir, arcname=os.path.basename(FLAGS.dst_dir))
 
 
+def preprocess_file(args):
+    # svg -> svg_pre, validated by rendering the result once in its default
+    # pose; None if either fails or nothing is drawn
+    run_id, file_path, file_hash = args
+    name = os.path.basename(file_path)[:-3] + 'svg_pre'
+    try:
+        if run_id == 1:
+            svg_pre = preprocess_makemeahanzi(file_path)
+        else:
+            svg_pre = preprocess_kanji(file_path)
+        svg = svg_pre.format(w=64, h=64, **SVG_PRE_POSE[run_id])
+        img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
+        img = np.array(Image.open(io.BytesIO(img)))[:,:,3]
+        if np.amax(img) == 0:
+            print('%s: skip %s, nothing drawn' % (datetime.now(), file_path))
+            svg_pre = None
+    except (IOError, OSError, ValueError, KeyError, IndexError, SyntaxError) as e:
+        # unreadable file, stray braces in the template, xml parse error
+        # (ET.ParseError is a SyntaxError) or an svg cairo can't render
+        print('%s: skip %s, %s: %s' % (datetime.now(), file_path, type(e).__name__, e))
+        svg_pre = None
+    return name, file_hash, svg_pre
+
+
+def preprocess_packed(run_id, num_worker, shard_size):
+    # parallel version of preprocess() for the svg datasets (run 1, 2):
+    # results stream into shard packs in dst_dir, listed in its index.
+    # inputs whose content hash is already in the index are skipped.
+    assert run_id in SVG_PRE_POSE, 'run %d has no packed preprocessing' % run_id
+    data_dir = RUN_DATA_DIRS[run_id]
+    index = read_index(FLAGS.dst_dir)
+
+    todo, seen = [], set()
+    for root, _, files in os.walk(data_dir):
+        for file in sorted(files):
+            if not file.lower().endswith('svg'):
+                continue
+            file_path = os.path.join(root, file)
+            with open(file_path, 'rb') as f:
+                file_hash = hashlib.md5(f.read()).hexdigest()
+            name = file[:-3] + 'svg_pre'
+            seen.add(name)
+            if name in index and index[name][0] == file_hash:
+                continue
+            todo.append((run_id, file_path, file_hash))
+    print('%s: %d of %d files new or changed' % (datetime.now(), len(todo), len(seen)))
+
+    # inputs removed since the last run leave the index (their records stay
+    # in the old shards, unreferenced)
+    for name in [n for n in index if n not in seen]:
+        del index[name]
+
+    shard_id = max([s for _, s in index.values()] + [-1]) + 1
+    names, svgs, hashes = [], [], []
+    def flush():
+        if names:
+            write_pack(shard_path(FLAGS.dst_dir, shard_id), names, svgs, [None]*len(names))
+            for name, file_hash in zip(names, hashes):
+                index[name] = (file_hash, shard_id)
+            print('%s: shard %d, %d files' % (datetime.now(), shard_id, len(names)))
+        write_index(FLAGS.dst_dir, index)
+
+    pool = multiprocessing.Pool(num_worker)
+    for name, file_hash, svg_pre in pool.imap_unordered(preprocess_file, todo, chunksize=16):
+        if svg_pre is None:
+            index[name] = (file_hash, -1)
+            continue
+        names.append(name)
+        svgs.append(svg_pre.encode('utf-8'))
+        hashes.append(file_hash)
+        if len(names) == shard_size:
+            flush()
+            shard_id += 1
+            names, svgs, hashes = [], [], []
+    pool.close()
+    pool.join()
+    flush()
+
+    # train/test lists the training side reads the packs with
+    update_split(FLAGS.dst_dir, [n for n, (_, s) in index.items() if s >= 0], FLAGS.split_seed)
+
+
+def normalize_qdraw(drawings, img_size, bbox_pad):
+    # ndjson 'drawing' fields ([x list, y list, t list] per stroke) to
+    # strokes in [0,img_size], one padded square bbox per drawing, all
+    # drawings of the chunk in one pass
+    strokes = [np.array(s[:2], dtype=np.float32).T for d in drawings for s in d]
+    num_strokes = [len(d) for d in drawings]
+    stroke_points = [len(s) for s in strokes]
+    points = np.concatenate(strokes)
+
+    stroke_owner = np.repeat(np.arange(len(drawings)), num_strokes)
+    owner = np.repeat(stroke_owner, stroke_points)
+    drawing_points = np.bincount(stroke_owner, weights=stroke_points, minlength=len(drawings)).astype(np.int64)
+    starts = np.cumsum(drawing_points) - drawing_points
+    lo = np.minimum.reduceat(points, starts) - bbox_pad
+    hi = np.maximum.reduceat(points, starts) + bbox_pad
+    b_size = np.amax(hi - lo, axis=1, keepdims=True)
+    points = (points - lo[owner]) / b_size[owner] * img_size
+
+    strokes = np.split(points, np.cumsum(stroke_points)[:-1])
+    stroke_starts = np.cumsum([0] + num_strokes)
+    return [strokes[stroke_starts[i]:stroke_starts[i+1]] for i in range(len(drawings))]
+
+def preprocess_qdraw_packed(category, shard_size, img_size=128, need=200000, num_vec=100):
+    # data/category.ndjson straight into shard packs of stroke geometry (no
+    # svg files, data_qdraw renders what it needs from the strokes); keyed
+    # by key_id like the svgs of preprocess_qdraw, lines already in the
+    # index are skipped. the index hash covers the line and the parameters
+    # that change the drawing, a change converts every line again
+    stroke_width = 2
+    bbox_pad = 20
+    gen_key = ('%d %d %d\n' % (img_size, stroke_width, bbox_pad)).encode('utf-8')
+    index = read_index(FLAGS.dst_dir)
+    shard_id = max([s for _, s in index.values()] + [-1]) + 1
+
+    names, hashes, drawings = [], [], []
+    def flush():
+        strokes = normalize_qdraw(drawings, img_size, bbox_pad)
+        parsed = [Drawing(s, np.full([len(s)], stroke_width, dtype=np.float32), [0, 0, img_size, img_size])
+                  for s in strokes]
+        write_pack(shard_path(FLAGS.dst_dir, shard_id), names, [b'']*len(names), parsed)
+        for name, line_hash in zip(names, hashes):
+            index[name] = (line_hash, shard_id)
+        write_index(FLAGS.dst_dir, index)
+        print('%s: shard %d, %d drawings' % (datetime.now(), shard_id, len(names)))
+
+    seen = set()
+    with open('data/{cat}.ndjson'.format(cat=category), 'rb') as f:
+        for line in f:
+            if len(seen) >= need:
+                break
+            obj = json.loads(line)
+            name = obj['key_id'] + '.svg'
+            seen.add(name)
+            line_hash = hashlib.md5(gen_key + line).hexdigest()
+            if name in index and index[name][0] == line_hash:
+                continue
+            if sum(len(s[0]) for s in obj['drawing']) == 0:
+                index[name] = (line_hash, -1)
+                continue
+
+            names.append(name)
+            hashes.append(line_hash)
+            drawings.append(obj['drawing'])
+            if len(names) == shard_size:
+                flush()
+                shard_id += 1
+                names, hashes, drawings = [], [], []
+    # drawings no longer among the first need lines leave the index
+    for name in [n for n in index if n not in seen]:
+        del index[name]
+    if names:
+        flush()
+    else:
+        write_index(FLAGS.dst_dir, index)
+
+    # train/test lists as in preprocess_qdraw, plus a vec list (num_vec of
+    # test, the ones of earlier runs kept) for the tester
+    update_split(FLAGS.dst_dir, [n for n, (_, s) in index.items() if s >= 0], FLAGS.split_seed)
+    with open(os.path.join(FLAGS.dst_dir, 'test.txt'), 'r') as f:
+        test_list = [n.strip() for n in f if n.strip()]
+    vec_path = os.path.join(FLAGS.dst_dir, 'vec.txt')
+    test_set, vec_list = set(test_list), []
+    if os.path.exists(vec_path):
+        with open(vec_path, 'r') as f:
+            vec_list = [n.strip() for n in f if n.strip() in test_set]
+    vec_set = set(vec_list)
+    vec_list += [n for n in test_list if n not in vec_set][:num_vec - len(vec_list)]
+    with open(vec_path, 'w') as f:
+        for n in vec_list[:num_vec]:
+            f.write(n + '\n')
+
+
 def init_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('process_num',
                     default=0,
+                    type=int,
                     help='process number',
                     nargs='?') 
     parser.add_argument('dst_dir',
@@ -741,6 +947,21 @@ def init_arg_parser():
                     default='data_tmp/car.tar.gz', # 'data_tmp/gc_test',
                     help='destination tar file',
                     nargs='?') # optional arg.
+    parser.add_argument('--num_worker',
+                    default=0,
+                    type=int,
+                    help='parallel, incremental run into shard packs (run 1, 2)')
+    parser.add_argument('--shard_size',
+                    default=1000,
+                    type=int,
+                    help='drawings per shard pack')
+    parser.add_argument('--split_seed',
+                    default=123,
+                    type=int,
+                    help='seed of the train/test split')
+    parser.add_argument('--qdraw',
+                    default='',
+                    help='Quick Draw category, data/<category>.ndjson into shard packs in dst_dir')
     return parser.parse_args()
 
 
@@ -757,7 +978,12 @@ if __name__ == '__main__':
     if not os.path.exists(FLAGS.dst_dir):
         os.makedirs(FLAGS.dst_dir)
 
-    # run [0-3]
-    preprocess(FLAGS.process_num)
+    # run [0-5]
+    if FLAGS.qdraw:
+        preprocess_qdraw_packed(FLAGS.qdraw, FLAGS.shard_size)
+    elif FLAGS.num_worker > 0:
+        preprocess_packed(FLAGS.process_num, FLAGS.num_worker, FLAGS.shard_size)
+    else:
+        preprocess(FLAGS.process_num)
 
     print('Done')
@@ -0,0 +1,489 @@
+import re
+import io
+
+import numpy as np
+import cairosvg
+from PIL import Image
+
+
+# stroke elements of the datasets: <path .../>, <path ...></path>, <polyline .../>
+STROKE_PATTERN = re.compile(r'<(path|polyline)\b[^>]*?(?:/>|>\s*</\1>)', re.S)
+# group open / close tags, for the paint strokes inherit
+GROUP_PATTERN = re.compile(r'<g\b[^>]*?[^/]>|<g>|</g>')
+
+
+def render_alpha(svg):
+    png = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
+    img = Image.open(io.BytesIO(png))
+    return np.array(img)[:,:,3]
+
+def render_rgba(svg):
+    png = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
+    img = Image.open(io.BytesIO(png))
+    return np.array(img)
+
+
+def paint(tag, prop):
+    # fill/stroke of an element set in its style (wins) or attribute, or None
+    m = re.search(r'style="[^"]*?(?<![\w-])%s\s*:\s*([^;"]+)' % prop, tag)
+    if m is None:
+        m = re.search(r'\s%s="([^"]*)"' % prop, tag)
+    return m.group(1).strip() if m is not None else None
+
+
+class StrokeSVG(object):
+    # svg text split once into strokes and the text between them, so that
+    # any subset of strokes can be rendered without re-parsing. painted
+    # [(stroked, filled)] of each stroke, with the paint inherited from its
+    # groups (svg defaults: fill black, stroke none)
+    def __init__(self, svg):
+        self.texts = []
+        self.strokes = []
+        self.painted = []
+        groups = [{'fill': 'black', 'stroke': 'none'}]
+        pos = 0
+        for m in STROKE_PATTERN.finditer(svg):
+            self.texts.append(svg[pos:m.start()])
+            for g in GROUP_PATTERN.finditer(self.texts[-1]):
+                if g.group(0) == '</g>':
+                    groups.pop()
+                else:
+                    groups.append({k: paint(g.group(0), k) or v for k, v in groups[-1].items()})
+            self.strokes.append(m.group(0))
+            self.painted.append(tuple((paint(m.group(0), k) or groups[-1][k]) != 'none'
+                                      for k in ['stroke', 'fill']))
+            pos = m.end()
+        self.texts.append(svg[pos:])
+
+    def __len__(self):
+        return len(self.strokes)
+
+    def subset(self, ids, strokes=None):
+        if strokes is None:
+            strokes = self.strokes
+        ids = set(ids)
+        svg = self.texts[0]
+        for i, text in enumerate(self.texts[1:]):
+            if i in ids:
+                svg += strokes[i]
+            svg += text
+        return svg
+
+    def render(self, ids):
+        return render_alpha(self.subset(ids))
+
+
+def set_stroke_color(stroke, color, stroked=True, filled=False):
+    # css in style wins over presentation attributes and inherited style.
+    # only the painted parts are recolored, a filled glyph stroke (ch) gets
+    # no outline and a stroked line no fill
+    css = 'opacity:1'
+    if stroked:
+        css += ';stroke:%s;stroke-opacity:1' % color
+    if filled:
+        css += ';fill:%s;fill-opacity:1' % color
+    m = re.search(r'style="([^"]*)"', stroke)
+    if m is not None:
+        return stroke[:m.end(1)] + ';' + css + stroke[m.end(1):]
+    tag_end = re.match(r'<\w+', stroke).end()
+    return stroke[:tag_end] + ' style="%s"' % css + stroke[tag_end:]
+
+def id_palette(num):
+    # num well separated colors, id = (r*k + g)*k + b on a k^3 grid
+    k = max(2, int(np.ceil(num**(1/3.0))))
+    step = 255 // (k-1)
+    ids = np.arange(num)
+    rgb = np.stack([ids // (k*k), (ids // k) % k, ids % k], axis=-1) * step
+    return rgb, k, step
+
+
+class StrokeMasks(object):
+    # lazy ground truth: per-stroke masks (alpha > 0) rendered on first access.
+    # with one_pass, all strokes are rendered at once in id colors and
+    # decoded; a pixel covered by several strokes goes to the top one.
+    def __init__(self, svg, one_pass=False):
+        self.svg = StrokeSVG(svg)
+        self.one_pass = one_pass
+        self.masks = {}
+
+    def __len__(self):
+        return len(self.svg)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if i not in self.masks:
+            if self.one_pass:
+                self.render_all()
+            else:
+                self.masks[i] = self.svg.render([i]) > 0
+        return self.masks[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def render_all(self):
+        num = len(self)
+        rgb, k, step = id_palette(num)
+        strokes = [set_stroke_color(stroke, '#%02x%02x%02x' % tuple(c), *painted)
+                   for stroke, c, painted in zip(self.svg.strokes, rgb, self.svg.painted)]
+        img = render_rgba(self.svg.subset(range(num), strokes))
+
+        level = np.rint(img[:,:,:3] / float(step)).astype(np.int64)
+        level = np.minimum(level, k-1)
+        ids = (level[:,:,0]*k + level[:,:,1])*k + level[:,:,2]
+        ink = img[:,:,3] > 0
+        for i in range(num):
+            self.masks[i] = np.logical_and(ink, ids == i)
+
+
+def sample_markers(s, render_stroke, num_strokes, rng, num_samples=None):
+    # pathnet examples from one rendered drawing s: each picks a random
+    # stroke (rendered at most once by render_stroke, [0,1]) and a marker
+    # pixel on it. x [num,h,w,2], y [num,h,w,1], no leading axis if None.
+    num = 1 if num_samples is None else num_samples
+    h, w = s.shape
+    x = np.zeros([num, h, w, 2])
+    y = np.zeros([num, h, w, 1])
+    x[:,:,:,0] = s
+
+    strokes = {}
+    i = 0
+    while i < num and num_strokes > 0:
+        path_id = rng.randint(num_strokes)
+        if path_id not in strokes:
+            strokes[path_id] = render_stroke(path_id)
+        pixel_ids = np.nonzero(strokes[path_id])
+        if len(pixel_ids[0]) == 0:
+            # no stroke in the frame at all: leave the rest empty
+            if len(strokes) == num_strokes and not any(np.any(v) for v in strokes.values()):
+                break
+            continue
+
+        # select arbitrary marking pixel
+        point_id = rng.randint(len(pixel_ids[0]))
+        x[i,pixel_ids[0][point_id],pixel_ids[1][point_id],1] = 1.0
+        y[i,:,:,0] = strokes[path_id]
+        i += 1
+
+    if num_samples is None:
+        return x[0], y[0]
+    return x, y
+
+
+class Drawing(object):
+    # parsed stroke geometry: polylines in viewBox coordinates
+    def __init__(self, strokes, widths, viewbox):
+        self.strokes = strokes # list of [n,2] (x,y) arrays
+        self.widths = widths # stroke width per stroke
+        self.viewbox = viewbox # x, y, w, h
+
+    def __len__(self):
+        return len(self.strokes)
+
+
+NUMBER_PATTERN = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+PATH_COMMAND_PATTERN = re.compile(r'([MLCQZmlcqz])([^MLCQZmlcqz]*)')
+
+def attribute(element, name):
+    m = re.search(r'\s%s="([^"]*)"' % name, element)
+    if m is not None:
+        return m.group(1)
+    m = re.search(r'%s\s*:\s*([^;"]+)' % name, element)
+    if m is not None:
+        return m.group(1)
+    return None
+
+def flatten_bezier(ctrl, num):
+    # ctrl: [k,2] control points of a quadratic (k=3) or cubic (k=4) curve
+    t = np.linspace(0, 1, num)[:,np.newaxis]
+    if len(ctrl) == 3:
+        return (1-t)**2*ctrl[0] + 2*(1-t)*t*ctrl[1] + t**2*ctrl[2]
+    return (1-t)**3*ctrl[0] + 3*(1-t)**2*t*ctrl[1] + 3*(1-t)*t**2*ctrl[2] + t**3*ctrl[3]
+
+def parse_path_data(d):
+    # absolute M/L/C/Q/Z only, which is what the line dataset writes
+    points = []
+    start = None
+    for cmd, args in PATH_COMMAND_PATTERN.findall(d):
+        v = np.array([float(n) for n in NUMBER_PATTERN.findall(args)]).reshape([-1,2])
+        if cmd == 'M':
+            start = v[0]
+            points.extend(v)
+        elif cmd == 'L':
+            points.extend(v)
+        elif cmd in 'CQ':
+            k = 3 if cmd == 'C' else 2
+            for i in range(0, len(v), k):
+                ctrl = np.concatenate(([points[-1]], v[i:i+k]))
+                length = np.sum(np.linalg.norm(np.diff(ctrl, axis=0), axis=1))
+                num = int(np.clip(np.ceil(length / 2.0), 8, 64))
+                points.extend(flatten_bezier(ctrl, num)[1:])
+        elif cmd in 'Zz':
+            points.append(start)
+        else:
+            raise ValueError('unsupported path command %s' % cmd)
+    return np.array(points, dtype=np.float32)
+
+def parse_drawing(svg):
+    # geometry of an svg made of <path d> (absolute) and <polyline> strokes
+    svg_tag = re.search(r'<svg\b[^>]*>', svg).group(0)
+    viewbox = [float(v) for v in NUMBER_PATTERN.findall(attribute(svg_tag, 'viewBox'))]
+
+    strokes, widths = [], []
+    pos = 0
+    width = 1.0
+    for m in STROKE_PATTERN.finditer(svg):
+        # stroke-width inherited from the closest preceding declaration
+        inherited = re.findall(r'stroke-width[=:]\s*"?([-+.\d]+)', svg[pos:m.start()])
+        if inherited:
+            width = float(inherited[-1])
+        pos = m.end()
+
+        element = m.group(0)
+        sw = attribute(element, 'stroke-width')
+        if m.group(1) == 'polyline':
+            points = NUMBER_PATTERN.findall(attribute(element, 'points'))
+            points = np.array(points, dtype=np.float32).reshape([-1,2])
+        else:
+            points = parse_path_data(attribute(element, 'd'))
+        strokes.append(points)
+        widths.append(float(sw) if sw is not None else width)
+    return Drawing(strokes, np.array(widths, dtype=np.float32), viewbox)
+
+def drawing_svg(drawing):
+    # inverse of parse_drawing: black polylines after an empty <defs>, laid
+    # out like the svgwrite files of the qdraw dataset
+    bx, by, bw, bh = drawing.viewbox
+    svg = ['<svg width="%g" height="%g" viewBox="%g %g %g %g" xmlns="http://www.w3.org/2000/svg" version="1.1"><defs />' % (bw, bh, bx, by, bw, bh)]
+    for points, width in zip(drawing.strokes, drawing.widths):
+        svg.append('<polyline fill="none" points="%s" stroke="#000000" stroke-width="%g" />' %
+                   (' '.join('%g,%g' % (x, y) for x, y in points), width))
+    svg.append('</svg>')
+    return ''.join(svg)
+
+def stroke_coverage(points, half_width, cx, cy):
+    # anti-aliased coverage of one stroke on pixel centers (cx, cy):
+    # clip(half_width + 0.5 - distance), round joins and butt caps
+    a = points[:-1]
+    ab = points[1:] - a
+    length = np.linalg.norm(ab, axis=1)
+    keep = length > 1e-6
+    if not np.any(keep):
+        return np.zeros(cx.shape, dtype=np.float32)
+    a, ab, length = a[keep], ab[keep], length[keep]
+    num_seg = len(a)
+
+    px = cx[np.newaxis] - a[:,0,np.newaxis,np.newaxis]
+    py = cy[np.newaxis] - a[:,1,np.newaxis,np.newaxis]
+    ux = (ab[:,0] / length)[:,np.newaxis,np.newaxis]
+    uy = (ab[:,1] / length)[:,np.newaxis,np.newaxis]
+    along = px*ux + py*uy # distance along the segment from a
+    across = np.abs(px*uy - py*ux)
+    seg_len = length[:,np.newaxis,np.newaxis]
+    clamped = np.clip(along, 0, seg_len)
+    dist = np.sqrt((px - clamped*ux)**2 + (py - clamped*uy)**2)
+
+    # butt caps at both ends of the stroke
+    dist[0] = np.where(along[0] < 0, across[0], dist[0])
+    dist[-1] = np.where(along[-1] > seg_len[-1], across[-1], dist[-1])
+    cov = np.clip(half_width + 0.5 - dist, 0, 1)
+    cov[0] *= np.clip(0.5 + along[0], 0, 1)
+    cov[-1] *= np.clip(0.5 - (along[-1] - seg_len[-1]), 0, 1)
+    return np.amax(cov, axis=0)
+
+def rasterize_strokes(drawing, w, h):
+    # per-stroke alpha [n,h,w] in [0,1] (8-bit steps like cairo), viewBox
+    # mapped with the default xMidYMid meet
+    bx, by, bw, bh = drawing.viewbox
+    scale = min(w / float(bw), h / float(bh))
+    ox = (w - bw*scale) * 0.5 - bx*scale
+    oy = (h - bh*scale) * 0.5 - by*scale
+
+    alpha = np.zeros([len(drawing), h, w], dtype=np.float32)
+    for i, (points, sw) in enumerate(zip(drawing.strokes, drawing.widths)):
+        if len(points) < 2:
+            continue
+        p = points * scale + [ox, oy]
+        r = sw * scale * 0.5
+
+        # only pixels around the stroke
+        x0 = int(max(np.floor(p[:,0].min() - r - 1), 0))
+        x1 = int(min(np.ceil(p[:,0].max() + r + 1), w))
+        y0 = int(max(np.floor(p[:,1].min() - r - 1), 0))
+        y1 = int(min(np.ceil(p[:,1].max() + r + 1), h))
+        if x0 >= x1 or y0 >= y1:
+            continue
+        cy, cx = np.mgrid[y0:y1, x0:x1] + 0.5
+        alpha[i,y0:y1,x0:x1] = stroke_coverage(p, r, cx, cy)
+    return np.rint(alpha*255) / 255.0
+
+def composite(alpha):
+    # alpha of strokes drawn over each other
+    return 1 - np.prod(1 - alpha, axis=0)
+
+def rasterize_batch(drawings, w, h):
+    # [n,h,w] alpha of whole drawings
+    return np.array([composite(rasterize_strokes(d, w, h)) for d in drawings])
+
+
+def random_affine(rng, num, augment):
+    # augment: max rotation (deg), max relative scale change, max translation
+    # (fraction of the viewBox); returns angle [num], scale [num], shift [num,2]
+    rotate, scale, translate = augment
+    theta = np.deg2rad(rng.uniform(-rotate, rotate, num))
+    k = rng.uniform(1 - scale, 1 + scale, num)
+    d = rng.uniform(-translate, translate, [num,2])
+    return theta, k, d
+
+def augment_drawings(drawings, rng, augment):
+    # one random similarity per drawing about its viewBox center, applied to
+    # the points of all drawings at once
+    num = len(drawings)
+    theta, k, d = random_affine(rng, num, augment)
+    viewbox = np.array([dr.viewbox for dr in drawings], dtype=np.float32)
+    c = viewbox[:,:2] + viewbox[:,2:]*0.5
+    d = d * np.amax(viewbox[:,2:], axis=1, keepdims=True)
+    m = np.stack([np.stack([np.cos(theta), -np.sin(theta)], axis=-1),
+                  np.stack([np.sin(theta), np.cos(theta)], axis=-1)], axis=1) * k[:,np.newaxis,np.newaxis]
+
+    lengths = [len(p) for dr in drawings for p in dr.strokes]
+    if sum(lengths) == 0:
+        return drawings
+    points = np.concatenate([p for dr in drawings for p in dr.strokes])
+    owner = np.repeat(np.arange(num), [sum(len(p) for p in dr.strokes) for dr in drawings])
+    points = np.einsum('nij,nj->ni', m[owner], points - c[owner]) + c[owner] + d[owner]
+    points = np.split(points.astype(np.float32), np.cumsum(lengths)[:-1])
+
+    augmented, pos = [], 0
+    for dr, k_ in zip(drawings, k):
+        strokes = points[pos:pos+len(dr)]
+        pos += len(dr)
+        augmented.append(Drawing(strokes, dr.widths * k_, dr.viewbox))
+    return augmented
+
+def augment_template(rng, augment, transform, center, size):
+    # random r, s, t for svgs with a rotate({r},c,c) scale({sx},{sy})
+    # translate({tx},{ty}) template (ch, kanji): scaled about the center
+    r, s, t = transform
+    theta, k, d = random_affine(rng, 1, augment)
+    k = k[0]
+    d = d[0] * size
+    r = r + np.rad2deg(theta[0])
+    t = [t[i] + ((1 - k)*center + d[i]) / (k*s[i]) for i in range(2)]
+    s = [s[i]*k for i in range(2)]
+    return r, s, t
+
+
+def stroke_buffers(stroke_svg):
+    # per-pixel stroke count (saturated at 2) and stroke id (-1 unless covered
+    # by exactly one stroke) in 2*ceil(log2(n)) renders: for each bit of the
+    # stroke id, render the strokes with the bit set and the ones without.
+    # a pixel in both renders is covered by two strokes with different ids.
+    # coverage is alpha > 0 of the 8-bit union render, so at antialiased
+    # edges it can differ from the per-stroke masks (faint strokes that round
+    # to 0 alone may add up to ink together). up to n = 6 the bit renders
+    # are no fewer than n, then each stroke is rendered once instead.
+    num = len(stroke_svg)
+    if num <= 1:
+        ink = stroke_svg.render(range(num)) > 0
+        ids = np.where(ink, 0, -1).astype(np.int32)
+        return ink.astype(np.uint8), ids
+
+    num_bits = int(np.ceil(np.log2(num)))
+    if 2*num_bits >= num:
+        inks = [stroke_svg.render([i]) > 0 for i in range(num)]
+        count = np.minimum(np.sum(inks, axis=0), 2).astype(np.uint8)
+        ids = np.argmax(inks, axis=0).astype(np.int32)
+        ids[count != 1] = -1
+        return count, ids
+
+    stroke_ids = np.arange(num)
+    ids = None
+    for b in range(num_bits):
+        bit = (stroke_ids >> b) & 1
+        on = stroke_svg.render(stroke_ids[bit == 1]) > 0
+        off = stroke_svg.render(stroke_ids[bit == 0]) > 0
+        if ids is None:
+            ink = np.logical_or(on, off)
+            multi = np.logical_and(on, off)
+            ids = np.zeros(on.shape, dtype=np.int32)
+        else:
+            multi = np.logical_or(multi, np.logical_and(on, off))
+        ids += on.astype(np.int32) << b
+
+    count = ink.astype(np.uint8) + multi.astype(np.uint8)
+    ids[count != 1] = -1
+    return count, ids
+
+
+def parity_check(num=100, w=64, h=64, seed=123):
+    # compare against cairosvg on random line drawings
+    from data_line import SVG_START_TEMPLATE, SVG_END_TEMPLATE, draw_path
+    rng = np.random.RandomState(seed)
+    diff, iou = [], []
+    for _ in range(num):
+        svg = SVG_START_TEMPLATE.format(w=w, h=h)
+        for i in range(4):
+            svg += draw_path(2, i, w, h, 10, 2, rng) + '\n'
+        svg += SVG_END_TEMPLATE
+
+        a_cairo = render_alpha(svg) / 255.0
+        a_numpy = composite(rasterize_strokes(parse_drawing(svg), w, h))
+        diff.append(np.mean(np.abs(a_cairo - a_numpy)))
+        m_cairo, m_numpy = a_cairo > 0.5, a_numpy > 0.5
+        iou.append(np.sum(m_cairo & m_numpy) / float(max(np.sum(m_cairo | m_numpy), 1)))
+
+    print('mean abs diff: %.4f, mask iou: %.4f' % (np.mean(diff), np.mean(iou)))
+    assert np.mean(diff) < 0.02 and np.mean(iou) > 0.9, 'numpy rasterizer diverges from cairosvg'
+    print('parity check done')
+
+
+def one_pass_check(svgs=None, w=64, h=64):
+    # one pass ground truth against the per-stroke masks: a pixel goes to
+    # the top stroke covering it, edge pixels blend colors and may decode
+    # wrong. svgs: [(svg template, (r, s, t))], default a filled glyph (ch)
+    # and a stroked one (kanji) with the TEMPLATE_TRANSFORM of their dataset
+    if svgs is None:
+        svgs = [(ONE_PASS_CH, (0, [1, -1], [0, -900])), (ONE_PASS_KANJI, (0, [1, 1], [0, 0]))]
+    for svg, (r, s, t) in svgs:
+        svg = svg.format(w=w, h=h, r=r, sx=s[0], sy=s[1], tx=t[0], ty=t[1])
+        per_stroke = StrokeMasks(svg)
+        one_pass = StrokeMasks(svg, one_pass=True)
+        above = np.zeros([h, w], dtype=bool)
+        iou = []
+        for i in reversed(range(len(per_stroke))):
+            expected = np.logical_and(per_stroke[i], ~above)
+            above = np.logical_or(above, per_stroke[i])
+            union = np.sum(np.logical_or(expected, one_pass[i]))
+            iou.append(np.sum(np.logical_and(expected, one_pass[i])) / float(max(union, 1)))
+        print('one pass mask iou: %.4f (min %.4f)' % (np.mean(iou), np.min(iou)))
+        assert np.min(iou) > 0.8, 'one pass ground truth diverges from per-stroke masks'
+    print('one pass check done')
+
+# svg_pre of preprocess_makemeahanzi (filled outlines, 1024 units) and of
+# preprocess_kanji (stroked paths in a fill:none group, 109 units)
+ONE_PASS_CH = '''<svg version="1.1" width="{w}" height="{h}" viewBox="0 0 1024 1024" xmlns="http://www.w3.org/2000/svg">
+<g transform="rotate({r},512,512) scale({sx},{sy}) translate({tx},{ty})">
+<path d="M 150 700 L 870 700 L 870 600 L 150 600 Z"></path>
+<path d="M 450 850 L 570 850 L 570 -50 L 450 -50 Z"></path>
+<path d="M 200 300 L 820 300 L 820 200 L 200 200 Z"></path>
+</g>
+</svg>'''
+ONE_PASS_KANJI = '''<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}" viewBox="0 0 109 109">
+<g transform="rotate({r},54,54) scale({sx},{sy}) translate({tx},{ty})">
+<g id="kvg:StrokePaths_04e00" style="fill:none;stroke:#000000;stroke-width:3;stroke-linecap:round;stroke-linejoin:round;">
+<path id="kvg:04e00-s1" d="M11,54.25c3.19,0.62,6.25,0.75,9.73,0.5c20.64-1.5,50.39-5.12,68.58-5.24c3.6-0.02,5.77,0.24,7.57,0.49"/>
+<path id="kvg:04e00-s2" d="M54.5,15c1,1,1.5,2.5,1.5,4c0,20-0.5,50-0.5,72"/>
+<path id="kvg:04e00-s3" d="M30,30c8,10,40,40,50,60"/>
+</g>
+</g>
+</svg>'''
+
+
+if __name__ == '__main__':
+    parity_check()
+    one_pass_check()
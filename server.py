@@ -0,0 +1,186 @@
+from __future__ import print_function
+
+import os
+import io
+import json
+import time
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import numpy as np
+import cairosvg
+
+from tester import vectorize
+from utils import load_raster
+
+
+class Request(object):
+    def __init__(self, img, file_path, out_dir):
+        self.img = img
+        self.file_path = file_path
+        self.out_dir = out_dir
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class VectorizeServer(object):
+    # keeps pathnet/overlapnet sessions of a tester warm and batches the
+    # pathnet pass over requests that arrive within serve_wait sec.
+    def __init__(self, config, tester):
+        self.tester = tester
+        self.width = config.width
+        self.height = config.height
+        self.max_batch = config.serve_batch
+        self.wait = config.serve_wait
+        self.q = queue.Queue()
+        self.pool = ThreadPool(config.num_worker)
+        self.count = 0
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, data, content_type, out_dir):
+        # out_dir: directory of this request's outputs and graphcut files
+        with self.lock:
+            self.count += 1
+            req_id = self.count
+        file_path = os.path.join(out_dir, 'req_%d' % req_id)
+
+        if 'svg' in content_type:
+            # any svg as is (no dataset template), scaled to width x height
+            file_path += '.svg'
+            try:
+                data = cairosvg.svg2png(bytestring=data, output_width=self.width,
+                                        output_height=self.height)
+            except (SyntaxError, ValueError) as e: # xml ParseError, defusedxml errors
+                raise ValueError('invalid svg: %s' % e)
+        else:
+            file_path += '.png'
+        img = load_raster(io.BytesIO(data), self.width, self.height)
+
+        if np.amax(img) == 0:
+            raise ValueError('empty drawing')
+
+        req = Request(img, file_path, out_dir)
+        self.q.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def run(self):
+        while True:
+            reqs = [self.q.get()]
+            deadline = time.time() + self.wait
+            while len(reqs) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    reqs.append(self.q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                self.process(reqs)
+            except Exception as e:
+                for req in reqs:
+                    req.error = e
+                    req.done.set()
+
+    def process(self, reqs):
+        start_time = time.time()
+        paths_list, _ = self.tester.extract_paths([req.img for req in reqs])
+        print('%s: pathnet on %d requests (%.3f sec)' % (datetime.now(), len(reqs), time.time() - start_time))
+
+        # graph is built in this thread (shared rng), graphcut and potrace
+        # run in the pool
+        pms = [self.tester.predict_img(req.img, req.file_path, paths=paths, out_dir=req.out_dir)
+               for req, paths in zip(reqs, paths_list)]
+
+        def finish(args):
+            req, pm = args
+            try:
+                vectorize(pm)
+                req.result = result(pm)
+            except Exception as e:
+                req.error = e
+            req.done.set()
+
+        self.pool.map(finish, zip(reqs, pms))
+
+
+def result(pm):
+    with open(pm.svg_path, 'r') as f:
+        svg = f.read()
+
+    # per pixel label, -1 for background, dup for the 2nd label on overlaps
+    num_path_pixels = len(pm.path_pixels[0])
+    label_map = -np.ones([pm.height, pm.width], dtype=np.int32)
+    label_map[pm.path_pixels] = pm.labels[:num_path_pixels]
+    dup_map = -np.ones([pm.height, pm.width], dtype=np.int32)
+    for i, dup_i in pm.dup_dict.items():
+        dup_map[pm.path_pixels[0][i], pm.path_pixels[1][i]] = pm.labels[dup_i]
+
+    return {
+        'svg': svg,
+        'num_labels': int(np.unique(pm.labels).size),
+        'labels': label_map.tolist(),
+        'dup_labels': dup_map.tolist(),
+        'duration': pm.duration,
+    }
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(config, tester):
+    server = VectorizeServer(config, tester)
+
+    class Handler(BaseHTTPRequestHandler):
+        # POST an svg (image/svg+xml) or a raster image, get json back. the
+        # request's files live in a temp dir, removed once answered
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            data = self.rfile.read(length)
+            content_type = self.headers.get('Content-Type', '')
+            out_dir = tempfile.mkdtemp(prefix='req_')
+            try:
+                try:
+                    body = server.submit(data, content_type, out_dir)
+                    code = 200
+                except Exception as e:
+                    body = {'error': str(e)}
+                    code = 400 if isinstance(e, ValueError) else 500
+
+                body = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                shutil.rmtree(out_dir, ignore_errors=True)
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', config.serve_port), Handler)
+    print('%s: serving on 127.0.0.1:%d' % (datetime.now(), config.serve_port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
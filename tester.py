@@ -1,11 +1,15 @@
 from __future__ import print_function
 
 import os
+import json
+import itertools
 from tqdm import trange
 import multiprocessing
 import time
 from datetime import datetime
 import platform
+import hashlib
+import cProfile
 from subprocess import call
 from shutil import copyfile
 
@@ -17,13 +21,27 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.cm as cmx
 import scipy.misc
+import scipy.ndimage
 
 from models import *
-from utils import save_image
+from utils import save_image, load_rasters, RASTER_EXTS
+from utils import profile_targets, profile_dir, save_profile, save_timeline
+from rasterizer import StrokeMasks
 
 class Param(object):
     pass
 
+# per file wall time of the pipeline stages, written to model_dir/latency.jsonl
+STAGES = ['render', 'pathnet', 'overlapnet', 'graph', 'solver', 'merge',
+          'accuracy', 'potrace', 'io']
+LATENCY_FILE = 'latency.jsonl'
+
+def add_time(pm, stage, start_time):
+    # a stage entered more than once adds up, returns the new start time
+    now = time.time()
+    pm.latency[stage] = pm.latency.get(stage, 0) + now - start_time
+    return now
+
 def vectorize_mp(q):
     while True:
         pm = q.get()
@@ -35,6 +53,76 @@ def vectorize_mp(q):
         q.task_done()
 
 
+def find_dup(ov, path_pixels):
+    # duplicate path pixels on the overlap map, ids start after path pixels
+    num_path_pixels = len(path_pixels[0])
+    dup_dict = {}
+    dup_rev_dict = {}
+    dup_id = num_path_pixels # start id of duplicated pixels
+    for i in range(num_path_pixels):
+        if ov[path_pixels[0][i], path_pixels[1][i]]:
+            dup_dict[i] = dup_id
+            dup_rev_dict[dup_id] = i
+            dup_id += 1
+    return dup_dict, dup_rev_dict, dup_id
+
+def edge_arrays(edges):
+    # [(i, j, pred, spatial)] -> i, j, pred, spatial arrays
+    if not edges:
+        return (np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64),
+                np.zeros([0]), np.zeros([0]))
+    ei, ej, ep, es = zip(*edges)
+    return (np.array(ei, dtype=np.int64), np.array(ej, dtype=np.int64),
+            np.array(ep), np.array(es))
+
+def update_check(tester, file_path, size=5, seed=123):
+    # Tester.update against predict: an empty change gives the same maps and
+    # edges, erasing a size x size square around an ink pixel matches a
+    # full rerun on the edited drawing. far neighbors are sampled at random,
+    # both run without them. returns the seconds of update and the rerun.
+    def edge_dict(edges):
+        return {(i, j): (p, s) for i, j, p, s in zip(*edges)}
+
+    neighbor_sample, tester.neighbor_sample = tester.neighbor_sample, 0
+    pm = tester.predict(file_path, keep_state=True)
+    pm.labels = np.zeros(pm.num_sites, dtype=np.int32) # no graphcut needed
+    img, paths, edges = pm.img, pm.paths, edge_dict(pm.edges)
+
+    pm = tester.update(pm, img, np.zeros(img.shape, dtype=bool))
+    assert np.array_equal(pm.paths, paths), 'update without change altered the path maps'
+    assert edge_dict(pm.edges) == edges, 'update without change altered the edges'
+
+    rng = np.random.RandomState(seed)
+    ys, xs = np.nonzero(img)
+    k = rng.randint(len(ys))
+    changed = np.zeros(img.shape, dtype=bool)
+    changed[max(ys[k]-size//2, 0):ys[k]+size//2+1, max(xs[k]-size//2, 0):xs[k]+size//2+1] = True
+    changed = np.logical_and(changed, img > 0)
+    edited = np.where(changed, 0, img)
+    if not np.any(edited):
+        tester.neighbor_sample = neighbor_sample
+        return None
+
+    pm.labels = np.zeros(pm.num_sites, dtype=np.int32)
+    start_time = time.time()
+    pm = tester.update(pm, edited, changed)
+    duration_update = time.time() - start_time
+    start_time = time.time()
+    pm_full = tester.predict_img(edited, file_path, keep_state=True)
+    duration_full = time.time() - start_time
+    tester.neighbor_sample = neighbor_sample
+
+    diff = np.amax(np.abs(pm.paths - pm_full.paths))
+    edges, edges_full = edge_dict(pm.edges), edge_dict(pm_full.edges)
+    assert diff < 1e-4, 'updated path maps differ from a full rerun (max %f)' % diff
+    assert set(edges) == set(edges_full), 'updated edges differ from a full rerun'
+    assert all(np.allclose(edges[e], edges_full[e], atol=1e-4) for e in edges), \
+        'updated edge weights differ from a full rerun'
+    print('%s: %s, update matches a full rerun (%.3f vs %.3f sec)' % (
+        datetime.now(), os.path.basename(file_path), duration_update, duration_full))
+    return duration_update, duration_full
+
+
 class Tester(object):
     def __init__(self, config, batch_manager):
         tf.set_random_seed(config.random_seed)
@@ -52,6 +140,7 @@ class Tester(object):
 
         self.load_pathnet = config.load_pathnet
         self.load_overlapnet = config.load_overlapnet
+        self.random_weights = config.random_weights
         self.find_overlap = config.find_overlap
         self.overlap_threshold = config.overlap_threshold
         self.max_label = config.max_label
@@ -65,13 +154,39 @@ class Tester(object):
         if config.dataset == 'baseball' or config.dataset == 'cat' or\
            config.dataset == 'multi':
             self.test_paths = self.batch_manager.vec_paths
+        if config.test_dir:
+            # raster inputs without ground truth
+            self.test_paths = sorted([os.path.join(config.test_dir, f) for f in os.listdir(config.test_dir)
+                                      if os.path.splitext(f)[1].lower() in RASTER_EXTS])
         if self.num_test < len(self.test_paths):
             self.test_paths = self.rng.choice(self.test_paths, self.num_test, replace=False)
+        self.num_test = len(self.test_paths)
+
+        self.rasters = None
+        if config.test_dir:
+            cache_path = None
+            if config.raster_cache:
+                # a file edited or replaced in place changes the key too
+                key = '\n'.join('%s %d %d' % (p, os.path.getmtime(p), os.path.getsize(p))
+                                for p in self.test_paths) + '%f' % config.raster_threshold
+                cache_path = os.path.join(config.test_dir, 'raster_%s_%dx%d.npy' % (
+                    hashlib.md5(key.encode('utf-8')).hexdigest()[:8], self.width, self.height))
+            self.rasters = load_rasters(self.test_paths, self.width, self.height,
+                                        config.raster_threshold, cache_path)
+        self.compute_accuracy = config.compute_accuracy
+        self.gt_one_pass = config.gt_one_pass
         self.mp = config.mp
         self.num_worker = config.num_worker
 
         self.model_dir = config.model_dir
         self.data_path = config.data_path
+
+        # --profile files: cProfile of predict + vectorize and timelines of
+        # their sess.run calls, in model_dir/profile
+        self.profile = profile_targets(config)
+        if self.profile:
+            self.profile_dir = profile_dir(config)
+        self.run_metadata = None # (net, RunMetadata) of a profiled file
         
         self.build_model()
 
@@ -89,12 +204,17 @@ class Tester(object):
                 self.data_format, self.use_norm, train=False)
             show_all_variables()
 
-            saver = tf.train.Saver()
-            ckpt = tf.train.get_checkpoint_state(self.load_pathnet)
-            assert(ckpt and self.load_pathnet)
-            ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-            saver.restore(self.sp, os.path.join(self.load_pathnet, ckpt_name))
-            print('%s: Pre-trained model restored from %s' % (datetime.now(), self.load_pathnet))
+            if not self.load_pathnet and self.random_weights:
+                # no checkpoint, for timing only (bench.py)
+                self.sp.run(tf.global_variables_initializer())
+                print('%s: pathnet with random weights' % datetime.now())
+            else:
+                saver = tf.train.Saver()
+                ckpt = tf.train.get_checkpoint_state(self.load_pathnet)
+                assert(ckpt and self.load_pathnet)
+                ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
+                saver.restore(self.sp, os.path.join(self.load_pathnet, ckpt_name))
+                print('%s: Pre-trained model restored from %s' % (datetime.now(), self.load_pathnet))
 
         if self.find_overlap:
             overlapnet_graph = tf.Graph()
@@ -108,26 +228,51 @@ class Tester(object):
                     self.data_format, self.use_norm, train=False)
                 show_all_variables()
 
-                saver = tf.train.Saver()
-                ckpt = tf.train.get_checkpoint_state(self.load_overlapnet)
-                assert(ckpt and self.load_overlapnet)
-                ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-                saver.restore(self.so, os.path.join(self.load_overlapnet, ckpt_name))
-                print('%s: Pre-trained model restored from %s' % (datetime.now(), self.load_overlapnet))
+                if not self.load_overlapnet and self.random_weights:
+                    # no checkpoint, for timing only (bench.py)
+                    self.so.run(tf.global_variables_initializer())
+                    print('%s: overlapnet with random weights' % datetime.now())
+                else:
+                    saver = tf.train.Saver()
+                    ckpt = tf.train.get_checkpoint_state(self.load_overlapnet)
+                    assert(ckpt and self.load_overlapnet)
+                    ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
+                    saver.restore(self.so, os.path.join(self.load_overlapnet, ckpt_name))
+                    print('%s: Pre-trained model restored from %s' % (datetime.now(), self.load_overlapnet))
 
     def test(self):
         if self.mp:
             q = multiprocessing.JoinableQueue()
             pool = multiprocessing.Pool(self.num_worker, vectorize_mp, (q,))
 
+        # records of a previous run
+        latency_path = os.path.join(self.model_dir, LATENCY_FILE)
+        if os.path.exists(latency_path):
+            os.remove(latency_path)
+
         # preprocess first
         for i in trange(self.num_test):
             file_path = self.test_paths[i]
             print('\n[{}/{}] start prediction, path: {}'.format(i+1,self.num_test,file_path))
 
-            param = self.predict(file_path)
+            file_name = os.path.splitext(os.path.basename(file_path))[0]
+            profile = str(i) in self.profile or file_name in self.profile
+            if profile:
+                profiler = cProfile.Profile()
+                self.run_metadata = []
+                profiler.enable()
+
+            if self.rasters is not None:
+                param = self.predict_img(np.array(self.rasters[i]), file_path)
+            else:
+                param = self.predict(file_path)
 
-            if self.mp:
+            if profile:
+                # vectorized here to be in the profile
+                vectorize(param)
+                profiler.disable()
+                self.save_profile(file_name, profiler)
+            elif self.mp:
                 q.put(param)
             else:
                 vectorize(param)
@@ -140,27 +285,54 @@ class Tester(object):
         self.stat()
 
 
-    def predict(self, file_path):
+    def predict(self, file_path, keep_state=False):
         # convert svg to raster image
+        start_time = time.time()
         img, num_paths, path_list = self.batch_manager.read_svg(file_path)
+        duration = time.time() - start_time
+        if not self.compute_accuracy:
+            path_list = None
+        elif isinstance(path_list, StrokeMasks):
+            # rendered lazily in vectorize
+            path_list.one_pass = self.gt_one_pass
+        pm = self.predict_img(img, file_path, num_paths, path_list,
+                              keep_state=keep_state)
+        pm.latency['render'] = duration
+        return pm
+
+    def predict_img(self, img, file_path, num_paths=0, path_list=None,
+                    paths=None, keep_state=False, out_dir=None):
+        # paths can be given when pathnet already ran on img (e.g. batched),
+        # out_dir (default model_dir) gets the images and graphcut files
+        if path_list is None:
+            path_list = [] # no ground truth
+        if out_dir is None:
+            out_dir = self.model_dir
         file_name = os.path.splitext(os.path.basename(file_path))[0]
-        input_img_path = os.path.join(self.model_dir, '%s_0_input.png' % file_name)
+        pm = Param()
+        pm.latency = {}
+        t = time.time()
+        input_img_path = os.path.join(out_dir, '%s_0_input.png' % file_name)
         save_image((1-img[np.newaxis,:,:,np.newaxis])*255, input_img_path, padding=0)
+        t = add_time(pm, 'io', t)
 
         # # debug
         # print(num_paths)
         # plt.imshow(img, cmap=plt.cm.gray)
         # plt.show()
 
-        pm = Param()
-
         # predict paths through pathnet
         start_time = time.time()
-        paths, path_pixels = self.extract_path(img)        
+        if paths is None:
+            paths, path_pixels = self.extract_path(img)        
+        else:
+            path_pixels = np.nonzero(img)
+        t = add_time(pm, 'pathnet', t)
         num_path_pixels = len(path_pixels[0])
         pids = self.rng.randint(num_path_pixels, size=8)
-        path_img_path = os.path.join(self.model_dir, '%s_1_path.png' % file_name)
+        path_img_path = os.path.join(out_dir, '%s_1_path.png' % file_name)
         save_image((1 - paths[pids,:,:,:])*255, path_img_path, padding=0)
+        t = add_time(pm, 'io', t)
         
         # # debug
         # plt.imshow(paths[0,:,:,0], cmap=plt.cm.gray)
@@ -179,20 +351,19 @@ class Tester(object):
             # predict overlap using overlap net
             start_time = time.time()
             ov = self.overlap(img)
+            t = add_time(pm, 'overlapnet', t)
 
-            overlap_img_path = os.path.join(self.model_dir, '%s_2_overlap.png' % file_name)
+            overlap_img_path = os.path.join(out_dir, '%s_2_overlap.png' % file_name)
             ov_img = ov[np.newaxis,:,:,np.newaxis]
             save_image((1-ov_img)*255, overlap_img_path, padding=0)
+            t = add_time(pm, 'io', t)
 
             # # debug
             # plt.imshow(ov, cmap=plt.cm.gray)
             # plt.show()
 
-            for i in range(num_path_pixels):
-                if ov[path_pixels[0][i], path_pixels[1][i]]:
-                    dup_dict[i] = dup_id
-                    dup_rev_dict[dup_id] = i
-                    dup_id += 1
+            dup_dict, dup_rev_dict, dup_id = find_dup(ov, path_pixels)
+            t = add_time(pm, 'overlapnet', t)
 
             # debug
             # print(dup_dict)
@@ -205,37 +376,183 @@ class Tester(object):
         else:
             pm.duration_ov = 0
 
-        # write config file for graphcut
+        # write config file for graphcut, edges are written as computed (their
+        # time goes to graph) and only kept for update()
         start_time = time.time()
-        tmp_dir = os.path.join(self.model_dir, 'tmp')
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
-        pred_file_path = os.path.join(tmp_dir, file_name+'.pred')
-        f = open(pred_file_path, 'w')
-        # info
-        f.write(pred_file_path + '\n')
-        f.write(self.data_path + '\n')
-        f.write('%d\n' % self.max_label)
-        f.write('%d\n' % self.label_cost)
-        f.write('%f\n' % self.sigma_neighbor)
-        f.write('%f\n' % self.sigma_predict)
-        # f.write('%d\n' % num_path_pixels)
-        f.write('%d\n' % dup_id)
+        kept = [] if keep_state else None
+        pm.num_edges = self.write_pred(file_name, self.compute_edges(paths, path_pixels),
+                                       dup_dict, dup_id, out_dir, kept)
+        t = add_time(pm, 'graph', t)
+        duration = time.time() - start_time
+        print('%s: %s, prediction computed (%.3f sec)' % (datetime.now(), file_name, duration))
+        pm.duration_map = duration
+        pm.duration += duration
+        
+        pm.num_paths = num_paths
+        pm.path_list = path_list
+        pm.path_pixels = path_pixels
+        pm.num_sites = dup_id
+        pm.dup_dict = dup_dict
+        pm.dup_rev_dict = dup_rev_dict
+        pm.img = img
+        pm.file_path = file_path
+        pm.model_dir = out_dir
+        pm.latency_path = os.path.join(self.model_dir, LATENCY_FILE)
+        pm.warmup = False # set by bench.py, a warm-up record is left out of stat()
+        pm.height = self.height
+        pm.width = self.width
+        pm.max_label = self.max_label
+        pm.sigma_neighbor = self.sigma_neighbor
+        pm.sigma_predict = self.sigma_predict
+
+        # state needed by update()
+        if keep_state:
+            pm.paths = paths
+            pm.edges = edge_arrays(kept)
+
+        return pm
+
+    def update(self, pm, img, changed):
+        # incremental re-vectorization after an edit: pm comes from
+        # predict(keep_state=True) (+ vectorize for labels), img is the edited
+        # drawing and changed a bool mask of edited pixels.
+        file_name = os.path.splitext(os.path.basename(pm.file_path))[0]
+        pm.latency = {}
+        start_time = time.time()
+        t = start_time
+
+        # pathnet output at q sees the input within rf_radius of q (k=3 convs),
+        # so every map is stale where q is that close to the change. there a
+        # map whose seed is farther than rf_radius from q equals the seedless
+        # output, seeds within 2*rf_radius of the change are rerun instead.
+        rf_radius = self.repeat_num
+        square = np.ones([3,3], dtype=bool)
+        stale = scipy.ndimage.binary_dilation(changed, structure=square, iterations=rf_radius)
+        affected = scipy.ndimage.binary_dilation(stale, structure=square, iterations=rf_radius)
+
+        old_ids = -np.ones([self.height, self.width], dtype=np.int64)
+        old_ids[pm.path_pixels] = np.arange(len(pm.path_pixels[0]))
+        path_pixels = np.nonzero(img)
+        num_path_pixels = len(path_pixels[0])
+        assert(num_path_pixels > 0)
+        old_id = old_ids[path_pixels]
+        recompute = np.logical_or(old_id < 0, affected[path_pixels])
+        sources = np.nonzero(recompute)[0]
+        reused = np.nonzero(~recompute)[0]
+
+        # predict paths through pathnet only for affected pixels
+        paths = np.zeros([num_path_pixels, self.height, self.width, 1], dtype=np.float32)
+        paths[reused] = pm.paths[old_id[reused]]
+        if reused.size > 0 and np.any(stale):
+            x_batch = np.zeros([1, self.height, self.width, 2])
+            x_batch[0,:,:,0] = img
+            seedless = self.run_pathnet(x_batch)[0]
+            sy, sx = np.nonzero(stale)
+            paths[reused[:,np.newaxis], sy, sx, 0] = seedless[sy, sx, 0]
+        if sources.size > 0:
+            paths[sources], _ = self.extract_path(img,
+                (path_pixels[0][sources], path_pixels[1][sources]))
+        t = add_time(pm, 'pathnet', t)
+        duration = time.time() - start_time
+        print('%s: %s, update paths (#pixels:%d/%d) through pathnet (%.3f sec)' % (datetime.now(), file_name, sources.size, num_path_pixels, duration))
+        pm.duration_pred = duration
+        pm.duration = duration
+
+        dup_dict = {}
+        dup_rev_dict = {}
+        dup_id = num_path_pixels
+        if self.find_overlap:
+            start_time = time.time()
+            ov = self.overlap(img)
+            dup_dict, dup_rev_dict, dup_id = find_dup(ov, path_pixels)
+            t = add_time(pm, 'overlapnet', t)
+            duration = time.time() - start_time
+            pm.duration_ov = duration
+            pm.duration += duration
+        else:
+            pm.duration_ov = 0
+
+        # keep edges between reused pixels, recompute the ones touching the change
+        start_time = time.time()
+        new_ids = -np.ones(len(pm.path_pixels[0]), dtype=np.int64)
+        new_ids[old_id[reused]] = reused
+        ei, ej, ep, es = pm.edges
+        ei, ej = new_ids[ei], new_ids[ej]
+        keep = np.logical_and(ei >= 0, ej >= 0)
+        old_edges = zip(ei[keep], ej[keep], ep[keep], es[keep])
+        kept = []
+        pm.num_edges = self.write_pred(file_name,
+            itertools.chain(old_edges, self.compute_edges(paths, path_pixels, sources)),
+            dup_dict, dup_id, pm.model_dir, kept)
+        num_new = len(kept) - np.sum(keep)
+        edges = edge_arrays(kept)
+        t = add_time(pm, 'graph', t)
+
+        # warm start graphcut from the previous labels
+        old_labels = getattr(pm, 'labels', None)
+        if old_labels is None:
+            old_labels = read_labels(os.path.join(pm.model_dir, 'tmp', file_name + '.label'))[2]
+        init_labels = np.zeros(dup_id, dtype=np.int32)
+        if reused.size > 0:
+            init_labels[reused] = old_labels[old_id[reused]]
+            if sources.size > 0:
+                knb = sklearn.neighbors.NearestNeighbors(n_neighbors=1)
+                knb.fit(np.array(path_pixels).transpose()[reused])
+                _, nn = knb.kneighbors(np.array(path_pixels).transpose()[sources])
+                init_labels[sources] = init_labels[reused[nn[:,0]]]
+        for i, dup_i in dup_dict.items():
+            old_dup = pm.dup_dict.get(old_id[i]) if not recompute[i] else None
+            init_labels[dup_i] = old_labels[old_dup] if old_dup is not None else init_labels[i]
+        init_labels = np.minimum(init_labels, self.max_label-1)
+        init_label_path = os.path.join(pm.model_dir, 'tmp', file_name + '.init')
+        with open(init_label_path, 'w') as f:
+            f.write(' '.join(str(l) for l in init_labels))
+        t = add_time(pm, 'graph', t)
+        duration = time.time() - start_time
+        print('%s: %s, prediction updated (#edges:%d new) (%.3f sec)' % (datetime.now(), file_name, num_new, duration))
+        pm.duration_map = duration
+        pm.duration += duration
+
+        # ground truth is unknown after an edit
+        pm.num_paths = 0
+        pm.path_list = []
+        pm.path_pixels = path_pixels
+        pm.num_sites = dup_id
+        pm.dup_dict = dup_dict
+        pm.dup_rev_dict = dup_rev_dict
+        pm.img = img
+        pm.paths = paths
+        pm.edges = edges
+        pm.labels = None
+        pm.init_label_path = init_label_path
+        return pm
+
+    def compute_edges(self, paths, path_pixels, sources=None):
+        # yields edges (i, j, pred, spatial) with i < j from each source pixel
+        # to its neighbors. by default every pair is visited once; with a
+        # subset of sources, pairs between two non-source pixels are skipped.
+        num_path_pixels = len(path_pixels[0])
+        is_source = np.ones(num_path_pixels, dtype=bool)
+        if sources is None:
+            sources = range(num_path_pixels-1)
+        else:
+            is_source[:] = False
+            is_source[sources] = True
+        non_sources = np.nonzero(~is_source)[0]
 
         # support only symmetric edge weight
         radius = self.sigma_neighbor*2
         nb = sklearn.neighbors.NearestNeighbors(radius=radius)
         nb.fit(np.array(path_pixels).transpose())
 
-        high_spatial = 100000
-        for i in range(num_path_pixels-1):
+        for i in sources:
             p1 = np.array([path_pixels[0][i], path_pixels[1][i]])
             pred_p1 = np.reshape(paths[i,:,:,:], [self.height, self.width])
 
             # see close neighbors and some far neighbors (stochastic sampling)
             rng = nb.radius_neighbors([p1])
             num_close = len(rng[1][0])
-            far = np.setdiff1d(range(i+1,num_path_pixels),rng[1][0])
+            far = np.setdiff1d(np.union1d(np.arange(i+1,num_path_pixels), non_sources),rng[1][0])
             num_far = len(far)
             num_far = int(num_far * self.neighbor_sample)
             if num_far > 0:
@@ -245,7 +562,7 @@ class Tester(object):
                 nb_ids = rng[1][0]
             
             for rj, j in enumerate(nb_ids): # ids
-                if j <= i:
+                if j == i or (j < i and is_source[j]):
                     continue                
                 p2 = np.array([path_pixels[0][j], path_pixels[1][j]])
                 if rj < num_close: d12 = rng[0][0][rj]
@@ -260,68 +577,100 @@ class Tester(object):
                 pred = np.exp(-0.5 * (1.0-pred)**2 / self.sigma_predict**2)
 
                 spatial = np.exp(-0.5 * d12**2 / self.sigma_neighbor**2)
-                f.write('%d %d %f %f\n' % (i, j, pred, spatial))
+                yield min(i, j), max(i, j), pred, spatial
 
-                dup_i = dup_dict.get(i)
-                if dup_i is not None:
-                    f.write('%d %d %f %f\n' % (j, dup_i, pred, spatial)) # as dup is always smaller than normal id
-                    f.write('%d %d %f %f\n' % (i, dup_i, 0, high_spatial)) # shouldn't be labeled together
-                dup_j = dup_dict.get(j)
-                if dup_j is not None:
-                    f.write('%d %d %f %f\n' % (i, dup_j, pred, spatial)) # as dup is always smaller than normal id
-                    f.write('%d %d %f %f\n' % (j, dup_j, 0, high_spatial)) # shouldn't be labeled together
+    def write_pred(self, file_name, edges, dup_dict, num_sites, out_dir, kept=None):
+        # edges: iterable of (i, j, pred, spatial), streamed to the file and
+        # appended to kept if given
+        tmp_dir = os.path.join(out_dir, 'tmp')
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        pred_file_path = os.path.join(tmp_dir, file_name+'.pred')
+        f = open(pred_file_path, 'w')
+        # info
+        f.write(pred_file_path + '\n')
+        f.write(self.data_path + '\n')
+        f.write('%d\n' % self.max_label)
+        f.write('%d\n' % self.label_cost)
+        f.write('%f\n' % self.sigma_neighbor)
+        f.write('%f\n' % self.sigma_predict)
+        # f.write('%d\n' % num_path_pixels)
+        f.write('%d\n' % num_sites)
 
-                if dup_i is not None and dup_j is not None:
-                    f.write('%d %d %f %f\n' % (dup_i, dup_j, pred, spatial)) # dup_i < dup_j
+        high_spatial = 100000
+        num_edges = 0
+        for i, j, pred, spatial in edges:
+            f.write('%d %d %f %f\n' % (i, j, pred, spatial))
+            num_edges += 1
+            if kept is not None:
+                kept.append((i, j, pred, spatial))
+
+            dup_i = dup_dict.get(i)
+            if dup_i is not None:
+                f.write('%d %d %f %f\n' % (j, dup_i, pred, spatial)) # as dup is always smaller than normal id
+                f.write('%d %d %f %f\n' % (i, dup_i, 0, high_spatial)) # shouldn't be labeled together
+                num_edges += 2
+            dup_j = dup_dict.get(j)
+            if dup_j is not None:
+                f.write('%d %d %f %f\n' % (i, dup_j, pred, spatial)) # as dup is always smaller than normal id
+                f.write('%d %d %f %f\n' % (j, dup_j, 0, high_spatial)) # shouldn't be labeled together
+                num_edges += 2
+
+            if dup_i is not None and dup_j is not None:
+                f.write('%d %d %f %f\n' % (dup_i, dup_j, pred, spatial)) # dup_i < dup_j
+                num_edges += 1
 
         f.close()
-        duration = time.time() - start_time
-        print('%s: %s, prediction computed (%.3f sec)' % (datetime.now(), file_name, duration))
-        pm.duration_map = duration
-        pm.duration += duration
-        
-        pm.num_paths = num_paths
-        pm.path_list = path_list
-        pm.path_pixels = path_pixels
-        pm.dup_dict = dup_dict
-        pm.dup_rev_dict = dup_rev_dict
-        pm.img = img
-        pm.file_path = file_path
-        pm.model_dir = self.model_dir
-        pm.height = self.height
-        pm.width = self.width
-        pm.max_label = self.max_label
-        pm.sigma_neighbor = self.sigma_neighbor
-        pm.sigma_predict = self.sigma_predict
+        return num_edges
 
-        return pm
+    def extract_path(self, img, path_pixels=None):
+        if path_pixels is not None:
+            path_pixels = [path_pixels]
+        y_batch, path_pixels = self.extract_paths([img], path_pixels)
+        return y_batch[0], path_pixels[0]
 
-    def extract_path(self, img):
-        path_pixels = np.nonzero(img)
-        num_path_pixels = len(path_pixels[0]) 
-        assert(num_path_pixels > 0)
+    def run_pathnet(self, x_batch):
+        # [n,h,w,2] (drawing, seed) -> [n,h,w,1] path maps
+        if self.data_format == 'NCHW':
+            x_batch = to_nchw_numpy(x_batch)
+        y_b = self.run('pathnet', self.sp, self.yp, {self.xp: x_batch})
+        y_b = np.clip(y_b, 0, 1)
+        if self.data_format == 'NCHW':
+            y_b = to_nhwc_numpy(y_b)
+        return y_b
+
+    def extract_paths(self, img_list, path_pixels_list=None):
+        # run pathnet on the path pixels of several images in shared batches
+        if path_pixels_list is None:
+            path_pixels_list = [np.nonzero(img) for img in img_list]
+        img_ids = []
+        for k, path_pixels in enumerate(path_pixels_list):
+            num_path_pixels = len(path_pixels[0]) 
+            assert(num_path_pixels > 0)
+            img_ids.append(np.full(num_path_pixels, k, dtype=np.int64))
+        img_ids = np.concatenate(img_ids)
+        pxs = np.concatenate([path_pixels[0] for path_pixels in path_pixels_list])
+        pys = np.concatenate([path_pixels[1] for path_pixels in path_pixels_list])
+        num_path_pixels = len(img_ids)
 
         y_batch = None
         for b in range(0,num_path_pixels,self.b_num):
             b_size = min(self.b_num, num_path_pixels - b)
             x_batch = np.zeros([b_size, self.height, self.width, 2])
             for i in range(b_size):
-                x_batch[i,:,:,0] = img
-                px, py = path_pixels[0][b+i], path_pixels[1][b+i]
+                x_batch[i,:,:,0] = img_list[img_ids[b+i]]
+                px, py = pxs[b+i], pys[b+i]
                 x_batch[i,px,py,1] = 1.0
         
-            if self.data_format == 'NCHW':
-                x_batch = to_nchw_numpy(x_batch)
-            y_b = self.sp.run(self.yp, feed_dict={self.xp: x_batch})
-            y_b = np.clip(y_b, 0, 1)
-            if self.data_format == 'NCHW':
-                y_b = to_nhwc_numpy(y_b)
+            y_b = self.run_pathnet(x_batch)
             if y_batch is None:
                 y_batch = y_b
             else:
                 y_batch = np.concatenate((y_batch, y_b), axis=0)
 
-        return y_batch, path_pixels
+        # split per image
+        splits = np.cumsum([len(path_pixels[0]) for path_pixels in path_pixels_list])[:-1]
+        return np.split(y_batch, splits), path_pixels_list
 
     def overlap(self, img):
         x_batch = np.zeros([1, self.height, self.width, 1])
@@ -329,67 +678,75 @@ class Tester(object):
         
         if self.data_format == 'NCHW':
             x_batch = to_nchw_numpy(x_batch)
-        y_b = self.so.run(self.yo, feed_dict={self.xo: x_batch})
+        y_b = self.run('overlapnet', self.so, self.yo, {self.xo: x_batch})
         if self.data_format == 'NCHW':
             y_b = to_nhwc_numpy(y_b)
         return (y_b[0,:,:,0] >= self.overlap_threshold)
 
+    def run(self, net, sess, fetch, feed_dict):
+        # sess.run, traced while a file is profiled
+        if self.run_metadata is None:
+            return sess.run(fetch, feed_dict=feed_dict)
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        result = sess.run(fetch, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+        self.run_metadata.append((net, run_metadata))
+        return result
+
+    def save_profile(self, file_name, profiler):
+        save_profile(profiler, os.path.join(self.profile_dir, file_name))
+        for k, (net, run_metadata) in enumerate(self.run_metadata):
+            save_timeline(run_metadata, os.path.join(self.profile_dir, '%s_%s_%d.json' % (file_name, net, k)))
+        print('%s: %s profiled in %s (%d sess.run)' % (datetime.now(), file_name, self.profile_dir, len(self.run_metadata)))
+        self.run_metadata = None
+
     def stat(self):
-        from glob import glob
-        stat_paths = sorted(glob("{}/*{}".format(self.model_dir, '_stat.txt')))
-        diff = []
-        abs_diff = []
-        acc = []
-        d_pred = []
-        d_ov = []
-        d_map = []
-        d_vec = []
-        duration = []
-
-        # print(len(stat_paths))
-        for path in stat_paths:            
-            with open(path, 'r') as f:
-                stat = f.readline()                 
-            # print(stat)
-            stat = stat.split()
-            # file_path, num_labels, pm.num_paths, acc_avg,
-            # duration_pred, duration_ov, duration_map, 
-            # duration_vect, duration
-            num_labels = int(stat[1])
-            gt_labels = int(stat[2])
-            acc_ = float(stat[3])
-            dpred = float(stat[4])
-            dov = float(stat[5])
-            dmap = float(stat[6])
-            dvec = float(stat[7])
-            d = float(stat[8])
-            
-            diff.append(num_labels-gt_labels)
-            abs_diff.append(abs(num_labels-gt_labels))
-            acc.append(acc_)
-            d_pred.append(dpred)
-            d_ov.append(dov)
-            d_map.append(dmap)
-            d_vec.append(dvec)
-            duration.append(d)
-
-        print('label abs diff: {}'.format(np.average(abs_diff)))
-        print('acc: {}'.format(np.average(acc)))
-        print('duration for prediction: {}'.format(np.average(d_pred)))
-        print('duration for overlap: {}'.format(np.average(d_ov)))
-        print('duration for mapping: {}'.format(np.average(d_map)))
-        print('duration for vectorization: {}'.format(np.average(d_vec)))
-        print('duration total: {}'.format(np.average(duration)))
-        
-        stat_path = os.path.join(self.model_dir, 'summary.txt')
-        with open(stat_path, 'w') as f:
-            f.write('label abs diff: {}\n'.format(np.average(abs_diff)))
-            f.write('acc: {}\n'.format(np.average(acc)))
-            f.write('duration for prediction: {}\n'.format(np.average(d_pred)))
-            f.write('duration for overlap: {}\n'.format(np.average(d_ov)))
-            f.write('duration for mapping: {}\n'.format(np.average(d_map)))
-            f.write('duration for vectorization: {}\n'.format(np.average(d_vec)))
-            f.write('duration total: {}\n'.format(np.average(duration)))
+        latency_path = os.path.join(self.model_dir, LATENCY_FILE)
+        if not os.path.exists(latency_path):
+            print('%s: no %s, nothing vectorized' % (datetime.now(), latency_path))
+            return
+        with open(latency_path, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        records = [r for r in records if not r.get('warmup')]
+        if not records:
+            return
+
+        # accuracy only over files with ground truth (acc is 0 without)
+        gt = [r for r in records if r['gt_labels'] > 0]
+        summary = {
+            'num_files': len(records),
+            'num_gt_files': len(gt),
+            'label_abs_diff': np.average([abs(r['labels'] - r['gt_labels']) for r in gt]) if gt else None,
+            'acc': np.average([r['acc'] for r in gt]) if gt else None,
+        }
+        for stage in STAGES + ['total']:
+            if stage == 'total':
+                d = [r['total'] for r in records]
+            else:
+                d = [r['latency'][stage] for r in records]
+            p50, p95, p99 = np.percentile(d, [50, 95, 99])
+            summary[stage] = {'mean': np.average(d), 'p50': p50, 'p95': p95, 'p99': p99}
+
+        # tail latency by drawing complexity
+        slowest = sorted(records, key=lambda r: r['total'], reverse=True)[:10]
+        summary['slowest'] = [{k: r[k] for k in ['file', 'pixels', 'sites', 'edges', 'labels', 'total']}
+                              for r in slowest]
+
+        lines = ['label abs diff: {}'.format(summary['label_abs_diff']),
+                 'acc: {}'.format(summary['acc'])]
+        for stage in STAGES + ['total']:
+            d = summary[stage]
+            lines.append('{}: mean {:.3f} p50 {:.3f} p95 {:.3f} p99 {:.3f}'.format(
+                stage, d['mean'], d['p50'], d['p95'], d['p99']))
+        for r in summary['slowest']:
+            lines.append('slow: {} (#pixels:{} #sites:{} #edges:{} #labels:{}) {:.3f}'.format(
+                r['file'], r['pixels'], r['sites'], r['edges'], r['labels'], r['total']))
+        print('\n'.join(lines))
+
+        with open(os.path.join(self.model_dir, 'summary.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        with open(os.path.join(self.model_dir, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=4)
 
 def vectorize(pm):
     start_time = time.time()
@@ -400,13 +757,19 @@ def vectorize(pm):
     labels, e_before, e_after = label(file_name, pm)
 
     # 2. merge small components
+    t = time.time()
     labels = merge_small_component(labels, pm)
+    t = add_time(pm, 'merge', t)
     
     # # 2-2. assign one label per one connected component
     # labels = label_cc(labels, pm)
 
     # 3. compute accuracy
-    accuracy_list = compute_accuracy(labels, pm)
+    if len(pm.path_list) > 0:
+        accuracy_list = compute_accuracy(labels, pm)
+    else:
+        accuracy_list = [0] # no ground truth
+    t = add_time(pm, 'accuracy', t)
 
     unique_labels = np.unique(labels)
     num_labels = unique_labels.size        
@@ -419,97 +782,114 @@ def vectorize(pm):
     print('%s: %s, accuracy computed, avg.: %.3f' % (datetime.now(), file_name, acc_avg))
 
     # 4. save image
-    save_label_img(labels, unique_labels, num_labels, acc_avg, pm)
+    pm.svg_path = save_label_img(labels, unique_labels, num_labels, acc_avg, pm)
+    t = add_time(pm, 'potrace', t)
     duration = time.time() - start_time
     pm.duration_vect = duration
     
     # write result
     pm.duration += duration        
     print('%s: %s, done (%.3f sec)' % (datetime.now(), file_name, pm.duration))
-    stat_file_path = os.path.join(pm.model_dir, file_name + '_stat.txt')
-    with open(stat_file_path, 'w') as f:
-        f.write('%s %d %d %.3f %.3f %.3f %.3f %.3f %.3f\n' % (
-            file_path, num_labels, pm.num_paths, acc_avg,
-            pm.duration_pred, pm.duration_ov, pm.duration_map, 
-            pm.duration_vect, pm.duration))
+
+    # one line per file, appended by every vectorize worker
+    record = {
+        'file': file_path,
+        'pixels': len(pm.path_pixels[0]),
+        'sites': pm.num_sites,
+        'edges': pm.num_edges,
+        'labels': int(num_labels),
+        'gt_labels': int(pm.num_paths),
+        'acc': float(acc_avg),
+        'latency': {k: pm.latency.get(k, 0) for k in STAGES},
+        'total': sum(pm.latency.values()),
+        'warmup': pm.warmup,
+    }
+    with open(pm.latency_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    # keep labels for incremental update
+    pm.labels = labels
 
 def label(file_name, pm):
     start_time = time.time()
+    t = start_time
     working_path = os.getcwd()
     gco_path = os.path.join(working_path, 'gco/build')
-    os.chdir(gco_path)
 
     pred_file_path = os.path.join(working_path, pm.model_dir, 'tmp', file_name + '.pred')        
+    # warm start from previous labels if given
+    args = [pred_file_path]
+    init_label_path = getattr(pm, 'init_label_path', None)
+    if init_label_path is not None:
+        args.append(os.path.join(working_path, init_label_path))
+    # run in gco_path without chdir, vectorize may run in threads
     sys_name = platform.system()
     if sys_name == 'Windows':
-        call(['Release/gco.exe', pred_file_path])
+        call([os.path.join(gco_path, 'Release/gco.exe')] + args, cwd=gco_path)
     else:
-        call(['./gco', pred_file_path])
-    os.chdir(working_path)
+        call([os.path.join(gco_path, 'gco')] + args, cwd=gco_path)
+    t = add_time(pm, 'solver', t)
 
     # read graphcut result
     label_file_path = os.path.join(pm.model_dir, 'tmp', file_name + '.label')
+    e_before, e_after, labels = read_labels(label_file_path)
+    t = add_time(pm, 'io', t)
+    duration = time.time() - start_time
+    print('%s: %s, labeling finished (%.3f sec)' % (datetime.now(), file_name, duration))
+
+    return labels, e_before, e_after
+
+def read_labels(label_file_path):
     f = open(label_file_path, 'r')
     e_before = float(f.readline())
     e_after = float(f.readline())
     labels = np.fromstring(f.read(), dtype=np.int32, sep=' ')
     f.close()
-    duration = time.time() - start_time
-    print('%s: %s, labeling finished (%.3f sec)' % (datetime.now(), file_name, duration))
-
-    return labels, e_before, e_after
+    return e_before, e_after, labels
 
 def merge_small_component(labels, pm):
     knb = sklearn.neighbors.NearestNeighbors(n_neighbors=5, algorithm='ball_tree')
     knb.fit(np.array(pm.path_pixels).transpose())
 
     num_path_pixels = len(pm.path_pixels[0])
+    px, py = pm.path_pixels
+    pixel_ids = np.zeros([pm.height, pm.width], dtype=np.int64)
+    pixel_ids[px, py] = np.arange(num_path_pixels)
+    dup_pixels = np.array(sorted(pm.dup_dict), dtype=np.int64)
+    dup_sites = np.array([pm.dup_dict[i] for i in dup_pixels], dtype=np.int64)
+    dup_of = -np.ones(num_path_pixels, dtype=np.int64)
+    dup_of[dup_pixels] = dup_sites
 
     for iter in range(2):
-        # # debug
-        # print('%d-th iter' % iter)
-        
-        unique_label = np.unique(labels)
-        for i in unique_label:
-            i_label_list = np.nonzero(labels == i)
-
-            # handle duplicated pixels
-            for j, i_label in enumerate(i_label_list[0]):
-                if i_label >= num_path_pixels:
-                    i_label_list[0][j] = pm.dup_rev_dict[i_label]
-
-            # connected component analysis on 'i' label map
-            i_label_map = np.zeros([pm.height, pm.width], dtype=np.float)
-            i_label_map[pm.path_pixels[0][i_label_list],pm.path_pixels[1][i_label_list]] = 1.0
-            cc_map, num_cc = skimage.measure.label(i_label_map, background=0, return_num=True)
-
-            # # debug
-            # print('%d: # labels %d, # cc %d' % (i, num_i_label_pixels, num_cc))
-            # plt.imshow(cc_map, cmap='spectral')
-            # plt.show()
-
-            # detect small pixel component
-            for j in range(num_cc):
-                j_cc_list = np.nonzero(cc_map == (j+1))
-                num_j_cc = len(j_cc_list[0])
-
-                # consider only less than 5 pixels component
-                if num_j_cc > 4:
-                    continue
-
-                # assign dominant label of neighbors using knn
-                for k in range(num_j_cc):
-                    p1 = np.array([j_cc_list[0][k], j_cc_list[1][k]])
-                    _, indices = knb.kneighbors([p1], n_neighbors=5)
-                    max_label_nb = np.argmax(np.bincount(labels[indices][0]))
-                    labels[indices[0][0]] = max_label_nb
+        # components of all labels at once: label+1 of the pixels in layer 0
+        # and of their duplicates, where it differs, in layer 1. pixels of
+        # the same label are connected within and across layers (8-neighbors)
+        label_map = np.zeros([2, pm.height, pm.width], dtype=np.int64)
+        label_map[0, px, py] = labels[:num_path_pixels] + 1
+        dup_labels = labels[dup_sites]
+        own = dup_labels != labels[dup_pixels]
+        label_map[1, px[dup_pixels[own]], py[dup_pixels[own]]] = dup_labels[own] + 1
+        cc_map = skimage.measure.label(label_map, background=0, connectivity=3)
+
+        # pixels of components of less than 5 pixels
+        cc_size = np.bincount(cc_map.ravel())
+        _, sx, sy = np.nonzero(np.logical_and(cc_map > 0, cc_size[cc_map] <= 4))
+        small = np.unique(pixel_ids[sx, sy])
+        if small.size == 0:
+            break
 
-                    # # debug
-                    # print(' (%d,%d) %d -> %d' % (p1[0], p1[1], i, max_label_nb))
+        # assign dominant label of the 5 nearest pixels (the smallest label
+        # on a tie), to the pixel and its duplicate
+        _, indices = knb.kneighbors(np.stack([px[small], py[small]], axis=1),
+                                    n_neighbors=min(5, num_path_pixels))
+        nb_labels = labels[indices]
+        votes = np.sum(nb_labels[:,:,np.newaxis] == nb_labels[:,np.newaxis,:], axis=2)
+        best = np.lexsort((nb_labels, -votes))[:,0]
+        max_label_nb = nb_labels[np.arange(len(small)), best]
 
-                    dup = pm.dup_dict.get(indices[0][0])
-                    if dup is not None:
-                        labels[dup] = max_label_nb
+        labels[indices[:,0]] = max_label_nb
+        dup = dup_of[indices[:,0]]
+        labels[dup[dup >= 0]] = max_label_nb[dup >= 0]
 
     return labels
 
@@ -671,3 +1051,5 @@ def save_label_img(labels, unique_labels, num_labels, acc_avg, pm):
     label_map_path = os.path.join(pm.model_dir, '%s_%.2f_%.2f_%d_%d_%.2f_t.png' % (
         file_name, pm.sigma_neighbor, pm.sigma_predict, num_labels, gt_labels, acc_avg))
     scipy.misc.imsave(label_map_path, label_map_t)
+
+    return target_svg_path
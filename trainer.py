@@ -1,20 +1,146 @@
 from __future__ import print_function
 
 import os
+import sys
+import json
+import time
+import signal
+import cProfile
+import threading
+import multiprocessing
 import numpy as np
 from tqdm import trange
+from datetime import datetime
 
 from models import *
-from utils import save_image
+from utils import save_image, valid_set, produce_examples
+from utils import profile_targets, profile_dir, save_profile, save_timeline
+
+def replica_device(device):
+    # ops of a replica on its device, the shared variables on the cpu
+    # (local parameter server)
+    def device_fn(op):
+        if op.type in ['Variable', 'VariableV2', 'VarHandleOp']:
+            return '/cpu:0'
+        return device
+    return device_fn
+
+def start_cluster(config):
+    # between-graph replication on localhost: one process per rank, a
+    # parameter server (hosted by rank 0) at --cluster_port and rank r at
+    # cluster_port+1+r. returns the servers of this process (its worker
+    # last) and the device function putting the variables on the ps
+    ps_hosts = ['localhost:%d' % config.cluster_port]
+    worker_hosts = ['localhost:%d' % (config.cluster_port + 1 + r) for r in range(config.world_size)]
+    cluster = tf.train.ClusterSpec({'ps': ps_hosts, 'worker': worker_hosts})
+    servers = []
+    if config.rank == 0:
+        servers.append(tf.train.Server(cluster, job_name='ps', task_index=0))
+    servers.append(tf.train.Server(cluster, job_name='worker', task_index=config.rank))
+    device = tf.train.replica_device_setter(worker_device='/job:worker/task:%d' % config.rank,
+                                            cluster=cluster)
+    print('%s: rank %d of %d, ps %s, workers %s' % (
+        datetime.now(), config.rank, config.world_size, ps_hosts[0], ','.join(worker_hosts)))
+    return servers, device
+
+def average_gradients(replica_grads):
+    # [(grad, var)] per replica -> [(mean grad, var)], None for the
+    # variables without gradient (batch norm moving stats)
+    if len(replica_grads) == 1:
+        return replica_grads[0]
+    averaged = []
+    for gv in zip(*replica_grads):
+        grads = [g for g, _ in gv if g is not None]
+        averaged.append((tf.add_n(grads) / len(grads) if grads else None, gv[0][1]))
+    return averaged
+
+def dequeue_time(run_metadata):
+    # sec the traced step waited on the input queues (longest replica)
+    wait = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            if 'DequeueMany' in node_stats.node_name:
+                wait = max(wait, node_stats.all_end_rel_micros / 1e6)
+    return wait
+
+def score(predict, valid_x, valid_y, batch_size, data_format):
+    # l1/l2 accuracy and iou of predict (x -> clipped y_) on the validation
+    # set, averaged over batches
+    l1, l2, iou, nb = 0, 0, 0, 0
+    for i in range(0, len(valid_x), batch_size):
+        x = np.asarray(valid_x[i:i+batch_size])
+        y = np.asarray(valid_y[i:i+batch_size])
+        if data_format == 'NCHW':
+            x = to_nchw_numpy(x)
+            y = to_nchw_numpy(y)
+        y_ = predict(x)
+        l1 += 1 - np.mean(np.abs(y_ - y))
+        l2 += 1 - np.mean(np.square(y_ - y))
+        nb += 1
+
+        # iou
+        y_I = np.logical_and(y>0, y_>0)
+        y_I_sum = np.sum(y_I, axis=(1, 2, 3))
+        y_U = np.logical_or(y>0, y_>0)
+        y_U_sum = np.sum(y_U, axis=(1, 2, 3))
+        nonzero_id = np.where(y_U_sum != 0)[0]
+        if nonzero_id.shape[0] == 0:
+            acc = 1.0
+        else:
+            acc = np.average(y_I_sum[nonzero_id] / y_U_sum[nonzero_id])
+        iou += acc
+
+    return l1 / float(nb), l2 / float(nb), iou / float(nb)
+
+def evaluate_checkpoint(config, batch_manager):
+    # standalone evaluation: the --archi checkpoint (load_pathnet or
+    # load_overlapnet) on the validation set, results in model_dir/eval.json
+    load_dir = config.load_pathnet if config.archi == 'path' else config.load_overlapnet
+    x = tf.placeholder(tf.float32, shape=[None, config.height, config.width, 2 if config.archi == 'path' else 1])
+    xin = nhwc_to_nchw(x) if config.data_format == 'NCHW' else x
+    y_, _ = VDSR(xin, config.conv_hidden_num, config.repeat_num,
+                 config.data_format, config.use_norm, train=False)
+    y_ = tf.clip_by_value(y_, 0, 1)
+
+    sess_config = tf.ConfigProto(allow_soft_placement=True,
+                                 gpu_options=tf.GPUOptions(allow_growth=True))
+    sess = tf.Session(config=sess_config)
+    saver = tf.train.Saver()
+    ckpt = tf.train.get_checkpoint_state(load_dir)
+    assert(ckpt and load_dir)
+    ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
+    saver.restore(sess, os.path.join(load_dir, ckpt_name))
+    print('%s: Pre-trained model restored from %s' % (datetime.now(), load_dir))
+
+    valid_x, valid_y = valid_set(batch_manager, config)
+    l1, l2, iou = score(lambda x_: sess.run(y_, {x: x_}),
+                        valid_x, valid_y, config.batch_size, config.data_format)
+    result = {'checkpoint': os.path.join(load_dir, ckpt_name), 'num': len(valid_x),
+              'test_acc_l1': float(l1), 'test_acc_l2': float(l2), 'test_acc_iou': float(iou)}
+    with open(os.path.join(config.model_dir, 'eval.json'), 'w') as f:
+        json.dump(result, f, indent=4)
+    print('%s: l1 %.4f l2 %.4f iou %.4f on %d examples' % (datetime.now(), l1, l2, iou, len(valid_x)))
+    return result
 
 class Trainer(object):
-    def __init__(self, config, batch_manager):
+    def __init__(self, config, batch_manager, servers=None):
+        # servers: of start_cluster, with world_size > 1 (the graph is then
+        # built under its device function)
         tf.set_random_seed(config.random_seed)
         self.config = config
-        self.batch_manager = batch_manager
-        self.x, self.y = batch_manager.batch()
+        self.rank = config.rank
+        self.world_size = config.world_size
+        self.is_chief = (self.rank == 0)
+        self.servers = servers
+        # data parallel: one BatchManager (train shard) per replica
+        if not isinstance(batch_manager, list):
+            batch_manager = [batch_manager]
+        self.batch_managers = batch_manager
+        self.batch_manager = batch_manager[0]
+        self.num_replica = len(batch_manager)
+        self.xs, self.ys = zip(*[bm.batch() for bm in batch_manager])
+        self.x, self.y = self.xs[0], self.ys[0]
         self.xt = tf.placeholder(tf.float32, shape=int_shape(self.x))
-        self.yt = tf.placeholder(tf.float32, shape=int_shape(self.y))
         self.dataset = config.dataset
 
         self.beta1 = config.beta1
@@ -32,52 +158,152 @@ class Trainer(object):
         self.repeat_num = config.repeat_num
         self.use_l2 = config.use_l2
         self.use_norm = config.use_norm
+        self.dtype = tf.as_dtype(config.precision)
+        # float16 gradients underflow without it, bfloat16 has float32's range
+        self.loss_scale = config.loss_scale if config.precision == 'float16' else 1
 
         self.model_dir = config.model_dir
 
         self.use_gpu = config.use_gpu
         self.data_format = config.data_format
         if self.data_format == 'NCHW':
-            self.x = nhwc_to_nchw(self.x)
-            self.y = nhwc_to_nchw(self.y)
+            self.xs = [nhwc_to_nchw(x) for x in self.xs]
+            self.ys = [nhwc_to_nchw(y) for y in self.ys]
+            self.x, self.y = self.xs[0], self.ys[0]
             self.xt = nhwc_to_nchw(self.xt)
-            self.yt = nhwc_to_nchw(self.yt)
 
         self.start_step = config.start_step
         self.log_step = config.log_step
+        self.trace_step = config.trace_step
         self.test_step = config.test_step
         self.max_step = config.max_step
         self.save_sec = config.save_sec
         self.lr_update_step = config.lr_update_step
+        self.eval_size = config.eval_size
+        # in-graph towers of one process (num_replica, one per GPU) or one
+        # replica per process (world_size), not both
+        assert self.num_replica == 1 or self.world_size == 1, \
+            'num_replica > 1 runs in one process, use it without world_size > 1'
+        if self.num_replica > 1 and not self.use_gpu:
+            print('%s: %d towers share the cpu, --world_size processes split it instead' % (
+                datetime.now(), self.num_replica))
+        num_replica = self.num_replica * self.world_size
+        if num_replica > 1:
+            # an update takes a batch from every replica: step budget and lr
+            # schedule are scaled to see the same number of examples
+            self.max_step = config.max_step // num_replica
+            self.lr_update_step = max(config.lr_update_step // num_replica, 1)
+            print('%s: %d replicas, max_step %d, lr_update_step %d' % (
+                datetime.now(), num_replica, self.max_step, self.lr_update_step))
 
         self.step = tf.Variable(self.start_step, name='step', trainable=False)
 
+        # --profile steps: cProfile of the producer work of a batch and a
+        # timeline of the step, in model_dir/profile
+        self.profile_steps = set(int(s) for s in profile_targets(config))
+        if self.profile_steps:
+            self.profile_dir = profile_dir(config)
+
         self.is_train = config.is_train
-        self.build_model()
+        if self.profile_steps:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            self.build_model()
+            profiler.disable()
+            save_profile(profiler, os.path.join(self.profile_dir, 'build_model'))
+        else:
+            self.build_model()
 
-        self.saver = tf.train.Saver()
+        # the evaluation copy is not part of the model
+        eval_names = set(v.name for v in self.eval_var)
+        self.saver = tf.train.Saver([v for v in tf.global_variables() if v.name not in eval_names])
         self.summary_writer = tf.summary.FileWriter(self.model_dir)
 
+        # the chief (rank 0) initializes, checkpoints and evaluates, the
+        # other ranks wait for it and then only train
+        local_init_op = tf.train.Supervisor.USE_DEFAULT
+        ready_for_local_init_op = None
+        if self.world_size > 1:
+            if self.is_chief:
+                local_init_op = self.sync_optimizer.chief_init_op
+            else:
+                local_init_op = self.sync_optimizer.local_step_init_op
+            ready_for_local_init_op = self.sync_optimizer.ready_for_local_init_op
+            chief_queue_runner = self.sync_optimizer.get_chief_queue_runner()
+            sync_init_op = self.sync_optimizer.get_init_tokens_op()
+
         sv = tf.train.Supervisor(logdir=self.model_dir,
-                                is_chief=True,
+                                is_chief=self.is_chief,
                                 saver=self.saver,
                                 summary_op=None,
                                 summary_writer=self.summary_writer,
                                 save_model_secs=self.save_sec,
                                 global_step=self.step,
-                                ready_for_local_init_op=None)
+                                local_init_op=local_init_op,
+                                ready_for_local_init_op=ready_for_local_init_op)
 
         gpu_options = tf.GPUOptions(allow_growth=True)
         sess_config = tf.ConfigProto(allow_soft_placement=True,
                                     gpu_options=gpu_options)
-
-        self.sess = sv.prepare_or_wait_for_session(config=sess_config)
+        master = ''
+        if self.world_size > 1:
+            # only the ps and this rank, ranks on one machine split its cores
+            master = self.servers[-1].target
+            sess_config.device_filters.extend(['/job:ps', '/job:worker/task:%d' % self.rank])
+            if not self.use_gpu:
+                sess_config.intra_op_parallelism_threads = max(multiprocessing.cpu_count() // self.world_size, 1)
+
+        self.sess = sv.prepare_or_wait_for_session(master, config=sess_config)
+        if self.world_size > 1 and self.is_chief:
+            self.sess.run(sync_init_op)
+            sv.start_queue_runners(self.sess, [chief_queue_runner])
         if self.is_train:
-            self.batch_manager.start_thread(self.sess)
+            for bm in self.batch_managers:
+                bm.start_thread(self.sess)
+            if self.num_replica > 1:
+                # each manager replaced the SIGINT handler, stop them all
+                def signal_handler(signum, frame):
+                    print('%s: canceled by SIGINT' % datetime.now())
+                    for bm in self.batch_managers:
+                        bm.stop_thread()
+                    sys.exit(1)
+                signal.signal(signal.SIGINT, signal_handler)
 
     def build_model(self):
-        self.y_, self.var = VDSR(
-                self.x, self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm)
+        if self.optimizer == 'adam':
+            optimizer = tf.train.AdamOptimizer
+        else:
+            raise Exception("[!] Caution! Paper didn't use {} opimizer other than Adam".format(self.config.optimizer))
+
+        optimizer = optimizer(self.lr, beta1=self.beta1, beta2=self.beta2)
+
+        # a tower per replica on its own batch, sharing the VDSR variables
+        replica_grads, y_list, l1_list, l2_list = [], [], [], []
+        for r, (x, y) in enumerate(zip(self.xs, self.ys)):
+            device = None
+            if self.num_replica > 1:
+                device = replica_device('/gpu:%d' % r if self.use_gpu else '/cpu:0')
+            with tf.device(device), tf.name_scope('replica_%d' % r):
+                y_, self.var = VDSR(
+                        x, self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm,
+                        reuse=(r > 0), dtype=self.dtype)
+
+                # losses
+                # l1 and l2
+                loss_l1 = tf.reduce_mean(tf.abs(y_ - y))
+                loss_l2 = tf.reduce_mean(tf.squared_difference(y_, y))
+                loss = loss_l2 if self.use_l2 else loss_l1
+                if self.loss_scale != 1:
+                    grads = optimizer.compute_gradients(loss * self.loss_scale, var_list=self.var)
+                    grads = [(g / self.loss_scale if g is not None else None, v) for g, v in grads]
+                else:
+                    grads = optimizer.compute_gradients(loss, var_list=self.var)
+                replica_grads.append(grads)
+            y_list.append(y_)
+            l1_list.append(loss_l1)
+            l2_list.append(loss_l2)
+
+        self.y_ = y_list[0]
         self.y_img = denorm_img(self.y_, self.data_format) # for debug
 
         self.yt_, _ = VDSR(
@@ -86,19 +312,21 @@ class Trainer(object):
         self.yt_ = tf.clip_by_value(self.yt_, 0, 1)
         self.yt_img = denorm_img(self.yt_, self.data_format)
 
-        show_all_variables()        
-
-        if self.optimizer == 'adam':
-            optimizer = tf.train.AdamOptimizer
-        else:
-            raise Exception("[!] Caution! Paper didn't use {} opimizer other than Adam".format(self.config.optimizer))
+        # evaluation tower with its own copy of the weights, refreshed by
+        # self.snapshot and run in the background (see evaluate)
+        self.ye_, eval_var = VDSR(
+                self.xt, self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm,
+                name='VDSR_eval', train=False)
+        self.ye_ = tf.clip_by_value(self.ye_, 0, 1)
+        train_var = {v.op.name.split('/', 1)[1]: v for v in self.var}
+        self.snapshot = tf.group(*[v.assign(train_var[v.op.name.split('/', 1)[1]]) for v in eval_var])
+        self.eval_var = eval_var
 
-        optimizer = optimizer(self.lr, beta1=self.beta1, beta2=self.beta2)
+        show_all_variables()        
 
-        # losses
-        # l1 and l2
-        self.loss_l1 = tf.reduce_mean(tf.abs(self.y_ - self.y))
-        self.loss_l2 = tf.reduce_mean(tf.squared_difference(self.y_, self.y))
+        # mean over replicas
+        self.loss_l1 = tf.add_n(l1_list) / self.num_replica
+        self.loss_l2 = tf.add_n(l2_list) / self.num_replica
 
         # total
         if self.use_l2:
@@ -106,14 +334,18 @@ class Trainer(object):
         else:
             self.loss = self.loss_l1
 
-        # test loss
-        self.tl1 = 1 - tf.reduce_mean(tf.abs(self.yt_ - self.yt))
-        self.tl2 = 1 - tf.reduce_mean(tf.squared_difference(self.yt_, self.yt))
+        # test accuracy, see score
         self.test_acc_l1 = tf.placeholder(tf.float32)
         self.test_acc_l2 = tf.placeholder(tf.float32)
         self.test_acc_iou = tf.placeholder(tf.float32)
 
-        self.optim = optimizer.minimize(self.loss, global_step=self.step, var_list=self.var)
+        if self.world_size > 1:
+            # an update waits for the gradients of every rank and applies
+            # their mean, stale ones are dropped
+            optimizer = tf.train.SyncReplicasOptimizer(optimizer, replicas_to_aggregate=self.world_size,
+                                                       total_num_replicas=self.world_size)
+            self.sync_optimizer = optimizer
+        self.optim = optimizer.apply_gradients(average_gradients(replica_grads), global_step=self.step)
  
         summary = [
             tf.summary.image("y", self.y_img),
@@ -143,6 +375,9 @@ class Trainer(object):
 
         self.summary_test = tf.summary.merge(summary)
 
+        # queue levels, fetched every step for the starvation count
+        self.q_sizes = [bm.q.size() for bm in self.batch_managers]
+
     def train(self):
         x_list, xs, ys, sample_list = self.batch_manager.random_list(self.b_num)
         save_image(xs, '{}/x_gt.png'.format(self.model_dir))
@@ -157,10 +392,22 @@ class Trainer(object):
         self.summary_writer.add_summary(summary_once, 0)
         self.summary_writer.flush()
 
+        if self.is_chief:
+            self.valid_x, self.valid_y = valid_set(self.batch_manager, self.config)
+        self.eval_thread = None
+
+        # throughput since the last log step, traced steps are slower and
+        # left out (their time in traced_time). trace: (step, dequeue wait,
+        # step time) of a traced step of this log interval
+        step_times, traced_time, starved, trace = [], 0, 0, None
+        self.last_log_time = time.time()
+        self.last_produced = self.produced_counts()
+
         for step in trange(self.start_step, self.max_step):
             fetch_dict = {
                 "optim": self.optim,
                 "loss": self.loss,
+                "q": self.q_sizes,
             }           
 
             if step % self.log_step == 0 or step == self.max_step-1:
@@ -168,47 +415,42 @@ class Trainer(object):
                     "summary": self.summary_op,                    
                 })
 
-            if step % self.test_step == self.test_step-1 or step == self.max_step-1:
-                l1, l2, iou, nb = 0, 0, 0, 0
-                for x, y in self.batch_manager.test_batch():
-                    if self.data_format == 'NCHW':
-                        x = to_nchw_numpy(x)
-                        y = to_nchw_numpy(y)
-                    tl1, tl2, y_ = self.sess.run([self.tl1, self.tl2, self.yt_], {self.xt: x, self.yt: y})
-                    l1 += tl1
-                    l2 += tl2
-                    nb += 1
-
-                    # iou
-                    y_I = np.logical_and(y>0, y_>0)
-                    y_I_sum = np.sum(y_I, axis=(1, 2, 3))
-                    y_U = np.logical_or(y>0, y_>0)
-                    y_U_sum = np.sum(y_U, axis=(1, 2, 3))
-                    # print(y_I_sum, y_U_sum)
-                    nonzero_id = np.where(y_U_sum != 0)[0]
-                    if nonzero_id.shape[0] == 0:
-                        acc = 1.0
-                    else:
-                        acc = np.average(y_I_sum[nonzero_id] / y_U_sum[nonzero_id])
-                    iou += acc
-
-                    if nb > 500:
-                        break
-
-                l1 /= float(nb)
-                l2 /= float(nb)
-                iou /= float(nb)
-                    
-                summary_test = self.sess.run(self.summary_test, 
-                              {self.test_acc_l1: l1, self.test_acc_l2: l2, self.test_acc_iou: iou})
-                self.summary_writer.add_summary(summary_test, step)
-                self.summary_writer.flush()
-
-            result = self.sess.run(fetch_dict)
+            if step in self.profile_steps:
+                self.profile_producer(step)
+
+            # traced every trace_step steps to split a step into dequeue wait
+            # and compute
+            traced = step in self.profile_steps or (self.trace_step > 0 and step % self.trace_step == 0)
+            run_options, run_metadata = None, None
+            if traced:
+                run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+                run_metadata = tf.RunMetadata()
+
+            if self.is_chief and (step % self.test_step == self.test_step-1 or step == self.max_step-1):
+                self.evaluate(step, wait=(step == self.max_step-1))
+
+            start_time = time.time()
+            result = self.sess.run(fetch_dict, options=run_options, run_metadata=run_metadata)
+            if traced:
+                traced_time += time.time() - start_time
+                trace = (step, dequeue_time(run_metadata), time.time() - start_time)
+            else:
+                step_times.append(time.time() - start_time)
+            if min(result['q']) < self.batch_size:
+                starved += 1
+
+            if step in self.profile_steps:
+                timeline_path = os.path.join(self.profile_dir, 'step_%d.json' % step)
+                save_timeline(run_metadata, timeline_path)
+                print('%s: step %d profiled in %s' % (datetime.now(), step, self.profile_dir))
 
             if step % self.log_step == 0 or step == self.max_step-1:
+                start_time = time.time()
                 self.summary_writer.add_summary(result['summary'], step)
                 self.summary_writer.flush()
+                self.log_throughput(step, step_times, traced_time, time.time() - start_time,
+                                    starved, result['q'], trace)
+                step_times, traced_time, starved, trace = [], 0, 0, None
 
                 loss = result['loss']
                 assert not np.isnan(loss), 'Model diverged with loss = NaN'
@@ -218,13 +460,95 @@ class Trainer(object):
             if step % (self.log_step * 10) == 0 or step == self.max_step-1:
                 self.generate(x_list, self.model_dir, idx=step)
 
-            if step % self.lr_update_step == self.lr_update_step - 1:
+            if self.is_chief and step % self.lr_update_step == self.lr_update_step - 1:
                 self.sess.run(self.lr_update)
 
         # save last checkpoint..
-        save_path = os.path.join(self.model_dir, 'model.ckpt')
-        self.saver.save(self.sess, save_path, global_step=self.step)
-        self.batch_manager.stop_thread()
+        if self.is_chief:
+            save_path = os.path.join(self.model_dir, 'model.ckpt')
+            self.saver.save(self.sess, save_path, global_step=self.step)
+        for bm in self.batch_managers:
+            bm.stop_thread()
+
+    def profile_producer(self, step):
+        # cProfile only sees the calling thread: a batch of the producer
+        # work is run here instead of in the producer threads
+        rng = np.random.RandomState(step)
+        for r, bm in enumerate(self.batch_managers):
+            ids = rng.randint(len(bm.train), size=self.batch_size)
+            profiler = cProfile.Profile()
+            profiler.enable()
+            produce_examples(bm, ids, rng)
+            profiler.disable()
+            name = 'producer_%d' % step if self.num_replica == 1 else 'producer_%d_%d' % (step, r)
+            save_profile(profiler, os.path.join(self.profile_dir, name))
+
+    def produced_counts(self):
+        return [n for bm in self.batch_managers for n in bm.produced]
+
+    def log_throughput(self, step, step_times, traced_time, summary_time, starved, q, trace):
+        # timing of the untraced steps since the last log, to TensorBoard
+        # (throughput/*) and a line of model_dir/throughput.jsonl. dequeue
+        # and compute time only on lines whose interval has a traced step,
+        # both of that step (its compute includes the tracing overhead)
+        now = time.time()
+        elapsed = now - self.last_log_time
+        produced = self.produced_counts()
+        rates = [(n - m) / elapsed for n, m in zip(produced, self.last_produced)]
+        self.last_log_time, self.last_produced = now, produced
+
+        stat = {
+            'step': step,
+            'steps': len(step_times),
+            'step_time': float(np.mean(step_times)) if step_times else 0,
+            'summary_time': summary_time,
+            'examples_per_sec': len(step_times) * self.batch_size * self.num_replica / max(elapsed - traced_time, 1e-6),
+            'produced_per_sec': float(np.sum(rates)),
+            'starved_steps': starved,
+            'q': [int(n) for n in q],
+            'worker_produced_per_sec': rates,
+        }
+        keys = ['step_time', 'summary_time', 'examples_per_sec', 'produced_per_sec', 'starved_steps']
+        if trace is not None:
+            traced_step, dequeue_wait, traced_step_time = trace
+            stat.update({
+                'traced_step': traced_step,
+                'dequeue_time': dequeue_wait,
+                'compute_time': max(traced_step_time - dequeue_wait, 0),
+            })
+            keys += ['dequeue_time', 'compute_time']
+
+        values = [tf.Summary.Value(tag='throughput/' + k, simple_value=stat[k]) for k in keys]
+        values += [tf.Summary.Value(tag='throughput/worker_%d' % i, simple_value=r)
+                   for i, r in enumerate(rates)]
+        self.summary_writer.add_summary(tf.Summary(value=values), step)
+        with open(os.path.join(self.model_dir, 'throughput.jsonl'), 'a') as f:
+            f.write(json.dumps(stat) + '\n')
+
+    def evaluate(self, step, wait=False):
+        # copy the weights and score the copy in a thread, training goes on;
+        # skipped if the previous evaluation is still running
+        if self.eval_thread is not None and self.eval_thread.is_alive():
+            if not wait:
+                print('%s: evaluation still running, skip step %d' % (datetime.now(), step))
+                return
+            self.eval_thread.join()
+
+        self.sess.run(self.snapshot)
+        self.eval_thread = threading.Thread(target=self.run_eval, args=(step,))
+        self.eval_thread.start()
+        if wait:
+            self.eval_thread.join()
+
+    def run_eval(self, step):
+        l1, l2, iou = score(lambda x: self.sess.run(self.ye_, {self.xt: x}),
+                            self.valid_x, self.valid_y, self.batch_size, self.data_format)
+
+        summary_test = self.sess.run(self.summary_test, 
+                      {self.test_acc_l1: l1, self.test_acc_l2: l2, self.test_acc_iou: iou})
+        self.summary_writer.add_summary(summary_test, step)
+        self.summary_writer.flush()
+        print('%s: step %d test l1 %.4f l2 %.4f iou %.4f' % (datetime.now(), step, l1, l2, iou))
 
     def generate(self, x_samples, root_path=None, idx=None):
         if self.data_format == 'NCHW':
@@ -1,8 +1,13 @@
 from __future__ import print_function
 
 import os
+import sys
+import copy
 import math
 import json
+import time
+import pstats
+import hashlib
 import logging
 import numpy as np
 from PIL import Image
@@ -33,6 +38,9 @@ def prepare_dirs_and_logger(config):
     if config.is_train:
         model_name = os.path.join(config.archi, '{}_{}_{}'.format(
             config.dataset, get_time(), config.tag))
+        if config.world_size > 1:
+            # logs of each rank, checkpoints in the chief's (rank 0)
+            model_name += '_rank%d' % config.rank
         config.model_dir = os.path.join(config.log_dir, model_name)    
     else:
         model_name = os.path.join('vec', '{}_{}_{}'.format(
@@ -42,6 +50,157 @@ def prepare_dirs_and_logger(config):
     if not os.path.exists(config.model_dir):
         os.makedirs(config.model_dir)
 
+    # how the producer rngs derive from the seed, see worker_rngs
+    config.worker_rng = 'MT19937(SeedSequence(%d).spawn(%d)[worker])' % (
+        config.random_seed, config.num_worker)
+
+def worker_rngs(seed, num_worker):
+    # independent streams for the producer threads, spawned from the run seed
+    children = np.random.SeedSequence(seed).spawn(num_worker)
+    return [np.random.RandomState(np.random.MT19937(c)) for c in children]
+
+def epoch_ids(num, seed, worker, num_worker):
+    # endless ids of a split without replacement: every epoch is a
+    # permutation fixed by (seed, epoch) and worker takes every num_worker-th
+    # id of it, so the producer threads together visit each id once per epoch
+    assert num >= num_worker, '%d drawings for %d producer threads, lower --num_worker' % (num, num_worker)
+    epoch = 0
+    while True:
+        perm = np.random.RandomState(np.random.MT19937(np.random.SeedSequence([seed, epoch]))).permutation(num)
+        for id in perm[worker::num_worker]:
+            yield id
+        epoch += 1
+
+def replica_configs(config):
+    # BatchManager config of each data parallel replica: its own part of
+    # the train split (of this process' rank) and share of the workers
+    configs = []
+    for r in range(config.num_replica):
+        c = copy.copy(config)
+        c.rank = config.rank * config.num_replica + r
+        c.world_size = config.world_size * config.num_replica
+        c.num_worker = max(config.num_worker // config.num_replica, 1)
+        c.random_seed = config.random_seed + r
+        configs.append(c)
+    return configs
+
+def to_uint8(x):
+    # [0,1] images for the input queues, batch() scales them back
+    return np.rint(np.clip(x, 0, 1) * 255).astype(np.uint8)
+
+def marker_coords(x):
+    # [n,h,w,2] pathnet inputs -> [n,2] (row, col) of the marker pixel,
+    # -1 where there is none
+    n, _, w, _ = x.shape
+    marker = x[...,1].reshape([n, -1])
+    ids = np.argmax(marker, axis=1)
+    coords = np.stack([ids // w, ids % w], axis=1)
+    coords[marker[np.arange(n), ids] <= 0] = -1
+    return coords.astype(np.int32)
+
+def compact_example(x, y, is_pathnet):
+    # queue form of [n,h,w,c] float examples, expanded by ops.expand_example
+    if is_pathnet:
+        return to_uint8(x[...,:1]), marker_coords(x), to_uint8(y)
+    return to_uint8(x), np.packbits(y.reshape([len(y), -1]) > 0, axis=1)
+
+def produce_examples(batch_manager, ids, rng):
+    # the work of a producer thread of batch_manager on the train drawings
+    # ids, without the enqueue: latency and number of examples per drawing
+    module = sys.modules[type(batch_manager).__module__]
+    w, h = batch_manager.width, batch_manager.height
+    is_pathnet = batch_manager.is_pathnet
+    num_samples = batch_manager.samples_per_render
+    latency, count = [], []
+    for id in ids:
+        start_time = time.time()
+        svg, drawing = batch_manager.train[id]
+        if hasattr(module, 'TEMPLATE_TRANSFORM'): # ch, kanji
+            transform = module.TEMPLATE_TRANSFORM
+            if is_pathnet:
+                x_, y_ = module.preprocess_path(svg, w, h, rng, transform, num_samples)
+            else:
+                x_, y_ = module.preprocess_overlap(svg, w, h, rng, transform)
+        else:
+            rasterizer = batch_manager.rasterizer
+            if is_pathnet:
+                x_, y_ = module.preprocess_path(svg, w, h, rng, rasterizer, drawing, num_samples)
+            else:
+                x_, y_ = module.preprocess_overlap(svg, w, h, rng, rasterizer, drawing)
+        if not is_pathnet:
+            x_, y_ = x_[np.newaxis], y_[np.newaxis]
+        compact_example(x_, y_, is_pathnet)
+        latency.append(time.time() - start_time)
+        count.append(len(x_))
+    return latency, count
+
+def valid_set(batch_manager, config):
+    # fixed (x, y) test examples, float32 NHWC: rendered once with a rng
+    # seeded by random_seed into data_path/valid and memory-mapped from
+    # there, so every evaluation and every run scores the same examples.
+    # named after everything the examples depend on: the flags, the test
+    # names and, for the line dataset, its generation config
+    bs = batch_manager.batch_size
+    num = min(-(-config.eval_size // bs), len(batch_manager.test) // bs) * bs
+    assert num > 0, 'no full test batch'
+    digest = hashlib.md5('\n'.join(os.path.basename(p) for p in batch_manager.test_paths).encode('utf-8'))
+    gen_config_path = os.path.join(config.data_path, 'gen_config.json')
+    if os.path.exists(gen_config_path):
+        with open(gen_config_path, 'rb') as f:
+            digest.update(f.read())
+    name = '%s_%dx%d_%s_pack%d_onepass%d_%d_%d_%s' % (
+        config.archi, config.width, config.height, config.rasterizer, config.data_pack,
+        config.gt_one_pass, config.random_seed, num, digest.hexdigest()[:8])
+    valid_dir = os.path.join(config.data_path, 'valid')
+    x_path = os.path.join(valid_dir, name + '_x.npy')
+    y_path = os.path.join(valid_dir, name + '_y.npy')
+
+    if not os.path.exists(y_path):
+        print('%s: render %d validation examples into %s' % (datetime.now(), num, valid_dir))
+        if not os.path.exists(valid_dir):
+            os.makedirs(valid_dir)
+        rng = np.random.RandomState(config.random_seed)
+        xm, ym = None, None
+        for i, (x, y) in enumerate(batch_manager.test_batch(rng)):
+            if i*bs >= num:
+                break
+            if xm is None:
+                xm = np.lib.format.open_memmap(x_path + '.tmp', mode='w+', dtype=np.float32, shape=(num,) + x.shape[1:])
+                ym = np.lib.format.open_memmap(y_path + '.tmp', mode='w+', dtype=np.float32, shape=(num,) + y.shape[1:])
+            xm[i*bs:(i+1)*bs] = x
+            ym[i*bs:(i+1)*bs] = y
+        xm.flush()
+        ym.flush()
+        del xm, ym
+        # y last, its presence marks a complete set
+        os.rename(x_path + '.tmp', x_path)
+        os.rename(y_path + '.tmp', y_path)
+
+    return np.load(x_path, mmap_mode='r'), np.load(y_path, mmap_mode='r')
+
+def profile_targets(config):
+    # --profile: comma separated train steps or test files (name or index)
+    return set(p.strip() for p in config.profile.split(',') if p.strip())
+
+def profile_dir(config):
+    path = os.path.join(config.model_dir, 'profile')
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+def save_profile(profiler, path):
+    # cProfile stats for pstats/snakeviz (.prof) and the top functions by
+    # cumulative time (.txt)
+    profiler.dump_stats(path + '.prof')
+    with open(path + '.txt', 'w') as f:
+        pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(50)
+
+def save_timeline(run_metadata, path):
+    # chrome://tracing view of a traced sess.run
+    from tensorflow.python.client import timeline
+    with open(path, 'w') as f:
+        f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+
 def get_time():
     return datetime.now().strftime("%m%d_%H%M%S")
 
@@ -111,6 +270,50 @@ def convert_png2mp4(imgdir, filename, fps, delete_imgdir=False):
     
     if delete_imgdir: shutil.rmtree(imgdir)
     
+RASTER_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+def load_raster(f, w, h, threshold=0):
+    # ink intensity in [0,1] from a file path or file object (alpha if any,
+    # darkness otherwise), intensity <= threshold is set to background
+    img = Image.open(f)
+    if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+        img = img.convert('RGBA').split()[-1]
+    else:
+        img = Image.eval(img.convert('L'), lambda v: 255 - v)
+    if img.size != (w, h):
+        img = img.resize((w, h), Image.BILINEAR)
+    s = np.array(img).astype(np.float)
+    max_intensity = np.amax(s)
+    if max_intensity > 0:
+        s = s / max_intensity
+    s[s <= threshold] = 0
+    return s
+
+def load_rasters(paths, w, h, threshold=0, cache_path=None):
+    # load images into one [n,h,w] float32 array, optionally backed by a
+    # memory-mapped .npy file that is reused when its shape matches
+    shape = (len(paths), h, w)
+    if cache_path is not None and os.path.exists(cache_path):
+        imgs = np.load(cache_path, mmap_mode='r')
+        if imgs.shape == shape:
+            return imgs
+
+    # written aside and renamed once complete, an interrupted run leaves
+    # only the .tmp file
+    if cache_path is not None:
+        imgs = np.lib.format.open_memmap(cache_path + '.tmp', mode='w+', dtype=np.float32, shape=shape)
+    else:
+        imgs = np.zeros(shape, dtype=np.float32)
+    for i, path in enumerate(paths):
+        imgs[i] = load_raster(path, w, h, threshold)
+
+    if cache_path is not None:
+        imgs.flush()
+        del imgs
+        os.rename(cache_path + '.tmp', cache_path)
+        imgs = np.load(cache_path, mmap_mode='r')
+    return imgs
+
 def rf(o, k, stride): # input size from output size
     return (o-1)*stride + k
 